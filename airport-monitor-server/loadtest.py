@@ -0,0 +1,462 @@
+"""Load test of the monitor server with simulated dashboards
+
+Seeds Redis with a world of --airports airports, each with --gates gates and
+--runways runways, a --busy share of them holding a plane, and a Sky of
+--planes planes, half of them circling. The snapshots are made by the
+simulator's own components, so run this where the simulator's dependencies
+are installed.
+
+Then --dashboards dashboards poll the server the way airport-monitor does:
+every --interval seconds the Sky, and for each of the --watch airports the
+dashboard shows, the airport and each of its runways and gates. A dashboard
+sends its requests one after the other on a keep-alive connection; when a
+round takes longer than the interval the next one starts late, which is
+counted. --interval 0 polls as fast as the server answers.
+
+Without --redis an in-process Redis stand-in serves the world, and without
+--url the server is started on it. The report has the offered and achieved
+request rates, latency percentiles per endpoint, and the server's CPU use
+read from /proc (given --server-pid when the server runs elsewhere):
+
+    python loadtest.py --airports 20 --gates 20 --planes 20000 --dashboards 10
+"""
+
+import argparse
+import fnmatch
+import http.client
+import json
+import os
+import random
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from redis import Redis
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "simulator"))
+# pylint:disable=wrong-import-position
+import snapshot
+from airport import Airport
+from gate import Gate, GateState
+from localbroker import LocalBroker
+from plane import Plane, PlaneState
+from runway import Runway, RunwayState
+from sky import Sky
+
+
+class RedisStandIn(socketserver.ThreadingTCPServer):
+    """Just enough of Redis for the simulator's snapshots and the server:
+    HELLO, PING, GET, SET, MGET, DEL, EXISTS, KEYS, SCAN and FLUSHDB"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port: int = 0):
+        super().__init__(("127.0.0.1", port), RespHandler)
+        self.store: Dict[bytes, bytes] = {}
+        self.lock = threading.Lock()
+        self.commands = 0
+        self.bytes_sent = 0
+
+    def execute(self, command: List[bytes]):
+        """run a command; returns the reply as a Python value"""
+        name = command[0].upper()
+        arguments = command[1:]
+        with self.lock:
+            self.commands += 1
+            if name == b"GET":
+                return self.store.get(arguments[0])
+            if name == b"MGET":
+                return [self.store.get(key) for key in arguments]
+            if name == b"SET":
+                self.store[arguments[0]] = arguments[1]
+                return "OK"
+            if name == b"DEL":
+                return sum(self.store.pop(key, None) is not None for key in arguments)
+            if name == b"EXISTS":
+                return sum(key in self.store for key in arguments)
+            if name in (b"KEYS", b"SCAN"):
+                if name == b"KEYS":
+                    pattern = arguments[0]
+                else:
+                    options = [argument.upper() for argument in arguments]
+                    pattern = (
+                        arguments[options.index(b"MATCH") + 1]
+                        if b"MATCH" in options
+                        else b"*"
+                    )
+                keys = [
+                    key
+                    for key in self.store
+                    if fnmatch.fnmatchcase(key.decode(), pattern.decode())
+                ]
+                return keys if name == b"KEYS" else [b"0", keys]
+            if name == b"FLUSHDB":
+                self.store.clear()
+                return "OK"
+            if name == b"HELLO":
+                hello = {"server": "redis", "version": "7.0.0", "proto": 2}
+                if arguments and arguments[0] == b"3":
+                    hello["proto"] = 3
+                    return hello  # a RESP3 map
+                return [item for pair in hello.items() for item in pair]
+            if name in (b"PING", b"CLIENT", b"SELECT"):
+                return "PONG" if name == b"PING" else "OK"
+        return ValueError(f"unknown command '{name.decode()}'")
+
+
+def encode_reply(value) -> bytes:
+    """RESP encoding of a reply; dicts are RESP3 maps, for HELLO 3"""
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, ValueError):
+        return f"-ERR {value}\r\n".encode()
+    if isinstance(value, str):
+        return f"+{value}\r\n".encode()
+    if isinstance(value, int):
+        return f":{value}\r\n".encode()
+    if isinstance(value, bytes):
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+    if isinstance(value, dict):
+        return b"%%%d\r\n" % len(value) + b"".join(
+            encode_reply(item) for pair in value.items() for item in pair
+        )
+    return b"*%d\r\n" % len(value) + b"".join(encode_reply(item) for item in value)
+
+
+class RespHandler(socketserver.StreamRequestHandler):
+    """one client connection"""
+
+    def read_command(self) -> Optional[List[bytes]]:
+        """an array of bulk strings, or an inline command"""
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            return line.split()
+        command = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            command.append(self.rfile.read(length + 2)[:-2])
+        return command
+
+    def handle(self):
+        while True:
+            command = self.read_command()
+            if command is None:
+                return
+            if not command:
+                continue
+            reply = encode_reply(self.server.execute(command))
+            self.server.bytes_sent += len(reply)
+            self.wfile.write(reply)
+
+
+def seed(redis: Redis, args: argparse.Namespace) -> List[Tuple[str, list, list]]:
+    """write the world's snapshots; returns (airport, runways, gates) of each"""
+    rng = random.Random(args.seed)
+    broker = LocalBroker()  # the components are only built for their to_dict
+    names = [f"A{index:03d}" for index in range(args.airports)]
+    layout = []
+    pipeline = redis.pipeline(transaction=False)
+
+    def busy(component, in_use, plane_state):
+        if rng.random() < args.busy:
+            component.current_plane = Plane(
+                component.airport, rng.choice(names), rng=rng
+            )
+            component.current_plane.state = plane_state
+            component.state = in_use
+            component.ticks_till_exit = rng.randint(1, 10)
+        pipeline.set(component.redis_key, snapshot.dumps(component.to_dict()))
+
+    for name in names:
+        runways = [str(number) for number in range(1, args.runways + 1)]
+        gates = [str(number) for number in range(1, args.gates + 1)]
+        airport = Airport(name, runways, gates, broker=broker)
+        for _ in range(rng.randint(0, args.gates)):
+            airport.waiting_for_departure_gate.offer(
+                Plane(name, rng.choice(names), rng=rng)
+            )
+        pipeline.set(airport.redis_key, snapshot.dumps(airport.to_dict()))
+        for number in runways:
+            busy(
+                Runway(name, number, broker=broker),
+                RunwayState.IN_USE_DEPARTING,
+                PlaneState.ON_DEPARTURE_RUNWAY,
+            )
+        for number in gates:
+            busy(
+                Gate(name, number, broker=broker),
+                GateState.IN_USE_DEPARTING,
+                PlaneState.AT_DEPARTURE_GATE,
+            )
+        pipeline.execute()
+        layout.append((name, runways, gates))
+
+    sky = Sky(broker=broker)
+    for index in range(args.planes):
+        plane = Plane(rng.choice(names), rng.choice(names), rng=rng)
+        if index % 2:
+            plane.state = PlaneState.IN_SKY
+            plane.ticks_in_sky = rng.randint(Sky.FLIGHT_MIN_TICKS, Sky.FLIGHT_MAX_TICKS)
+            sky.planes_flying.append(plane)
+        else:
+            plane.state = PlaneState.CIRCLING
+            sky.plane_queues.setdefault(plane.end_airport, Sky.new_queue()).offer(plane)
+    redis.set(sky.redis_key, snapshot.dumps(sky.to_dict()))
+    return layout
+
+
+def dashboard_requests(layout: list, watch: int, rng: random.Random) -> List[tuple]:
+    """(endpoint, path) of one polling round of a dashboard"""
+    requests = [("/state/sky", "/state/sky")]
+    for name, runways, gates in rng.sample(layout, min(watch, len(layout))):
+        requests.append(("/state/airport", f"/state/airport?airport={name}"))
+        requests += [
+            ("/state/runway", f"/state/runway?airport={name}&runway_number={number}")
+            for number in runways
+        ]
+        requests += [
+            ("/state/gate", f"/state/gate?airport={name}&gate_number={number}")
+            for number in gates
+        ]
+    return requests
+
+
+class Dashboard(threading.Thread):
+    """polls its requests every interval until the deadline"""
+
+    def __init__(self, url, requests: List[tuple], interval: float, deadline: float):
+        super().__init__(daemon=True)
+        self.address = urlparse(url)
+        self.requests = requests
+        self.interval = interval
+        self.deadline = deadline
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.rounds = 0
+        self.late_rounds = 0
+        self.connection = None
+
+    def get(self, path: str) -> int:
+        """GET path; returns the status"""
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(
+                self.address.hostname, self.address.port, timeout=30
+            )
+        try:
+            self.connection.request("GET", path)
+            response = self.connection.getresponse()
+            response.read()
+            return response.status
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.connection = None
+            return 0
+
+    def run(self):
+        next_round = time.monotonic()
+        while next_round < self.deadline:
+            for endpoint, path in self.requests:
+                start = time.perf_counter()
+                status = self.get(path)
+                if status == 200:
+                    self.latencies[endpoint].append(time.perf_counter() - start)
+                else:
+                    self.errors[endpoint] += 1
+            self.rounds += 1
+            next_round += self.interval
+            now = time.monotonic()
+            if now < next_round:
+                time.sleep(next_round - now)
+            else:
+                if self.interval:
+                    self.late_rounds += 1
+                next_round = now
+
+
+def cpu_seconds(pid: int) -> float:
+    """user and system CPU time of a process, from /proc"""
+    with open(f"/proc/{pid}/stat", encoding="utf-8") as stat:
+        # the fields after the command name, which is in parentheses
+        fields = stat.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def percentile(values: List[float], q: float) -> float:
+    """nearest-rank percentile of sorted values"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, round(q * len(values)) - 1))]
+
+
+def start_server(port: int, redis_port: int) -> subprocess.Popen:
+    """run server.py on the Redis at redis_port until it answers"""
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(os.path.dirname(__file__), "server.py"),
+            "--http-port",
+            str(port),
+        ],
+        env={**os.environ, "REDIS_HOST": "127.0.0.1", "REDIS_PORT": str(redis_port)},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            connection.request("GET", "/state/sky")
+            connection.getresponse().read()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("the server did not come up")
+
+
+def main():
+    """main"""
+    parser = argparse.ArgumentParser(description="Monitor server load test")
+    parser.add_argument("--airports", type=int, default=20)
+    parser.add_argument("--gates", type=int, default=20, help="per airport")
+    parser.add_argument("--runways", type=int, default=4, help="per airport")
+    parser.add_argument("--planes", type=int, default=10000, help="in the sky")
+    parser.add_argument(
+        "--busy", type=float, default=0.5, help="share of gates and runways in use"
+    )
+    parser.add_argument("--dashboards", type=int, default=10)
+    parser.add_argument(
+        "--watch", type=int, default=2, help="airports shown on each dashboard"
+    )
+    parser.add_argument(
+        "--interval", type=float, default=1.0, help="seconds between polls"
+    )
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--redis", help="host:port of a Redis to seed instead of the stand-in"
+    )
+    parser.add_argument("--url", help="a running server, instead of starting one")
+    parser.add_argument("--server-pid", type=int, help="pid of the --url server")
+    parser.add_argument("--port", type=int, default=5099, help="for the server")
+    parser.add_argument("--output", help="JSON file for the results")
+    args = parser.parse_args()
+
+    stand_in = None
+    if args.redis:
+        host, port = args.redis.rsplit(":", 1)
+        redis_port = int(port)
+        redis = Redis(host=host, port=redis_port)
+    else:
+        stand_in = RedisStandIn()
+        threading.Thread(target=stand_in.serve_forever, daemon=True).start()
+        redis_port = stand_in.server_address[1]
+        redis = Redis(host="127.0.0.1", port=redis_port)
+    layout = seed(redis, args)
+    print(
+        f"seeded {args.airports} airports with {args.gates} gates and "
+        + f"{args.runways} runways, and {args.planes} planes in the sky; "
+        + f"sky snapshot {len(redis.get('sky'))} bytes"
+    )
+
+    server = None
+    url, pid = args.url, args.server_pid
+    if url is None:
+        server = start_server(args.port, redis_port)
+        url, pid = f"http://127.0.0.1:{args.port}", server.pid
+
+    try:
+        rng = random.Random(args.seed)
+        deadline = time.monotonic() + args.duration
+        dashboards = [
+            Dashboard(
+                url,
+                dashboard_requests(layout, args.watch, rng),
+                args.interval,
+                deadline,
+            )
+            for _ in range(args.dashboards)
+        ]
+        cpu_before = cpu_seconds(pid) if pid else None
+        start = time.monotonic()
+        for dashboard in dashboards:
+            dashboard.start()
+        for dashboard in dashboards:
+            dashboard.join()
+        elapsed = time.monotonic() - start
+        cpu = (cpu_seconds(pid) - cpu_before) / elapsed if pid else None
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors: Dict[str, int] = defaultdict(int)
+    for dashboard in dashboards:
+        for endpoint, values in dashboard.latencies.items():
+            latencies[endpoint].extend(values)
+        for endpoint, count in dashboard.errors.items():
+            errors[endpoint] += count
+    answered = sum(len(values) for values in latencies.values())
+    offered = (
+        sum(len(dashboard.requests) for dashboard in dashboards) / args.interval
+        if args.interval
+        else None
+    )
+    results = {
+        "dashboards": args.dashboards,
+        "seconds": elapsed,
+        "offered_per_second": offered,
+        "answered_per_second": answered / elapsed,
+        "errors": sum(errors.values()),
+        "late_rounds": sum(dashboard.late_rounds for dashboard in dashboards),
+        "rounds": sum(dashboard.rounds for dashboard in dashboards),
+        "server_cpu": cpu,
+        "endpoints": {},
+    }
+    for endpoint in sorted(set(latencies) | set(errors)):
+        values = sorted(latencies[endpoint])
+        results["endpoints"][endpoint] = {
+            "count": len(values),
+            "errors": errors[endpoint],
+            **{
+                f"p{q}_ms": round(percentile(values, q / 100) * 1000, 2)
+                for q in (50, 90, 99)
+            },
+        }
+    if stand_in:
+        results["redis_commands"] = stand_in.commands
+        results["redis_bytes_sent"] = stand_in.bytes_sent
+        stand_in.shutdown()
+
+    print(
+        f"{args.dashboards} dashboards: {results['answered_per_second']:.1f} "
+        + "requests/s answered"
+        + (f" of {offered:.1f} offered" if offered else "")
+        + f", {results['errors']} errors, "
+        + f"{results['late_rounds']} of {results['rounds']} rounds late"
+        + (f", server CPU {cpu:.0%}" if cpu is not None else "")
+    )
+    print(
+        f"{'endpoint':<18}{'count':>8}{'errors':>8}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}"
+    )
+    for endpoint, row in results["endpoints"].items():
+        print(
+            f"{endpoint:<18}{row['count']:>8}{row['errors']:>8}"
+            + f"{row['p50_ms']:>9.2f}{row['p90_ms']:>9.2f}{row['p99_ms']:>9.2f}"
+        )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
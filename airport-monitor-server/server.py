@@ -1,12 +1,21 @@
 """returns state to the frontend"""
 
-import json
 import argparse
+import json
 import os
+import sys
 from redis import Redis
 from flask import Flask, jsonify, request
 from flask_cors import CORS
 
+# snapshot.py, locations.py and sharding.py are shared with the simulator; the
+# Dockerfile copies them alongside
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "simulator"))
+# pylint:disable=wrong-import-position
+import locations
+import snapshot
+from sharding import SKY_SHARDS, sky_redis_key
+
 parser = argparse.ArgumentParser(description="Gate Simulation")
 parser.add_argument("--http-port", type=int, required=True, help="HTTP server port")
 args = parser.parse_args()
@@ -18,7 +27,6 @@ redis = Redis(
     host=os.environ.get("REDIS_HOST", "redis"),
     port=int(os.environ.get("REDIS_PORT", 6379)),
     db=0,
-    decode_responses=True,
 )
 
 
@@ -32,11 +40,17 @@ def validate_args(request_args, required_keys: list):
 
 @app.route("/state/sky", methods=["GET"])
 def get_state_sky():
-    """HTTP endpoint to get the current state of the sky."""
-    sky = redis.get("sky")
-    if not sky:
+    """HTTP endpoint to get the current state of the sky, merged over its
+    SKY_SHARDS shards."""
+    keys = [sky_redis_key(shard) for shard in range(SKY_SHARDS)]
+    shards = [snapshot.loads(raw) for raw in redis.mget(keys) if raw]
+    if not shards:
         return jsonify({"error": "Sky state not found"}), 404
-    sky = json.loads(sky)
+    sky = {"plane_queues": {}, "planes_flying": []}
+    for shard in shards:
+        for airport, planes in shard.get("plane_queues", {}).items():
+            sky["plane_queues"].setdefault(airport, []).extend(planes)
+        sky["planes_flying"].extend(shard.get("planes_flying", []))
     return jsonify(sky)
 
 
@@ -51,7 +65,7 @@ def get_state_airport():
     if not airport:
         return jsonify({"error": "airport state not found for " + redis_key}), 404
 
-    return jsonify(json.loads(airport))
+    return jsonify(snapshot.loads(airport))
 
 
 @app.route("/state/runway", methods=["GET"])
@@ -70,7 +84,7 @@ def get_state_runway():
     if not runway:
         return jsonify({"error": "runway state not found for " + redis_key}), 404
 
-    return jsonify(json.loads(runway))
+    return jsonify(snapshot.loads(runway))
 
 
 @app.route("/state/gate", methods=["GET"])
@@ -89,7 +103,49 @@ def get_state_gate():
     if not gate:
         return jsonify({"error": "gate state not found for " + redis_key}), 404
 
-    return jsonify(json.loads(gate))
+    return jsonify(snapshot.loads(gate))
+
+
+def lookup(plane_ids: list, flight_ids: list) -> dict:
+    """locations of planes and flights from the index, None where unknown"""
+    fields = [f"plane:{plane_id}" for plane_id in plane_ids] + [
+        f"flight:{flight_id}" for flight_id in flight_ids
+    ]
+    values = redis.hmget(locations.LOCATIONS_KEY, fields) if fields else []
+    found = [json.loads(value) if value else None for value in values]
+    return {
+        "plane_ids": dict(zip(plane_ids, found[: len(plane_ids)])),
+        "flight_ids": dict(zip(flight_ids, found[len(plane_ids) :])),
+    }
+
+
+@app.route("/locate", methods=["GET"])
+def get_locate():
+    """HTTP endpoint to find where a plane is now, by `plane_id` or
+    `flight_id`. Comma separated ids return all of them."""
+    if not request.args.get("plane_id") and not request.args.get("flight_id"):
+        return jsonify({"error": "required parameter `plane_id` or `flight_id`"}), 404
+    plane_ids = [i for i in request.args.get("plane_id", "").split(",") if i]
+    flight_ids = [i for i in request.args.get("flight_id", "").split(",") if i]
+    found = lookup(plane_ids, flight_ids)
+    if len(plane_ids) + len(flight_ids) > 1:
+        return jsonify(found)
+    location = [*found["plane_ids"].values(), *found["flight_ids"].values()][0]
+    if location is None:
+        return jsonify({"error": "no location for " + (plane_ids + flight_ids)[0]}), 404
+    return jsonify(location)
+
+
+@app.route("/locate", methods=["POST"])
+def post_locate():
+    """HTTP endpoint for bulk lookups: a JSON body with lists `plane_ids`
+    and/or `flight_ids`"""
+    body = request.get_json(silent=True) or {}
+    plane_ids = body.get("plane_ids", [])
+    flight_ids = body.get("flight_ids", [])
+    if not isinstance(plane_ids, list) or not isinstance(flight_ids, list):
+        return jsonify({"error": "`plane_ids` and `flight_ids` must be lists"}), 400
+    return jsonify(lookup(plane_ids, flight_ids))
 
 
 def start_http_server():
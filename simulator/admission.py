@@ -0,0 +1,82 @@
+"""Bounded waiting queues with load shedding
+
+A BoundedQueue holds at most `capacity` items (0 means unbounded). What
+happens to an item that doesn't fit depends on the queue's policy:
+
+- reject: the item is refused and dropped
+- defer: the item is refused and handed back to where it came from, e.g. the
+  plane generator, to be offered again later
+- hangar: the item is kept in an overflow list that is not serialized and
+  moves into the queue as room frees up; it is lost if the process restarts
+
+Capacity and policy of a queue come from <PREFIX>_CAPACITY and
+<PREFIX>_POLICY in the environment, e.g. DEPARTURE_QUEUE_CAPACITY and
+DEPARTURE_QUEUE_POLICY for the planes waiting for a departure gate.
+"""
+
+import os
+from typing import Generic, Iterable, Iterator, List, Tuple, TypeVar
+
+REJECT = "reject"
+DEFER = "defer"
+HANGAR = "hangar"
+POLICIES = (REJECT, DEFER, HANGAR)
+
+T = TypeVar("T")
+
+
+def queue_limits(prefix: str) -> Tuple[int, str]:
+    """capacity and policy of a queue from the environment"""
+    capacity = int(os.environ.get(f"{prefix}_CAPACITY", "0"))
+    policy = os.environ.get(f"{prefix}_POLICY", REJECT)
+    if policy not in POLICIES:
+        raise ValueError(f"{prefix}_POLICY must be one of {', '.join(POLICIES)}")
+    return capacity, policy
+
+
+class BoundedQueue(Generic[T]):
+    """FIFO queue with a capacity and a policy for what doesn't fit"""
+
+    def __init__(self, capacity: int = 0, policy: str = REJECT, items: Iterable = ()):
+        self.capacity = capacity
+        self.policy = policy
+        self.items: List[T] = list(items)  # what is serialized
+        self.hangar: List[T] = []  # overflow under the hangar policy
+        self.shed = 0  # items refused so far
+
+    def __len__(self) -> int:
+        return len(self.items) + len(self.hangar)
+
+    def __iter__(self) -> Iterator[T]:
+        yield from self.items
+        yield from self.hangar
+
+    def full(self) -> bool:
+        """whether the queue itself is at capacity"""
+        return 0 < self.capacity <= len(self.items)
+
+    def admits(self) -> bool:
+        """whether offer() would take another item"""
+        return self.policy == HANGAR or not self.full()
+
+    def offer(self, item: T) -> bool:
+        """queue item if the policy allows it; False if it was refused"""
+        if not self.full():
+            self.items.append(item)
+        elif self.policy == HANGAR:
+            self.hangar.append(item)
+        else:
+            self.shed += 1
+            return False
+        return True
+
+    def refuse(self):
+        """count an item the caller turned away after admits() said no"""
+        self.shed += 1
+
+    def pop(self, index: int = 0) -> T:
+        """take an item off the queue, moving one in from the hangar"""
+        item = self.items.pop(index)
+        if self.hangar and not self.full():
+            self.items.append(self.hangar.pop(0))
+        return item
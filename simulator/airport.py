@@ -1,22 +1,26 @@
 """Airport Simulation using MQTT"""
 
-import json
-import random
 import os
 from uuid import uuid4
 from typing import List, Dict
+from functools import cached_property
 
 import argparse
 from redis import Redis
 
+from admission import DEFER, BoundedQueue, queue_limits
 from restorable import construct_or_restore
-from airportcomponent import AirportComponent
+from airportcomponent import handles
+from features import Component
 from plane import Plane, PlaneState
 from gate import GateState
 from runway import RunwayState
+from sharding import sky_topic_for
+import tracing
 
 MQTT_BROKER = os.environ.get("MQTT_BROKER", "localhost")
 REDIS_BROKER = os.environ.get("REDIS_BROKER", "localhost")
+DEPARTURE_QUEUE_CAPACITY, DEPARTURE_QUEUE_POLICY = queue_limits("DEPARTURE_QUEUE")
 
 
 def comma_separated_list(value: str):
@@ -29,30 +33,37 @@ def airport_redis_key(airport_name: str) -> str:
     return f"airport-{airport_name}"
 
 
-class Airport(AirportComponent):
+class Airport(Component):
     """Representation of an airport"""
 
+    logged_attributes = ("gate_seqs", "runway_seqs", "announced_depth", "deferred")
+
     @staticmethod
     def args_to_dict(arguments: argparse.Namespace) -> dict:
         """Convert command line arguments to a state dictionary."""
         return {"airport": arguments.airport, "runways": [], "gates": []}
 
-    @property
+    @cached_property
     def mqtt_topic(self):
         """Return the MQTT topic for the airport"""
         return f"airport/{self.airport}"
 
-    @property
+    @cached_property
     def mqttclientname(self):
         """Name of the MQTT client we will create"""
         return f"Airport_{self.airport}"
 
-    @property
+    @cached_property
+    def sky_topic(self):
+        """Topic of the Sky shard our arriving planes circle in"""
+        return sky_topic_for(self.airport)
+
+    @cached_property
     def loggername(self) -> str:
         """Name of the logger"""
         return f"Airport {self.airport}"
 
-    @property
+    @cached_property
     def redis_key(self) -> str:
         """Key for Redis storage"""
         return airport_redis_key(self.airport)
@@ -73,13 +84,21 @@ class Airport(AirportComponent):
 
         self.runways: Dict[str, str] = runways
         self.gates: Dict[str, str] = gates
+        # last state_seq heard from each runway and gate, to detect missed updates
+        self.runway_seqs: Dict[str, int] = {}
+        self.gate_seqs: Dict[str, int] = {}
 
-        self.waiting_for_departure_gate: List[Plane] = []
+        self.waiting_for_departure_gate: BoundedQueue[Plane] = BoundedQueue(
+            DEPARTURE_QUEUE_CAPACITY, DEPARTURE_QUEUE_POLICY
+        )
+        self.deferred: List[str] = []  # destinations handed back to the generator
+        self.announced_depth = None  # queue depth last told the generator
         self.waiting_for_arrival_gate: List[str] = []  # runway topic to notify
         self.waiting_for_departure_runway: List[str] = []  # gate topic to notify
         self.waiting_for_arrival_runway: List[Plane] = (
             []
         )  # should this be the sky topic?
+        self.arrivals_waiting = 0  # planes circling for us, as announced by Sky
 
         super().__init__(**kwargs)
 
@@ -87,6 +106,33 @@ class Airport(AirportComponent):
         """called by airportcomponent.on_connect"""
         self.log(f"Runways: {self.runways}")
         self.log(f"Gates: {self.gates}")
+        self.publish(
+            self.sky_topic,
+            {"msg_type": "arrivals_waiting_query", "airport": self.airport},
+        )
+
+    def register_gauges(self):
+        """queue depths"""
+        self.metrics.gauge(
+            "airport_departure_queue",
+            "Planes waiting for a departure gate",
+            lambda: len(self.waiting_for_departure_gate),
+        )
+        self.metrics.gauge(
+            "airport_arrival_gate_queue",
+            "Landed planes waiting for an arrival gate",
+            lambda: len(self.waiting_for_arrival_gate),
+        )
+        self.metrics.gauge(
+            "airport_departure_runway_queue",
+            "Planes at a gate waiting for a departure runway",
+            lambda: len(self.waiting_for_departure_runway),
+        )
+        self.metrics.gauge(
+            "airport_arrivals_waiting",
+            "Planes circling to land, as announced by Sky",
+            lambda: self.arrivals_waiting,
+        )
 
     def to_dict(self):
         """Convert the Airport instance to a dict representation."""
@@ -95,13 +141,14 @@ class Airport(AirportComponent):
             "runways": self.runways,
             "gates": self.gates,
             "waiting_for_departure_gate": [
-                plane.to_dict() for plane in self.waiting_for_departure_gate
+                plane.to_dict() for plane in self.waiting_for_departure_gate.items
             ],
             "waiting_for_arrival_gate": self.waiting_for_arrival_gate,
             "waiting_for_departure_runway": self.waiting_for_departure_runway,
             "waiting_for_arrival_runway": [
                 plane.to_dict() for plane in self.waiting_for_arrival_runway
             ],
+            "arrivals_waiting": self.arrivals_waiting,
         }
 
     @staticmethod
@@ -111,7 +158,7 @@ class Airport(AirportComponent):
             data["airport"], data["runways"], data["gates"], **kwargs
         )
         if data.get("waiting_for_departure_gate"):
-            restored_airport.waiting_for_departure_gate = [
+            restored_airport.waiting_for_departure_gate.items = [
                 Plane.from_dict(plane_data)
                 for plane_data in data["waiting_for_departure_gate"]
             ]
@@ -128,6 +175,7 @@ class Airport(AirportComponent):
                 Plane.from_dict(plane_data)
                 for plane_data in data["waiting_for_arrival_runway"]
             ]
+        restored_airport.arrivals_waiting = data.get("arrivals_waiting", 0)
         return restored_airport
 
     def assign_gate_for_departure(self, gate_number: str):
@@ -136,9 +184,8 @@ class Airport(AirportComponent):
             plane = self.waiting_for_departure_gate.pop(0)
             plane.start_gate = gate_number
             gate_topic = f"airport/{self.airport}/gate/{gate_number}"
-            self.client.publish(
-                gate_topic,
-                json.dumps({"msg_type": "departing_plane", "plane": plane.to_dict()}),
+            self.publish(
+                gate_topic, {"msg_type": "departing_plane", "plane": plane.to_dict()}
             )
             self.log(f"Plane {plane.plane_id} has been assigned to gate {gate_number}")
             self.gates[gate_number] = GateState.IN_USE_DEPARTING.value
@@ -149,15 +196,13 @@ class Airport(AirportComponent):
         """Assign a gate for an arriving plane."""
         if len(self.waiting_for_arrival_gate) > 0:
             runway_topic = self.waiting_for_arrival_gate.pop(0)
-            self.client.publish(
+            self.publish(
                 runway_topic,
-                json.dumps(
-                    {
-                        "msg_type": "arrival_gate_assigned",
-                        "gate_number": gate_number,
-                        "gate_topic": f"airport/{self.airport}/gate/{gate_number}",
-                    }
-                ),
+                {
+                    "msg_type": "arrival_gate_assigned",
+                    "gate_number": gate_number,
+                    "gate_topic": f"airport/{self.airport}/gate/{gate_number}",
+                },
             )
             self.gates[gate_number] = GateState.IN_USE_ARRIVING.value
             return True
@@ -167,33 +212,30 @@ class Airport(AirportComponent):
         """Assign a runway to a plane waiting at a departure gate"""
         if len(self.waiting_for_departure_runway) > 0:
             gate_topic = self.waiting_for_departure_runway.pop(0)
-            self.client.publish(
+            self.publish(
                 gate_topic,
-                json.dumps(
-                    {
-                        "msg_type": "departure_runway_assigned",
-                        "runway_number": runway_number,
-                        "runway_topic": f"airport/{self.airport}/runway/{runway_number}",
-                    }
-                ),
+                {
+                    "msg_type": "departure_runway_assigned",
+                    "runway_number": runway_number,
+                    "runway_topic": f"airport/{self.airport}/runway/{runway_number}",
+                },
             )
             self.runways[runway_number] = RunwayState.IN_USE_DEPARTING.value
             return True
         return False
 
-    def assign_runway_for_arrival(self, runway_number: str):
-        """Assign a runway to a plane circling in the sky"""
-        self.client.publish(
-            "sky",
-            json.dumps(
-                {
-                    "msg_type": "land_next_plane",
-                    "airport": self.airport,
-                    "runway_number": runway_number,
-                }
-            ),
+    def assign_runways_for_arrival(self, runway_numbers: List[str]):
+        """Ask Sky to land circling planes on these runways"""
+        self.publish(
+            self.sky_topic,
+            {
+                "msg_type": "land_planes",
+                "airport": self.airport,
+                "runway_numbers": runway_numbers,
+            },
         )
-        # if there are no planes ready to land, the runway state won't change
+        # don't ask again for the same planes; Sky announces the new count
+        self.arrivals_waiting -= len(runway_numbers)
 
     def handle_heartbeat(self):
         """Handle heartbeat messages to update gate state."""
@@ -201,88 +243,140 @@ class Airport(AirportComponent):
             if GateState(state) == GateState.FREE:
                 # self.log(f"Gate {gate_number} is free, checking for planes.")
 
-                if random.random() < 0.5:
+                if self.rng.random() < 0.5:
                     if not self.assign_gate_for_departure(gate_number):
                         self.assign_gate_for_arrival(gate_number)
                 else:
                     if not self.assign_gate_for_arrival(gate_number):
                         self.assign_gate_for_departure(gate_number)
 
-        # assign runway
+        # assign runway; landings are only requested for planes Sky says are
+        # circling, and all in one message
+        landing_runways = []
         for runway_number, state in self.runways.items():
             if RunwayState(state) == RunwayState.FREE:
-                # self.log(f"Runway {runway_number} is free, checking for planes.")
-
-                if random.random() < 0.5:
-                    if not self.assign_runway_for_departure(runway_number):
-                        self.assign_runway_for_arrival(runway_number)
+                can_land = len(landing_runways) < self.arrivals_waiting
+                if can_land and (
+                    self.rng.random() < 0.5 or not self.waiting_for_departure_runway
+                ):
+                    landing_runways.append(runway_number)
                 else:
-                    if not self.assign_runway_for_arrival(runway_number):
-                        self.assign_runway_for_departure(runway_number)
+                    self.assign_runway_for_departure(runway_number)
+        if landing_runways:
+            self.assign_runways_for_arrival(landing_runways)
+
+        self.publish_queue_depth()
+
+    def publish_queue_depth(self):
+        """Tell the plane generator how many planes wait for a gate, if that
+        changed, and hand back the flights we deferred"""
+        depth = len(self.waiting_for_departure_gate)
+        if depth == self.announced_depth and not self.deferred:
+            return
+        self.announced_depth = depth
+        self.publish(
+            f"queues/{self.airport}",
+            {
+                "msg_type": "queue_depth",
+                "airport": self.airport,
+                "depth": depth,
+                "capacity": self.waiting_for_departure_gate.capacity,
+                "deferred": self.deferred,
+            },
+        )
+        self.deferred = []
 
-    def handle_gate_update(self, gate_number: str, gate_state: str):
+    @handles("gate_update", "gate_number", "gate_state", optional=("seq",))
+    def handle_gate_update(self, gate_number: str, gate_state: str, seq=None):
         """Handle updates to gate state."""
         self.gates[gate_number] = gate_state
+        if seq is not None:
+            self.gate_seqs[gate_number] = seq
         self.log(f"Gate {gate_number} is now {gate_state}")
 
-    def handle_runway_update(self, runway_number: str, runway_state: str):
+    @handles("runway_update", "runway_number", "runway_state", optional=("seq",))
+    def handle_runway_update(self, runway_number: str, runway_state: str, seq=None):
         """Handle updates to runway state."""
         self.runways[runway_number] = runway_state
+        if seq is not None:
+            self.runway_seqs[runway_number] = seq
         self.log(f"Runway {runway_number} is now {runway_state}")
 
+    @handles("gate_sync", "gate_number", "gate_state", "seq")
+    def handle_gate_sync(self, gate_number: str, gate_state: str, seq: int):
+        """Adopt the gate state if we missed one of its updates"""
+        if self.gate_seqs.get(gate_number) != seq:
+            self.log(f"Missed an update from gate {gate_number}, resyncing")
+            self.handle_gate_update(gate_number, gate_state, seq)
+
+    @handles("runway_sync", "runway_number", "runway_state", "seq")
+    def handle_runway_sync(self, runway_number: str, runway_state: str, seq: int):
+        """Adopt the runway state if we missed one of its updates"""
+        if self.runway_seqs.get(runway_number) != seq:
+            self.log(f"Missed an update from runway {runway_number}, resyncing")
+            self.handle_runway_update(runway_number, runway_state, seq)
+
+    @handles("new_plane", "end_airport")
     def handle_new_plane(self, end_airport: str):
         """Handle a new plane arriving at the airport hangar."""
-        plane = Plane(start_airport=self.airport, end_airport=end_airport)
+        queue = self.waiting_for_departure_gate
+        if not queue.admits():
+            queue.refuse()
+            if queue.policy == DEFER:
+                self.deferred.append(end_airport)
+                self.log(f"Departure queue full, deferred flight to {end_airport}")
+            else:
+                self.log(f"Departure queue full, rejected flight to {end_airport}")
+            return
+        plane = Plane(start_airport=self.airport, end_airport=end_airport, rng=self.rng)
+        if tracing.sampled(plane.flight_id):
+            plane.trace = tracing.start(self.ticks)
         self.log(f"Plane {plane.plane_id} will depart to {plane.end_airport}")
-        self.waiting_for_departure_gate.append(plane)
-        plane.init_flight(self.client)
+        queue.offer(plane)
+        self.locate(plane, plane.state.value)
+        plane.init_flight(self)
         plane.update_flight(
-            self.client, from_airport=plane.start_airport, to_airport=plane.end_airport
+            self, from_airport=plane.start_airport, to_airport=plane.end_airport
         )
 
-    def handle_register_runway(self, runway_number: str):
+    @handles("new_planes", "end_airports")
+    def handle_new_planes(self, end_airports: List[str]):
+        """Handle several new planes at once, one per destination"""
+        for end_airport in end_airports:
+            self.handle_new_plane(end_airport)
+
+    @handles("arrivals_waiting", "count")
+    def handle_arrivals_waiting(self, count: int):
+        """Sky tells us how many planes are circling to land here"""
+        self.arrivals_waiting = count
+
+    @handles("register_runway", "runway_number", optional=("seq",))
+    def handle_register_runway(self, runway_number: str, seq=None):
         """Register a new runway for this Airport"""
         self.runways[runway_number] = RunwayState.FREE.value
+        if seq is not None:
+            self.runway_seqs[runway_number] = seq
         self.log(f"Registered runway {runway_number}")
 
-    def handle_register_gate(self, gate_number: str):
+    @handles("register_gate", "gate_number", optional=("seq",))
+    def handle_register_gate(self, gate_number: str, seq=None):
         """Register a new gate for this Airport"""
         self.gates[gate_number] = GateState.FREE.value
+        if seq is not None:
+            self.gate_seqs[gate_number] = seq
         self.log(f"Registered gate {gate_number}")
 
-    def handle_message(self, message: dict):
-        """Handle messages sent to the airport."""
-        if message["msg_type"] == "gate_update":
-            if self.validate_message(["gate_number", "gate_state"], message):
-                self.handle_gate_update(message["gate_number"], message["gate_state"])
-
-        elif message["msg_type"] == "runway_update":
-            if self.validate_message(["runway_number", "runway_state"], message):
-                self.handle_runway_update(
-                    message["runway_number"], message["runway_state"]
-                )
-
-        elif message["msg_type"] == "new_plane":
-            if self.validate_message(["end_airport"], message):
-                self.handle_new_plane(message["end_airport"])
-
-        elif message["msg_type"] == "requesting_arrival_gate":
-            if self.validate_message(["runway_topic"], message):
-                if message["runway_topic"] not in self.waiting_for_arrival_gate:
-                    self.waiting_for_arrival_gate.append(message["runway_topic"])
-
-        elif message["msg_type"] == "requesting_departure_runway":
-            if self.validate_message(["gate"], message):
-                if message["gate"] not in self.waiting_for_departure_runway:
-                    self.waiting_for_departure_runway.append(message["gate"])
-
-        elif message["msg_type"] == "register_runway":
-            if self.validate_message(["runway_number"], message):
-                self.handle_register_runway(message["runway_number"])
-
-        elif message["msg_type"] == "register_gate":
-            if self.validate_message(["gate_number"], message):
-                self.handle_register_gate(message["gate_number"])
+    @handles("requesting_arrival_gate", "runway_topic")
+    def handle_requesting_arrival_gate(self, runway_topic: str):
+        """A runway with a landed plane needs a gate"""
+        if runway_topic not in self.waiting_for_arrival_gate:
+            self.waiting_for_arrival_gate.append(runway_topic)
+
+    @handles("requesting_departure_runway", "gate")
+    def handle_requesting_departure_runway(self, gate: str):
+        """A gate with a boarded plane needs a runway"""
+        if gate not in self.waiting_for_departure_runway:
+            self.waiting_for_departure_runway.append(gate)
 
 
 # == main
@@ -1,20 +1,65 @@
 """All components must derive from AirportComponent"""
 
-from typing import List
+from typing import Callable, Dict, List, Tuple
+import fnmatch
 import json
 import os
+import random
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 import argparse
 import paho.mqtt.client as mqtt
 
 from logger import Logger
+import codec
+import snapshot
+from sharding import event_topic
 
 MQTT_BROKER = os.environ.get("MQTT_BROKER", "localhost")
 
+# accumulate what a callback publishes and send one message per topic at its end
+BATCH_PUBLISH = os.environ.get("BATCH_PUBLISH", "0") == "1"
+
+
+def handles(msg_type: str, *required_keys: str, optional: Tuple[str, ...] = ()):
+    """Register a component method as the handler for msg_type.
+
+    The required keys are checked on every message and their values passed to
+    the method positionally, in the order given here. Optional keys that are
+    present are passed as keyword arguments."""
+
+    def register(method: Callable) -> Callable:
+        method.handles = (msg_type, required_keys, optional)
+        return method
+
+    return register
+
+
+def targets(message: dict, component_name: str) -> bool:
+    """whether an admin command is meant for the component: "target" is a
+    shell-style pattern of client names, all when it's missing"""
+    target = message.get("target", "*")
+    return isinstance(target, str) and fnmatch.fnmatchcase(component_name, target)
+
 
 class AirportComponent(ABC):
     """Interface for components in the messaging system"""
 
+    # msg_type -> (handler, required keys, optional keys), from @handles methods
+    message_handlers: Dict[str, Tuple[Callable, Tuple[str, ...], Tuple[str, ...]]] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.message_handlers = dict(cls.message_handlers)
+        for attribute in vars(cls).values():
+            if hasattr(attribute, "handles"):
+                msg_type, required_keys, optional_keys = attribute.handles
+                cls.message_handlers[msg_type] = (
+                    attribute,
+                    required_keys,
+                    optional_keys,
+                )
+
     @staticmethod
     @abstractmethod
     def args_to_dict(arguments: argparse.Namespace) -> dict:
@@ -41,16 +86,24 @@ class AirportComponent(ABC):
         msg: mqtt.MQTTMessage,
     ):
         """Handle heartbeat messages"""
+        with self.batching():
+            try:
+                ticks = int(codec.decode(msg.payload).get("ticks", 0))
+            except ValueError:
+                ticks = 0
+            self.heartbeat(ticks)
+
+    def heartbeat(self, ticks: int):
+        """Save the state, then move on to tick ticks"""
         if self.redis_client:
-            self.redis_client.set(self.redis_key, json.dumps(self.to_dict()))
-        payload = msg.payload.decode()
-        try:
-            message = json.loads(payload)
-            self.ticks = int(message.get("ticks", 0))
-        except json.decoder.JSONDecodeError:
-            self.ticks = 0
+            self.save_state(ticks)
+        self.ticks = ticks
         self.handle_heartbeat()
 
+    def save_state(self, ticks: int):  # pylint:disable=unused-argument
+        """Write the state to Redis before handling a heartbeat"""
+        self.redis_client.set(self.redis_key, snapshot.dumps(self.to_dict()))
+
     @abstractmethod
     def handle_heartbeat(self):
         """Child-specific implementations"""
@@ -60,9 +113,30 @@ class AirportComponent(ABC):
     def mqtt_topic(self) -> str:
         """MQTT topic for this object"""
 
-    @abstractmethod
     def handle_message(self, message: dict):
-        """Client-specific implementation"""
+        """Dispatch a message to the handler registered for its msg_type"""
+        entry = self.message_handlers.get(message.get("msg_type"))
+        if entry is None:
+            if "msg_type" not in message:
+                self.rejected()
+                self.error("Message does not contain 'msg_type'")
+                self.error(message)
+            return
+        handler, required_keys, optional_keys = entry
+        try:
+            arguments = [message[key] for key in required_keys]
+        except KeyError:
+            self.rejected()
+            self.validate_message(required_keys, message)  # logs what is missing
+            return
+        if optional_keys:
+            handler(
+                self,
+                *arguments,
+                **{key: message[key] for key in optional_keys if key in message},
+            )
+        else:
+            handler(self, *arguments)
 
     def on_message(
         self,
@@ -71,17 +145,91 @@ class AirportComponent(ABC):
         msg: mqtt.MQTTMessage,
     ):
         """Handler for mqtt_topic"""
-        payload = msg.payload.decode()
         try:
-            message = json.loads(payload)
-        except json.decoder.JSONDecodeError:
-            self.error(f"received non-json message: [{payload}]")
+            payload = codec.decode(msg.payload)
+        except ValueError:
+            self.rejected()
+            self.error(f"received undecodable message: [{msg.payload!r}]")
             return
-        if "msg_type" not in message:
-            self.error("Message does not contain 'msg_type'")
-            self.error(message)
+        self.accepted(msg.payload)
+        with self.batching():
+            for message in codec.unbatch(payload):
+                self.handle_message(message)
+
+    def accepted(self, payload: bytes):
+        """A message on mqtt_topic was decoded and is about to be handled"""
+
+    def rejected(self):
+        """A message couldn't be decoded or lacked keys; it was logged"""
+
+    def publish(self, topic: str, message: dict | str):
+        """Publish a message using the codec configured for the topic.
+
+        Inside a batching() block the message is held in the outbox instead."""
+        if self.outbox is not None:
+            self.outbox.setdefault(topic, []).append(message)
             return
-        self.handle_message(message)
+        self.send(topic, message)
+
+    def send(self, topic: str, message: dict | str):
+        """Publish a message now, text as it is"""
+        if isinstance(message, str):
+            self.client.publish(topic, message)
+        else:
+            self.client.publish(topic, codec.encode_for_topic(topic, message))
+
+    def publish_event(self, event: dict):
+        """Publish a plane event for the dbwriter, on its flight's partition"""
+        self.publish(event_topic(event["flight_id"]), event)
+
+    def locate(self, plane, state: str):
+        """Record where a plane is now; see locations.py"""
+
+    def forget_location(self, plane):
+        """Forget where a plane that left the simulation was; see locations.py"""
+
+    def flush_writes(self):
+        """Write what was held for Redis during a callback in one round trip,
+        if anything was"""
+        if not self.writes_held:
+            return
+        self.writes_held = False
+        if self.redis_client is None:  # e.g. on a LocalBroker without Redis
+            self.queue_writes(None)
+            return
+        pipeline = self.redis_client.pipeline(transaction=False)
+        self.queue_writes(pipeline)
+        pipeline.execute()
+
+    def queue_writes(self, pipeline):
+        """Queue the held writes on a Redis pipeline, or drop them if it is
+        None. Features that hold writes set writes_held and extend this"""
+
+    @contextmanager
+    def batching(self):
+        """Collect what is published in the block and flush it at the end as
+        one message per topic: a batch envelope, or newline separated lines
+        for text such as logs. Does nothing unless batch_publish is on, apart
+        from flushing what was held for Redis."""
+        if not self.batch_publish or self.outbox is not None:
+            try:
+                yield
+            finally:
+                self.flush_writes()
+            return
+        self.outbox = {}
+        try:
+            yield
+        finally:
+            self.flush_writes()
+            outbox, self.outbox = self.outbox, None
+            for topic, messages in outbox.items():
+                if len(messages) == 1:
+                    self.send(topic, messages[0])
+                elif all(isinstance(message, str) for message in messages):
+                    self.send(topic, "\n".join(messages))
+                else:
+                    self.send(topic, codec.batch(messages))
 
     def on_admin(
         self,
@@ -96,9 +244,28 @@ class AirportComponent(ABC):
         except json.decoder.JSONDecodeError:
             self.error(f"received non-json message: [{payload}]")
             return
+        if not isinstance(message, dict) or not isinstance(message.get("command"), str):
+            self.error(f"received admin message without a command: [{payload}]")
+            return
+        with self.batching():
+            self.handle_admin(message)
+
+    def handle_admin(self, message: dict):
+        """Act on an admin command meant for this component"""
+        if not targets(message, self.mqttclientname):
+            return
         if message["command"] == "quit":
             self.log("Received quit message, disconnecting from mqtt broker")
             self.client.disconnect()
+        else:
+            self.run_admin_command(message)
+
+    def run_admin_command(
+        self, message: dict  # pylint:disable=unused-argument
+    ) -> bool:
+        """Run any other admin command; False if no feature knows it, see
+        checkpoint.py and diagnostics.py"""
+        return False
 
     @property
     @abstractmethod
@@ -140,7 +307,7 @@ class AirportComponent(ABC):
         """callback on connection"""
         if reason_code == 0:
             self.logger = Logger(
-                self.loggername, self.client, verbose=userdata.get("verbose", False)
+                self.loggername, self, verbose=userdata.get("verbose", False)
             )
             self.client.subscribe("heartbeat")
             self.client.message_callback_add("heartbeat", self.on_heartbeat)
@@ -162,7 +329,22 @@ class AirportComponent(ABC):
         self.ticks = -1
         self.logger = None
         self.redis_client = None
-        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, self.mqttclientname)
+        self.batch_publish = kwargs.pop("batch_publish", BATCH_PUBLISH)
+        self.outbox: Dict[str, list] | None = None
+        self.writes_held = False  # see flush_writes
+        # all randomness of a component comes from here; a seed makes runs
+        # reproducible whatever else shares the process
+        seed = kwargs.pop("seed", None)
+        self.rng = random.Random(
+            None if seed is None else f"{seed}:{self.mqttclientname}"
+        )
+        broker = kwargs.pop("broker", None)
+        if broker:
+            self.client = broker.client(self.mqttclientname)
+        else:
+            self.client = mqtt.Client(
+                mqtt.CallbackAPIVersion.VERSION2, self.mqttclientname
+            )
         self.client.user_data_set(kwargs)
         self.client.on_connect = self.on_connect
         self.client.connect(MQTT_BROKER)
@@ -0,0 +1 @@
+"""Benchmarks for the simulator; run from simulator/ with `python -m benchmarks.<name>`"""
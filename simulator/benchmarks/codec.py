@@ -0,0 +1,53 @@
+"""Bytes per message and encode/decode time for the wire codecs"""
+
+import argparse
+import timeit
+
+import codec
+from plane import Plane, PlaneState
+
+
+def sample_messages() -> dict:
+    """Representative payloads, keyed by msg_type"""
+    plane = Plane("JFK", "LAX")
+    plane.start_gate = "12"
+    plane.state = PlaneState.AT_DEPARTURE_GATE
+    return {
+        "departing_plane": {"msg_type": "departing_plane", "plane": plane.to_dict()},
+        "plane_arrival": {"msg_type": "plane_arrival", "plane": plane.to_dict()},
+        "gate_update": {
+            "msg_type": "gate_update",
+            "gate_number": "12",
+            "gate_state": "in-use-departing",
+        },
+    }
+
+
+def main():
+    """main"""
+    parser = argparse.ArgumentParser(description="Wire codec benchmark")
+    parser.add_argument("--number", type=int, default=100000)
+    args = parser.parse_args()
+
+    print(f"{'message':<18}{'codec':<8}{'bytes':>7}{'encode us':>12}{'decode us':>12}")
+    for msg_type, message in sample_messages().items():
+        for name in (codec.JSON, codec.BINARY):
+            payload = codec.encode(message, name)
+            if isinstance(payload, str):
+                payload = payload.encode()
+            assert codec.decode(payload) == message
+            encode_time = timeit.timeit(
+                lambda m=message, n=name: codec.encode(m, n), number=args.number
+            )
+            decode_time = timeit.timeit(
+                lambda p=payload: codec.decode(p), number=args.number
+            )
+            print(
+                f"{msg_type:<18}{name:<8}{len(payload):>7}"
+                + f"{encode_time / args.number * 1e6:>12.2f}"
+                + f"{decode_time / args.number * 1e6:>12.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Per-message overhead of AirportComponent.on_message dispatch"""
+
+import argparse
+import json
+import timeit
+
+from airport import Airport
+from localbroker import LocalBroker, LocalMessage
+from runway import Runway
+
+
+def main():
+    """main"""
+    parser = argparse.ArgumentParser(description="Message dispatch benchmark")
+    parser.add_argument("--number", type=int, default=50000)
+    args = parser.parse_args()
+
+    broker = LocalBroker()
+    airport = Airport("JFK", ["1"], [str(gate) for gate in range(10)], broker=broker)
+    runway = Runway("JFK", "1", broker=broker)
+    broker.run()
+
+    cases = {
+        "gate_update": (
+            airport,
+            {"msg_type": "gate_update", "gate_number": "3", "gate_state": "free"},
+        ),
+        "requesting_departure_runway": (
+            airport,
+            {"msg_type": "requesting_departure_runway", "gate": "airport/JFK/gate/3"},
+        ),
+        "unknown msg_type": (airport, {"msg_type": "no_such_message"}),
+        "missing key": (airport, {"msg_type": "gate_update", "gate_number": "3"}),
+        "runway_update": (
+            airport,
+            {"msg_type": "runway_update", "runway_number": "1", "runway_state": "free"},
+        ),
+        "arrival_gate_assigned": (
+            runway,
+            {
+                "msg_type": "arrival_gate_assigned",
+                "gate_topic": "airport/JFK/gate/3",
+                "gate_number": "3",
+            },
+        ),
+    }
+    print(f"{'message':<30}{'on_message us':>14}{'handle_message us':>19}")
+    for name, (component, message) in cases.items():
+        msg = LocalMessage(component.mqtt_topic, json.dumps(message).encode())
+        timings = []
+        for func in (
+            lambda c=component, m=msg: c.on_message(c.client, None, m),
+            lambda c=component, m=message: c.handle_message(m),
+        ):
+            seconds = min(timeit.repeat(func, number=args.number, repeat=3))
+            timings.append(seconds / args.number * 1e6)
+            broker.queue.clear()
+        print(f"{name:<30}{timings[0]:>14.2f}{timings[1]:>19.2f}")
+
+    for name, component in (("Airport", airport), ("Runway", runway)):
+        for attribute in ("mqtt_topic", "redis_key"):
+            seconds = min(
+                timeit.repeat(
+                    lambda c=component, a=attribute: getattr(c, a),
+                    number=args.number * 10,
+                    repeat=3,
+                )
+            )
+            print(
+                f"{name + '.' + attribute:<30}"
+                + f"{seconds / (args.number * 10) * 1e6:>8.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""Time and allocations per call of what runs on every message or tick
+
+Covers Plane.to_dict/from_dict, json dumps/loads of typical payloads,
+AirportComponent.on_message and validate_message, Airport.handle_heartbeat
+by number of gates, and Sky.handle_heartbeat and Sky.to_dict by number of
+planes. Components run on a LocalBroker, so neither a broker nor Redis is
+needed. Operations that change the component's state are timed one call at
+a time on a freshly built component, the best of --repeat; allocations are
+the blocks and bytes still allocated after the call (see benchmarks.plane),
+including the messages it queued on the broker.
+
+    python -m benchmarks.micro --gates 10 100 1000 --planes 1000 100000
+"""
+
+import argparse
+import json
+import time
+import timeit
+from typing import Callable, Optional
+
+from airport import Airport
+from benchmarks.codec import sample_messages
+from benchmarks.plane import allocations_per_call
+from benchmarks.snapshot import sky_state
+from localbroker import LocalBroker, LocalMessage
+from plane import Plane
+from sky import Sky
+
+
+def fresh_airport(gates: int) -> Airport:
+    """an airport with all gates free, and planes and runways waiting for them"""
+    broker = LocalBroker()
+    airport = Airport(
+        "JFK",
+        [str(runway) for runway in range(max(2, gates // 10))],
+        [str(gate) for gate in range(gates)],
+        broker=broker,
+        seed=1,
+    )
+    broker.run()
+    airport.ticks = 1
+    for index in range(gates // 2):
+        airport.waiting_for_departure_gate.offer(Plane("JFK", "LAX", rng=airport.rng))
+        airport.waiting_for_departure_runway.append(f"airport/JFK/gate/{index}")
+    airport.waiting_for_arrival_gate = [
+        f"airport/JFK/runway/{index % 2}" for index in range(gates // 4)
+    ]
+    airport.arrivals_waiting = gates // 4
+    return airport
+
+
+def fresh_sky(planes: int) -> Sky:
+    """a Sky with half its planes flying and half circling over 50 airports"""
+    broker = LocalBroker()
+    sky = Sky.from_dict(sky_state(planes, 50), broker=broker, seed=1)
+    broker.run()
+    sky.ticks = 1
+    return sky
+
+
+def measure(
+    name: str,
+    func: Callable,
+    number: int,
+    repeat: int,
+    setup: Optional[Callable] = None,
+):
+    """print time and allocations per call of func, or of func(setup()) on
+    a fresh setup() per call"""
+    if setup is None:
+        seconds = min(timeit.repeat(func, number=number, repeat=repeat)) / number
+        blocks, size = allocations_per_call(func, number)
+    else:
+        timings = []
+        for _ in range(repeat):
+            subject = setup()
+            start = time.perf_counter()
+            func(subject)
+            timings.append(time.perf_counter() - start)
+        seconds = min(timings)
+        subject = setup()
+        blocks, size = allocations_per_call(lambda: func(subject), 1)
+    print(f"{name:<40}{seconds * 1e6:>12.2f}{blocks:>12.1f}{size:>12.0f}")
+
+
+def main():
+    """main"""
+    parser = argparse.ArgumentParser(description="Hot path microbenchmarks")
+    parser.add_argument("--number", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--gates", type=int, nargs="+", default=[10, 100, 1000], help="per airport"
+    )
+    parser.add_argument(
+        "--planes", type=int, nargs="+", default=[1000, 100000], help="in Sky"
+    )
+    args = parser.parse_args()
+    number, repeat = args.number, args.repeat
+
+    print(f"{'operation':<40}{'us/op':>12}{'blocks/op':>12}{'bytes/op':>12}")
+
+    messages = sample_messages()
+    messages["heartbeat"] = {"ticks": 1234}
+    plane_data = messages["departing_plane"]["plane"]
+    plane = Plane.from_dict(plane_data)
+    measure("Plane.to_dict", plane.to_dict, number, repeat)
+    measure("Plane.from_dict", lambda: Plane.from_dict(plane_data), number, repeat)
+    for msg_type, message in messages.items():
+        text = json.dumps(message)
+        measure(
+            f"json.dumps {msg_type}", lambda m=message: json.dumps(m), number, repeat
+        )
+        measure(f"json.loads {msg_type}", lambda t=text: json.loads(t), number, repeat)
+
+    airport = fresh_airport(10)
+    gate_update = messages["gate_update"]
+    msg = LocalMessage(airport.mqtt_topic, json.dumps(gate_update).encode())
+    measure(
+        "on_message gate_update",
+        lambda: airport.on_message(airport.client, None, msg),
+        number,
+        repeat,
+    )
+    required_keys = ["gate_number", "gate_state"]
+    measure(
+        "validate_message gate_update",
+        lambda: airport.validate_message(required_keys, gate_update),
+        number,
+        repeat,
+    )
+
+    for gates in args.gates:
+        measure(
+            f"Airport.handle_heartbeat {gates} gates",
+            Airport.handle_heartbeat,
+            number,
+            repeat,
+            setup=lambda g=gates: fresh_airport(g),
+        )
+
+    for planes in args.planes:
+        measure(
+            f"Sky.handle_heartbeat {planes} planes",
+            Sky.handle_heartbeat,
+            number,
+            repeat,
+            setup=lambda p=planes: fresh_sky(p),
+        )
+        sky = fresh_sky(planes)
+        measure(
+            f"Sky.to_dict {planes} planes",
+            sky.to_dict,
+            max(1, number // planes),
+            repeat,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""CPU time and allocations of one plane hop: from_dict, a state change, to_dict"""
+
+import argparse
+import gc
+import timeit
+import tracemalloc
+
+from plane import Plane, PlaneState
+
+
+def hop(data: dict) -> dict:
+    """What a component does with a plane it receives and passes on"""
+    plane = Plane.from_dict(data)
+    plane.state = PlaneState.ON_DEPARTURE_RUNWAY
+    return plane.to_dict()
+
+
+def allocations_per_call(func, number: int) -> tuple[float, float]:
+    """(blocks, bytes) allocated per call, measured with tracemalloc"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    keep = [func() for _ in range(number)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, "filename")
+    blocks = sum(stat.count_diff for stat in stats)
+    size = sum(stat.size_diff for stat in stats)
+    del keep
+    return blocks / number, size / number
+
+
+def main():
+    """main"""
+    parser = argparse.ArgumentParser(description="Plane (de)serialization benchmark")
+    parser.add_argument("--number", type=int, default=200000)
+    args = parser.parse_args()
+
+    plane = Plane("JFK", "LAX")
+    plane.start_gate = "12"
+    data = plane.to_dict()
+
+    cases = {
+        "Plane()": lambda: Plane("JFK", "LAX"),
+        "from_dict": lambda: Plane.from_dict(data),
+        "to_dict": plane.to_dict,
+        "hop": lambda: hop(data),
+    }
+    print(f"{'operation':<12}{'us/op':>8}{'blocks/op':>11}{'bytes/op':>10}")
+    for name, func in cases.items():
+        seconds = min(timeit.repeat(func, number=args.number, repeat=3))
+        blocks, size = allocations_per_call(func, 10000)
+        print(
+            f"{name:<12}{seconds / args.number * 1e6:>8.2f}"
+            + f"{blocks:>11.1f}{size:>10.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Size and dumps/loads time of Redis state snapshots"""
+
+import argparse
+import json
+import timeit
+
+import snapshot
+from plane import Plane, PlaneState
+
+
+def sky_state(planes: int, airports: int) -> dict:
+    """A Sky.to_dict() with the given number of airborne and circling planes"""
+    names = [f"A{index:03}" for index in range(airports)]
+    flying = []
+    queues = {name: [] for name in names}
+    for index in range(planes):
+        plane = Plane(names[index % airports], names[(index + 1) % airports])
+        plane.start_gate = str(index % 40)
+        if index % 2:
+            plane.state = PlaneState.IN_SKY
+            plane.ticks_in_sky = index % 10
+            flying.append(plane.to_dict())
+        else:
+            plane.state = PlaneState.CIRCLING
+            queues[plane.end_airport].append(plane.to_dict())
+    return {"plane_queues": queues, "planes_flying": flying}
+
+
+def main():
+    """main"""
+    parser = argparse.ArgumentParser(description="State snapshot benchmark")
+    parser.add_argument("--planes", type=int, default=5000)
+    parser.add_argument("--airports", type=int, default=50)
+    parser.add_argument("--number", type=int, default=20)
+    args = parser.parse_args()
+
+    state = sky_state(args.planes, args.airports)
+    variants = [("json", "none")] + [
+        ("binary", compression)
+        for compression in snapshot.COMPRESSIONS
+        if compression == "none"
+        or compression == "zlib"
+        or (compression == "zstd" and snapshot.zstandard)
+        or (compression == "lz4" and snapshot.lz4)
+    ]
+    print(f"sky with {args.planes} planes")
+    print(
+        f"{'format':<8}{'compression':<13}{'bytes':>10}{'dumps ms':>10}{'loads ms':>10}"
+    )
+    for snapshot_format, compression in variants:
+        raw = snapshot.dumps(state, snapshot_format, compression)
+        if isinstance(raw, str):
+            raw = raw.encode()
+        assert snapshot.loads(raw) == json.loads(json.dumps(state))
+        dumps_time = timeit.timeit(
+            lambda f=snapshot_format, c=compression: snapshot.dumps(state, f, c),
+            number=args.number,
+        )
+        loads_time = timeit.timeit(lambda r=raw: snapshot.loads(r), number=args.number)
+        print(
+            f"{snapshot_format:<8}{compression:<13}{len(raw):>10}"
+            + f"{dumps_time / args.number * 1e3:>10.2f}"
+            + f"{loads_time / args.number * 1e3:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+"""End-to-end throughput of headless worlds, compared against a baseline
+
+Every combination of the sizes given is one case: world.py's headless world
+of N airports with M gates and R runways each, new planes at the given
+rate, seeded. Each case runs in a fresh process, --repeat times, and the
+fastest run is kept. A case reports
+
+- ticks/s and messages/s, in total and per topic pattern
+- p50/p99 latency of every handler, heartbeat and snapshot by component
+  class (the upper bound of the metrics.BUCKETS bucket they fall in)
+- the bytes the snapshots and the plane location index would write to
+  Redis per tick, by component class
+- the peak RSS of each process (one process without --workers)
+
+The latency probes stay on in timed runs so that runs compare like with
+like. Results are written as JSON; with --baseline a stored result file is
+compared case by case (ticks/s, mean handler latencies, Redis bytes and
+peak RSS), regressions beyond --tolerance are listed and the exit status is
+1:
+
+    python -m benchmarks.throughput --airports 4 16 --output baseline.json
+    python -m benchmarks.throughput --airports 4 16 --baseline baseline.json
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import platform
+import sys
+from collections import defaultdict
+from typing import Dict, List
+
+from metrics import Histogram
+from world import run_world
+
+# topic segments that are followed by an airport, gate, runway or partition
+NAMED = {"airport", "gate", "runway", "queues", "events", "sky"}
+
+# a handler's latency is only compared when it handled this many messages; its
+# mean is compared, as the bucketed percentiles move in steps of 2 to 2.5x
+MIN_COMPARED = 100
+
+
+def topic_pattern(topic: str) -> str:
+    """the topic with names and numbers replaced by +, e.g. airport/+/gate/+"""
+    parts = topic.split("/")
+    return "/".join(
+        "+" if index and parts[index - 1] in NAMED else part
+        for index, part in enumerate(parts)
+    )
+
+
+def histogram_summary(data: dict) -> dict:
+    """count, mean, p50 and p99 of a histogram exported by world.Probes"""
+    histogram = Histogram()
+    histogram.counts = data["counts"]
+    histogram.count = sum(data["counts"])
+    histogram.sum = data["sum"]
+    return {
+        "count": histogram.count,
+        "mean": histogram.sum / histogram.count if histogram.count else 0.0,
+        "p50": histogram.quantile(0.5),
+        "p99": histogram.quantile(0.99),
+    }
+
+
+def run_case(params: dict, ticks: int, workers: int) -> dict:
+    """run one world and summarise it"""
+    options = {
+        "airports": [f"A{index:04d}" for index in range(params["airports"])],
+        "gates": params["gates"],
+        "runways": params["runways"],
+        "seed": params["seed"],
+        "new_plane_prob": params["prob"],
+        "batch_publish": params["batch_publish"],
+        "probes": True,
+    }
+    results, elapsed = run_world(options, ticks, workers)
+    per_topic: Dict[str, int] = defaultdict(int)
+    for topic, count in results["published"].items():
+        per_topic[topic_pattern(topic)] += count
+    return {
+        "params": params,
+        "ticks": ticks,
+        "seconds": elapsed,
+        "ticks_per_second": ticks / elapsed,
+        "messages_per_second": sum(per_topic.values()) / elapsed,
+        "topics_per_second": {
+            topic: count / elapsed for topic, count in sorted(per_topic.items())
+        },
+        "handlers": {
+            name: histogram_summary(histogram)
+            for name, histogram in sorted(results["histograms"].items())
+            if sum(histogram["counts"])
+        },
+        "redis_bytes_per_tick": {
+            kind: size / ticks for kind, size in sorted(results["redis_bytes"].items())
+        },
+        "redis_writes_per_tick": sum(results["redis_writes"].values()) / ticks,
+        "peak_rss_kib": results["peak_rss_kib"],
+        "events": results["events"],
+        "digest": results["digest"],
+    }
+
+
+def _case_process(connection, params: dict, ticks: int, workers: int):
+    """run a case in a fresh process, so its peak RSS is its own"""
+    connection.send(run_case(params, ticks, workers))
+
+
+def best_of(params: dict, ticks: int, workers: int, repeat: int) -> dict:
+    """the fastest of repeat runs of a case"""
+    best = None
+    for _ in range(repeat):
+        parent, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target=_case_process, args=(child, params, ticks, workers)
+        )
+        process.start()
+        result = parent.recv()
+        process.join()
+        if best is None or result["seconds"] < best["seconds"]:
+            best = result
+    return best
+
+
+def case_name(params: dict) -> str:
+    """a stable name for a case, the key in result files"""
+    name = (
+        f"{params['airports']}x{params['gates']}g{params['runways']}r"
+        + f"@{params['prob']}/seed{params['seed']}"
+    )
+    return name + "/batch" if params["batch_publish"] else name
+
+
+def compare(baseline: dict, current: dict, tolerance: float) -> List[str]:
+    """regressions of current against baseline, as lines of text"""
+    regressions = []
+    for name, case in current["cases"].items():
+        old = baseline["cases"].get(name)
+        if old is None:
+            print(f"{name}: not in the baseline")
+            continue
+        if old["ticks"] != case["ticks"]:
+            print(f"{name}: baseline ran {old['ticks']} ticks, not compared")
+            continue
+        if old["digest"] != case["digest"]:
+            print(f"{name}: the simulation's results differ from the baseline's")
+
+        ratio = case["ticks_per_second"] / old["ticks_per_second"]
+        print(
+            f"{name}: {case['ticks_per_second']:.1f} ticks/s, "
+            + f"{ratio - 1:+.1%} on {old['ticks_per_second']:.1f}"
+        )
+        if ratio < 1 - tolerance:
+            regressions.append(f"{name}: ticks/s {ratio - 1:+.1%}")
+
+        for handler, summary in case["handlers"].items():
+            before = old["handlers"].get(handler)
+            if (
+                before
+                and min(before["count"], summary["count"]) >= MIN_COMPARED
+                and summary["mean"] > before["mean"] * (1 + tolerance)
+            ):
+                regressions.append(
+                    f"{name}: {handler} mean {before['mean'] * 1e6:.1f}us -> "
+                    + f"{summary['mean'] * 1e6:.1f}us"
+                )
+
+        for label, key in (
+            ("Redis bytes/tick", "redis_bytes_per_tick"),
+            ("peak RSS KiB", "peak_rss_kib"),
+        ):
+            values = case[key].values() if isinstance(case[key], dict) else case[key]
+            before = old[key].values() if isinstance(old[key], dict) else old[key]
+            total, old_total = sum(values), sum(before)
+            if old_total and total > old_total * (1 + tolerance):
+                regressions.append(
+                    f"{name}: {label} {old_total:.0f} -> {total:.0f}"
+                    + f" ({total / old_total - 1:+.1%})"
+                )
+    return regressions
+
+
+def report(name: str, case: dict):
+    """print a case"""
+    print(
+        f"{name}: {case['ticks_per_second']:.1f} ticks/s, "
+        + f"{case['messages_per_second']:.0f} messages/s, "
+        + f"{sum(case['redis_bytes_per_tick'].values()):.0f} Redis bytes/tick, "
+        + f"peak RSS {max(case['peak_rss_kib']) / 1024:.1f} MiB"
+    )
+    for topic, rate in case["topics_per_second"].items():
+        print(f"    {topic:<28}{rate:>10.0f}/s")
+    print(f"    {'handler':<44}{'count':>9}{'p50 us':>9}{'p99 us':>9}")
+    for handler, summary in case["handlers"].items():
+        print(
+            f"    {handler:<44}{summary['count']:>9}"
+            + f"{summary['p50'] * 1e6:>9.0f}{summary['p99'] * 1e6:>9.0f}"
+        )
+
+
+def main():
+    """main"""
+    parser = argparse.ArgumentParser(description="Headless world throughput")
+    parser.add_argument("--airports", type=int, nargs="+", default=[4, 16])
+    parser.add_argument(
+        "--gates", type=int, nargs="+", default=[4], help="gates per airport"
+    )
+    parser.add_argument(
+        "--runways", type=int, nargs="+", default=[2], help="runways per airport"
+    )
+    parser.add_argument(
+        "--prob",
+        type=float,
+        nargs="+",
+        default=[0.3],
+        help="probability that an airport gets a new plane on a tick",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--ticks", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="worker processes per world; 0 runs a world in one process",
+    )
+    parser.add_argument("--batch-publish", action="store_true")
+    parser.add_argument("--output", help="JSON file for the results")
+    parser.add_argument("--baseline", help="JSON results to compare with")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="relative change that counts as a regression",
+    )
+    args = parser.parse_args()
+
+    results = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "workers": args.workers,
+        "cases": {},
+    }
+    for airports, gates, runways, prob in itertools.product(
+        args.airports, args.gates, args.runways, args.prob
+    ):
+        params = {
+            "airports": airports,
+            "gates": gates,
+            "runways": runways,
+            "prob": prob,
+            "seed": args.seed,
+            "batch_publish": args.batch_publish,
+        }
+        name = case_name(params)
+        results["cases"][name] = best_of(params, args.ticks, args.workers, args.repeat)
+        report(name, results["cases"][name])
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(results, output, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(baseline, results, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regressions beyond {args.tolerance:.0%}:")
+            for regression in regressions:
+                print(f"    {regression}")
+            sys.exit(1)
+        print("no regressions")
+
+
+if __name__ == "__main__":
+    main()
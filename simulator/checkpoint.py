@@ -0,0 +1,313 @@
+"""Consistent checkpoints of the whole world, taken between two ticks
+
+heartbeat.py --checkpoint-every N stops the clock after every Nth tick and
+asks all components, on the admin topic, how many messages they've handled.
+Once the counts stay the same over a quiet period nothing is in flight
+anymore, so no plane can be in two components or in none. Every component
+then replies with its state, which is written with the plane location index
+to one file. With nothing in flight, the states form one consistent cut of
+the world, all at the same tick.
+
+A checkpoint file is a fixed header, the values one after the other and an
+index at the end:
+
+    header  MAGIC, tick, index offset, index length (little endian u64s)
+    values  component states as snapshot.dumps writes them, then the
+            location index as one msgpack map
+    index   msgpack [[redis_key, kind, offset, length], ...], kind "string"
+            or "hash"
+
+The file is read through mmap and the values are handed to Redis without
+copying, so restoring writes every key in a few large pipelines. Only the
+last --keep checkpoints are kept.
+
+    python heartbeat.py 1 --checkpoint-every 100 --checkpoints checkpoints/
+    python checkpoint.py list checkpoints/
+    python checkpoint.py restore checkpoints/
+    python heartbeat.py 1 --start-tick <the tick restore printed>
+"""
+
+import argparse
+import glob
+import json
+import mmap
+import os
+import struct
+import time
+from typing import Callable, Dict, List, Optional
+
+import msgpack
+from redis import Redis
+
+import snapshot
+from inputlog import log_key
+from locations import LOCATIONS_KEY
+
+REDIS_BROKER = os.environ.get("REDIS_BROKER", "localhost")
+
+MAGIC = b"\x00ACKPT\x01\x00"
+HEADER = struct.Struct("<8sQQQ")
+
+REPLY_TOPIC = "checkpoint/reply"
+RESTORE_CHUNK = 1000  # keys per MSET
+
+
+def run_command(component, message: dict) -> bool:
+    """Answer a checkpoint command on the admin topic; False if the command
+    isn't one"""
+    command = message["command"]
+    reply = {
+        "component": component.mqttclientname,
+        "handled": component.handled,
+        "ticks": component.ticks,
+    }
+    if command == "checkpoint_count":
+        payload = json.dumps(reply)
+    elif command == "checkpoint_dump":
+        reply["redis_key"] = component.redis_key
+        reply["state"] = snapshot.dumps(component.to_dict(), "binary")
+        payload = msgpack.packb(reply)
+    else:
+        return False
+    # straight to the client: the reply isn't a message the codecs know
+    component.client.publish(message.get("reply_to", REPLY_TOPIC), payload)
+    return True
+
+
+class Checkpointed:
+    """Component mixin counting the messages handled and answering the
+    checkpoint commands"""
+
+    def __init__(self, **kwargs):
+        self.handled = 0  # messages received on mqtt_topic
+        super().__init__(**kwargs)
+
+    def accepted(self, payload: bytes):
+        """count a message about to be handled"""
+        self.handled += 1
+        super().accepted(payload)
+
+    def run_admin_command(self, message: dict) -> bool:
+        """a checkpoint command, or one of another feature"""
+        return run_command(self, message) or super().run_admin_command(message)
+
+
+def checkpoint_path(directory: str, tick: int) -> str:
+    """file of the checkpoint at tick"""
+    return os.path.join(directory, f"checkpoint-{tick:010d}.ckpt")
+
+
+def checkpoint_files(directory: str) -> List[str]:
+    """the checkpoints in a directory, oldest first"""
+    return sorted(glob.glob(os.path.join(directory, "checkpoint-*.ckpt")))
+
+
+def write_checkpoint(path: str, tick: int, states: Dict[str, bytes], index: dict):
+    """write component states (Redis key -> snapshot) and the plane location
+    index to a checkpoint file, atomically"""
+    entries = []
+    with open(path + ".tmp", "wb") as output:
+        output.write(HEADER.pack(MAGIC, tick, 0, 0))
+        offset = HEADER.size
+        values = [(key, "string", value) for key, value in sorted(states.items())]
+        values.append((LOCATIONS_KEY, "hash", msgpack.packb(index)))
+        for key, kind, value in values:
+            output.write(value)
+            entries.append([key, kind, offset, len(value)])
+            offset += len(value)
+        packed = msgpack.packb(entries)
+        output.write(packed)
+        output.seek(0)
+        output.write(HEADER.pack(MAGIC, tick, offset, len(packed)))
+        output.flush()
+        os.fsync(output.fileno())
+    os.replace(path + ".tmp", path)
+
+
+class CheckpointFile:
+    """A checkpoint read through mmap"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as source:
+            self.map = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.tick, offset, length = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a checkpoint")
+        self.entries = msgpack.unpackb(self.map[offset : offset + length])
+
+    def value(self, offset: int, length: int) -> memoryview:
+        """the bytes of a value, without copying"""
+        return memoryview(self.map)[offset : offset + length]
+
+    def states(self) -> Dict[str, dict]:
+        """Redis key -> component state"""
+        return {
+            key: snapshot.loads(bytes(self.value(offset, length)))
+            for key, kind, offset, length in self.entries
+            if kind == "string"
+        }
+
+    def restore(self, redis_client: Redis) -> int:
+        """write every key to Redis, replacing the location index and
+        dropping the components' input logs; returns the number of keys
+        written"""
+        pipeline = redis_client.pipeline(transaction=False)
+        chunk = {}
+        for key, kind, offset, length in self.entries:
+            if kind == "hash":
+                pipeline.delete(key)
+                index = msgpack.unpackb(self.value(offset, length))
+                if index:
+                    pipeline.hset(key, mapping=index)
+                continue
+            chunk[key] = self.value(offset, length)
+            if len(chunk) == RESTORE_CHUNK:
+                pipeline.mset(chunk)
+                pipeline.delete(*map(log_key, chunk))
+                chunk = {}
+        if chunk:
+            pipeline.mset(chunk)
+            pipeline.delete(*map(log_key, chunk))
+        pipeline.execute()
+        return len(self.entries)
+
+
+class Checkpointer:
+    """Takes checkpoints for the heartbeat, over an MQTT client that is
+    looping; wait(seconds) lets replies arrive"""
+
+    def __init__(self, client, directory: str, **kwargs):
+        self.client = client
+        self.directory = directory
+        self.keep: int = kwargs.get("keep", 5)  # 0 keeps all
+        self.quiet: float = kwargs.get("quiet", 0.5)
+        self.timeout: float = kwargs.get("timeout", 60.0)
+        self.redis_client: Optional[Redis] = kwargs.get("redis_client")
+        self.wait: Callable[[float], None] = kwargs.get("wait", time.sleep)
+        self.replies: List[bytes] = []
+        os.makedirs(directory, exist_ok=True)
+        client.subscribe(REPLY_TOPIC)
+        client.message_callback_add(REPLY_TOPIC, self.on_reply)
+
+    def on_reply(
+        self,
+        mqtt_client,  # pylint:disable=unused-argument
+        userdata,  # pylint:disable=unused-argument
+        msg,
+    ):
+        """a component's reply to a command"""
+        self.replies.append(msg.payload)
+
+    def gather(self, command: str) -> List[bytes]:
+        """send a command to all components and collect replies until none
+        came for a quiet period"""
+        self.replies = []
+        self.client.publish(
+            "admin", json.dumps({"command": command, "reply_to": REPLY_TOPIC})
+        )
+        deadline = time.monotonic() + self.timeout
+        seen = -1
+        while len(self.replies) != seen and time.monotonic() < deadline:
+            seen = len(self.replies)
+            self.wait(self.quiet)
+        replies, self.replies = self.replies, []
+        return replies
+
+    def counts(self) -> Dict[str, list]:
+        """component -> [messages handled, ticks]"""
+        counts = {}
+        for payload in self.gather("checkpoint_count"):
+            reply = json.loads(payload)
+            counts[reply["component"]] = [reply["handled"], reply["ticks"]]
+        return counts
+
+    def take(self, tick: int, attempts: int = 10) -> Optional[str]:
+        """checkpoint the world after tick; the clock must be stopped.
+        Returns the file written, or None if the world didn't settle"""
+        start = time.perf_counter()
+        counts = self.counts()
+        for _ in range(attempts):
+            settled = self.counts()
+            if settled != counts or not settled:
+                counts = settled
+                continue
+            replies = [
+                msgpack.unpackb(payload) for payload in self.gather("checkpoint_dump")
+            ]
+            dumped = {
+                reply["component"]: [reply["handled"], reply["ticks"]]
+                for reply in replies
+            }
+            if dumped != settled:
+                counts = dumped
+                continue
+            behind = [name for name, (_, ticks) in dumped.items() if ticks != tick]
+            if behind:
+                print(f"not at tick {tick}: {', '.join(sorted(behind))}")
+                return None
+            index = (
+                self.redis_client.hgetall(LOCATIONS_KEY) if self.redis_client else {}
+            )
+            path = checkpoint_path(self.directory, tick)
+            write_checkpoint(
+                path,
+                tick,
+                {reply["redis_key"]: reply["state"] for reply in replies},
+                index,
+            )
+            self.prune()
+            print(
+                f"checkpoint of {len(replies)} components at tick {tick} in "
+                + f"{time.perf_counter() - start:.2f}s: {path}"
+            )
+            return path
+        print(f"the world didn't settle after tick {tick}, no checkpoint")
+        return None
+
+    def prune(self):
+        """remove all but the last keep checkpoints"""
+        if self.keep:
+            for path in checkpoint_files(self.directory)[: -self.keep]:
+                os.remove(path)
+
+
+def latest(path: str) -> str:
+    """a checkpoint file, or the newest in a directory"""
+    if os.path.isdir(path):
+        files = checkpoint_files(path)
+        if not files:
+            raise FileNotFoundError(f"no checkpoints in {path}")
+        return files[-1]
+    return path
+
+
+def main():
+    """main"""
+    parser = argparse.ArgumentParser(description="World checkpoints")
+    parser.add_argument("action", choices=["list", "restore"])
+    parser.add_argument("path", help="checkpoint file, or directory of them")
+    args = parser.parse_args()
+
+    if args.action == "list":
+        paths = checkpoint_files(args.path) if os.path.isdir(args.path) else [args.path]
+        for path in paths:
+            checkpoint = CheckpointFile(path)
+            print(
+                f"{path}: tick {checkpoint.tick}, {len(checkpoint.entries)} keys, "
+                + f"{os.path.getsize(path) / 1024:.0f} KiB"
+            )
+        return
+
+    start = time.perf_counter()
+    checkpoint = CheckpointFile(latest(args.path))
+    written = checkpoint.restore(Redis(host=REDIS_BROKER, port=6379))
+    print(
+        f"restored {written} keys of tick {checkpoint.tick} from {checkpoint.path} "
+        + f"in {time.perf_counter() - start:.2f}s; "
+        + f"start the heartbeat with --start-tick {checkpoint.tick}"
+    )
+
+
+if __name__ == "__main__":
+    main()
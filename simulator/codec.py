@@ -0,0 +1,102 @@
+"""Wire codecs for MQTT payloads
+
+Payloads are JSON unless the topic they are published on matches one of the
+filters in MQTT_BINARY_TOPICS (comma separated, MQTT wildcards allowed), e.g.
+
+    MQTT_BINARY_TOPICS="airport/+/gate/+,airport/+/runway/+,sky"
+
+Binary payloads start with BINARY_HEADER followed by a msgpack body in which
+the "plane" of a message is sent as the positional record from plane.py. The
+header is what decode() dispatches on, so every receiver understands both
+encodings and JSON stays available for debugging with mosquitto_sub and for
+older peers.
+"""
+
+import json
+import os
+from functools import lru_cache
+
+import msgpack
+import paho.mqtt.client as mqtt
+
+from plane import plane_record, plane_from_record
+
+JSON = "json"
+BINARY = "binary"
+
+BATCH = "batch"  # msg_type of an envelope carrying several messages
+
+BINARY_HEADER = b"\x00\x01"  # JSON text never starts with a NUL byte
+
+BINARY_TOPICS = [
+    topic_filter.strip()
+    for topic_filter in os.environ.get("MQTT_BINARY_TOPICS", "").split(",")
+    if topic_filter.strip()
+]
+
+
+@lru_cache(maxsize=4096)
+def codec_for_topic(topic: str) -> str:
+    """Codec used when publishing to topic"""
+    for topic_filter in BINARY_TOPICS:
+        if mqtt.topic_matches_sub(topic_filter, topic):
+            return BINARY
+    return JSON
+
+
+def batch(messages: list) -> dict:
+    """Envelope carrying several messages published to the same topic"""
+    return {"msg_type": BATCH, BATCH: messages}
+
+
+def unbatch(message: dict) -> list:
+    """The messages carried by a decoded payload"""
+    if message.get("msg_type") == BATCH and BATCH in message:
+        return message[BATCH]
+    return [message]
+
+
+def _pack_plane(message: dict) -> dict:
+    """replace the plane of a message with its positional record"""
+    plane = message.get("plane")
+    if isinstance(plane, dict):
+        record = plane_record(plane)
+        if record is not None:
+            return dict(message, plane=record)
+    return message
+
+
+def _unpack_plane(message: dict):
+    """inverse of _pack_plane, in place"""
+    plane = message.get("plane")
+    if isinstance(plane, list):
+        message["plane"] = plane_from_record(plane)
+
+
+def encode(message: dict, codec: str = JSON) -> bytes | str:
+    """Encode a message for the wire"""
+    if codec == JSON:
+        return json.dumps(message)
+    if message.get("msg_type") == BATCH:
+        message = batch([_pack_plane(inner) for inner in message[BATCH]])
+    else:
+        message = _pack_plane(message)
+    return BINARY_HEADER + msgpack.packb(message)
+
+
+def encode_for_topic(topic: str, message: dict) -> bytes | str:
+    """Encode a message with the codec configured for topic"""
+    return encode(message, codec_for_topic(topic))
+
+
+def decode(payload: bytes) -> dict:
+    """Decode a payload in either encoding; raises ValueError if it can't"""
+    if payload[:2] != BINARY_HEADER:
+        return json.loads(payload)
+    try:
+        message = msgpack.unpackb(payload[2:])
+        for inner in unbatch(message):
+            _unpack_plane(inner)
+    except (msgpack.UnpackException, ValueError, AttributeError, IndexError) as exc:
+        raise ValueError(f"undecodable binary payload: {exc}") from exc
+    return message
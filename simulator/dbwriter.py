@@ -2,10 +2,14 @@
 
 import os
 import sys
-import argparse
+import time
 import json
+import argparse
 from datetime import datetime, timedelta
+from typing import Tuple
 import paho.mqtt.client as mqtt
+from redis import Redis
+from redis.exceptions import ResponseError
 from sqlalchemy import (
     create_engine,
     MetaData,
@@ -15,10 +19,46 @@ from sqlalchemy import (
     Integer,
     DateTime,
     update,
-    insert,
+)
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import (
+    ArgumentError,
+    CompileError,
+    DataError,
+    IntegrityError,
+    ProgrammingError,
+)
+
+import codec
+from sharding import (
+    EVENT_PARTITIONS,
+    event_streams_for_consumer,
+    event_topics_for_consumer,
 )
 
 MQTT_BROKER = os.environ.get("MQTT_BROKER", "localhost")
+REDIS_BROKER = os.environ.get("REDIS_BROKER", "localhost")
+
+# where components send plane events, see eventstreams.py
+EVENTS_TRANSPORT = os.environ.get("EVENTS_TRANSPORT", "mqtt")
+STREAM_GROUP = "dbwriter"
+# stream entries another consumer has held this long without acking are taken over
+STREAM_CLAIM_IDLE_MS = int(os.environ.get("STREAM_CLAIM_IDLE_MS", "60000"))
+# entries that can't be written are moved to <stream>:dead, capped at this length
+DEAD_LETTER_MAXLEN = 10000
+
+# what makes an event impossible to write, as opposed to the database being
+# unreachable, which stops the consumer with the entries unacknowledged
+UNWRITABLE = (
+    KeyError,
+    TypeError,
+    ValueError,
+    ArgumentError,
+    CompileError,
+    DataError,
+    IntegrityError,
+    ProgrammingError,
+)
 
 SECONDS_PER_TICKS = int(os.environ.get("SECONDS_PER_TICKS", "10"))
 
@@ -49,12 +89,12 @@ class DBWriter:
     plane_events = Table(
         "plane_events",
         metadata,
-        Column("plane_id", String),
-        Column("flight_id", String),
-        Column("ticks", Integer),
+        Column("plane_id", String, primary_key=True),
+        Column("flight_id", String, primary_key=True),
+        Column("ticks", Integer, primary_key=True),
         Column("event_time", DateTime),
-        Column("from_state", String),
-        Column("to_state", String),
+        Column("from_state", String, primary_key=True),
+        Column("to_state", String, primary_key=True),
     )
 
     def __init__(self, **kwargs):
@@ -63,19 +103,73 @@ class DBWriter:
             print("Connection to database successful")
         self.starttime = kwargs["starttime"]
         self.verbose = kwargs.get("verbose", False)
+        self.consumer_id = kwargs.get("consumer_id", 0)
+        consumers = kwargs.get("consumers", 1)
+        self.topics = event_topics_for_consumer(self.consumer_id, consumers)
+        self.streams = event_streams_for_consumer(self.consumer_id, consumers)
+        self.events_written = 0
+        # events are also appended here as JSON lines, for replay.py
+        record = kwargs.get("record")
+        self.record = (
+            open(  # pylint:disable=consider-using-with
+                record, "a", encoding="utf-8", buffering=1 << 20
+            )
+            if record
+            else None
+        )
 
-        self.mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, "dbwriter")
+        client_id = "dbwriter" if consumers == 1 else f"dbwriter-{self.consumer_id}"
+        self.consumer_name = client_id
+        self.batch_size = kwargs.get("batch_size", 1000)
+        self.transport = kwargs.get("transport", EVENTS_TRANSPORT)
+        if self.transport == "redis":
+            # events come from the streams, only heartbeats over mqtt
+            self.redis_client = Redis(host=REDIS_BROKER, port=6379)
+            self.topics = []
+        self.mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id)
         self.mqtt_client.on_connect = self.on_connect
         self.mqtt_client.connect(MQTT_BROKER)
 
     def on_connect(self, mqtt_client, userdata, connect_flags, reason_code, properties):
         """on connection to the broker"""
         if reason_code == 0:
-            self.mqtt_client.subscribe("events")
-            self.mqtt_client.message_callback_add("events", self.on_event)
+            for topic in self.topics:
+                self.mqtt_client.subscribe(topic)
+                self.mqtt_client.message_callback_add(topic, self.on_event)
+            self.mqtt_client.subscribe("heartbeat")
+            self.mqtt_client.message_callback_add("heartbeat", self.on_heartbeat)
         else:
             raise RuntimeError("failed to connect to mqtt broker")
 
+    def on_heartbeat(
+        self,
+        mqtt_client: mqtt.Client,  # pylint:disable=unused-argument
+        userdata,  # pylint:disable=unused-argument
+        msg: mqtt.MQTTMessage,
+    ):
+        """publish how far behind this consumer is.
+
+        Messages reach us in order, so a heartbeat is only seen once the events
+        received before it were written; its age is the consumer's lag. Reading
+        streams, the lag is the age of the oldest entry not acknowledged yet."""
+        try:
+            heartbeat = json.loads(msg.payload)
+        except ValueError:
+            return
+        status = {
+            "consumer_id": self.consumer_id,
+            "topics": self.topics,
+            "ticks": heartbeat.get("ticks"),
+            "events_written": self.events_written,
+        }
+        if self.transport == "redis":
+            status["streams"], status["lag_seconds"] = self.stream_lag()
+        elif "time" in heartbeat:
+            status["lag_seconds"] = round(time.time() - heartbeat["time"], 3)
+        self.mqtt_client.publish(
+            f"dbwriter/status/{self.consumer_id}", json.dumps(status), retain=True
+        )
+
     def on_event(
         self,
         mqtt_client: mqtt.Client,  # pylint:disable=unused-argument
@@ -83,16 +177,166 @@ class DBWriter:
         msg: mqtt.MQTTMessage,
     ):
         """event handler"""
-        payload = msg.payload.decode()
         try:
-            message = json.loads(payload)
-        except json.decoder.JSONDecodeError:
-            print("Error decoding message " + payload)
+            message = codec.decode(msg.payload)
+        except ValueError:
+            print(f"Error decoding message {msg.payload!r}")
             return
 
         if self.verbose:
             print(message)
 
+        # a batch envelope is written in one transaction
+        events = codec.unbatch(message)
+        self.write_events(events)
+        self.record_events(events)
+        self.events_written += len(events)
+
+    def record_events(self, events: list):
+        """append events to the --record file once they are in the database"""
+        if self.record is None:
+            return
+        self.record.writelines(json.dumps(event) + "\n" for event in events)
+        self.record.flush()
+
+    def create_stream_groups(self):
+        """create the consumer group on our streams, reading from the start"""
+        for stream in self.streams:
+            try:
+                self.redis_client.xgroup_create(
+                    stream, STREAM_GROUP, "0", mkstream=True
+                )
+            except ResponseError as exc:
+                if "BUSYGROUP" not in str(exc):  # the group exists already
+                    raise
+
+    def stream_lag(self) -> Tuple[dict, float]:
+        """entries of our streams the group has read but not acknowledged
+        (pending) and not read yet (lag), and the age in seconds of the oldest
+        of them"""
+        streams, oldest = {}, time.time()
+        for stream in self.streams:
+            try:
+                groups = self.redis_client.xinfo_groups(stream)
+            except ResponseError:  # the stream isn't there yet
+                continue
+            for group in groups:
+                if group["name"] in (STREAM_GROUP, STREAM_GROUP.encode()):
+                    break
+            else:
+                continue
+            streams[stream] = {"pending": group["pending"], "lag": group["lag"]}
+            if group["pending"]:
+                first = self.redis_client.xpending(stream, STREAM_GROUP)["min"]
+            else:
+                unread = self.redis_client.xrange(
+                    stream, min=b"(" + group["last-delivered-id"], count=1
+                )
+                first = unread[0][0] if unread else None
+            if first is not None:
+                oldest = min(oldest, int(first.split(b"-")[0]) / 1000)
+        return streams, round(time.time() - oldest, 3)
+
+    def write_stream_entries(self, stream: str, entries: list):
+        """write stream entries in one transaction, then acknowledge them.
+
+        If the transaction fails the entries are written one by one, and those
+        that can't be are acknowledged with a copy left in <stream>:dead, so
+        a bad entry doesn't stop the consumer."""
+        if not entries:
+            return
+        decoded, dead = [], []  # (entry, fields, events), (entry, fields, error)
+        for entry, fields in entries:
+            if fields is None:  # deleted by MAXLEN trimming before we read it
+                continue
+            try:
+                events = codec.unbatch(codec.decode(fields[b"event"]))
+            except (KeyError, ValueError) as error:
+                dead.append((entry, fields, error))
+            else:
+                decoded.append((entry, fields, events))
+        events = [event for _, _, batch in decoded for event in batch]
+        try:
+            self.write_events(events)
+        except UNWRITABLE:
+            events = []
+            for entry, fields, batch in decoded:
+                try:
+                    self.write_events(batch)
+                except UNWRITABLE as error:
+                    dead.append((entry, fields, error))
+                else:
+                    events.extend(batch)
+        self.record_events(events)
+        pipeline = self.redis_client.pipeline()  # a transaction
+        for entry, fields, error in dead:
+            print(f"Cannot write stream entry {entry!r} of {stream}: {error!r}")
+            pipeline.xadd(
+                f"{stream}:dead",
+                dict(fields, entry=entry, error=repr(error)),
+                maxlen=DEAD_LETTER_MAXLEN,
+                approximate=True,
+            )
+        pipeline.xack(stream, STREAM_GROUP, *[entry for entry, _ in entries])
+        pipeline.execute()
+        self.events_written += len(events)
+        if self.verbose:
+            print(f"wrote {len(events)} events from {stream}")
+
+    def claim_stream_entries(self):
+        """take over entries read but never acknowledged by a crashed consumer"""
+        for stream in self.streams:
+            start = "0-0"
+            while True:
+                start, entries, *_ = self.redis_client.xautoclaim(
+                    stream,
+                    STREAM_GROUP,
+                    self.consumer_name,
+                    STREAM_CLAIM_IDLE_MS,
+                    start_id=start,
+                    count=self.batch_size,
+                )
+                self.write_stream_entries(stream, entries)
+                if start in (b"0-0", "0-0"):
+                    break
+
+    def consume_streams(self):
+        """read events from the Redis streams in large batches forever"""
+        self.mqtt_client.loop_start()  # heartbeats, for the status
+        self.create_stream_groups()
+        # our own entries that were read but not acknowledged before a restart
+        pending = self.redis_client.xreadgroup(
+            STREAM_GROUP,
+            self.consumer_name,
+            {stream: "0" for stream in self.streams},
+        )
+        for stream, entries in pending:
+            self.write_stream_entries(stream.decode(), entries)
+        self.claim_stream_entries()
+
+        last_claim = time.monotonic()
+        while True:
+            batches = self.redis_client.xreadgroup(
+                STREAM_GROUP,
+                self.consumer_name,
+                {stream: ">" for stream in self.streams},
+                count=self.batch_size,
+                block=1000,
+            )
+            for stream, entries in batches or []:
+                self.write_stream_entries(stream.decode(), entries)
+            if time.monotonic() - last_claim > STREAM_CLAIM_IDLE_MS / 1000:
+                self.claim_stream_entries()
+                last_claim = time.monotonic()
+
+    def write_events(self, events: list):
+        """write events in one transaction"""
+        with self.engine.begin() as conn:
+            for event in events:
+                self.write_event(conn, event)
+
+    def write_event(self, conn, message: dict):
+        """write one event using an open connection"""
         # add a plane event
         if message["event_type"] == "plane-event":
             event_time = self.starttime + timedelta(
@@ -106,16 +350,15 @@ class DBWriter:
                 from_state=message["from_state"],
                 to_state=message["to_state"],
             )
-            with self.engine.begin() as conn:
-                conn.execute(insert_statement)
+            # written again when a stream entry is delivered twice
+            conn.execute(insert_statement.on_conflict_do_nothing())
 
         # start a new flight object
         elif message["event_type"] == "init-flight":
             insert_statement = insert(DBWriter.flights).values(
                 flight_id=message["flight_id"], plane_id=message["plane_id"]
             )
-            with self.engine.begin() as conn:
-                conn.execute(insert_statement)
+            conn.execute(insert_statement.on_conflict_do_nothing())
 
         # update the flight object as information comes in
         elif message["event_type"] == "update-flight":
@@ -128,15 +371,35 @@ class DBWriter:
             update_args.pop("flight_id")
             update_args.pop("plane_id")
             update_stmt = update_stmt.values(**update_args)
-
-            with self.engine.begin() as conn:
-                conn.execute(update_stmt)
+            conn.execute(update_stmt)
 
 
 def main():
     """main function"""
     parser = argparse.ArgumentParser()
     parser.add_argument("--verbose", action="store_true")
+    parser.add_argument(
+        "--consumers",
+        type=int,
+        default=1,
+        help="number of dbwriters sharing the EVENT_PARTITIONS "
+        + f"({EVENT_PARTITIONS}) event partitions",
+    )
+    parser.add_argument(
+        "--consumer-id",
+        type=int,
+        default=0,
+        help="which of the consumers this is, from 0",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000,
+        help="stream entries read per call with EVENTS_TRANSPORT=redis",
+    )
+    parser.add_argument(
+        "--record", help="also append the events to this file, for replay.py"
+    )
     parser.add_argument("starttime")
     args = parser.parse_args()
 
@@ -145,8 +408,25 @@ def main():
     except ValueError:
         print("starttime must be of the format %Y-%m-%dT%H:%M:%S")
         return
-    dbwriter = DBWriter(verbose=args.verbose, starttime=starttime)
-    dbwriter.mqtt_client.loop_forever()
+    if not 0 <= args.consumer_id < args.consumers:
+        print("--consumer-id must be between 0 and --consumers - 1")
+        return
+    if args.consumers > max(EVENT_PARTITIONS, 1):
+        print(
+            f"warning: only {EVENT_PARTITIONS} partitions for {args.consumers} consumers"
+        )
+    dbwriter = DBWriter(
+        verbose=args.verbose,
+        starttime=starttime,
+        consumer_id=args.consumer_id,
+        consumers=args.consumers,
+        batch_size=args.batch_size,
+        record=args.record,
+    )
+    if EVENTS_TRANSPORT == "redis":
+        dbwriter.consume_streams()
+    else:
+        dbwriter.mqtt_client.loop_forever()
 
 
 if __name__ == "__main__":
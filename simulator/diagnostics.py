@@ -0,0 +1,257 @@
+"""Diagnostics of running components, on commands sent to the admin topic
+
+    {"command": "profile_start", "target": "Sky*", "interval": 0.005}
+    {"command": "profile_stop", "target": "Sky*", "output": "{component}.json"}
+    {"command": "memory", "target": "Airport_JFK", "top": 20}
+    {"command": "queue_counts"}
+
+"target" is a shell-style pattern matched against the component's client
+name (all components when it's missing). Results are published on
+"reply_to" (default admin/reply). With DIAGNOSTICS_DIR set they can instead
+be written as JSON to "output", a file name inside that directory in which
+{component} is replaced by the client name; paths leading outside it are
+refused. A command that can't be run, e.g. because an argument isn't a
+number, gets a reply with an "error" instead of a "result".
+
+- profile_start / profile_stop: a sampling profiler of the thread handling
+  the component's messages; the report has the most frequent stacks, in the
+  collapsed "outer;inner count" form flame graph tools read
+- memory_start / memory / memory_stop: tracemalloc, and its top allocation
+  sites by line; memory starts tracing if it's off, so ask again for a report
+  that covers what happened since
+- queue_counts: the length of every list, dict and queue the component holds
+  and the number of Plane objects alive in the process
+
+The profiler and tracemalloc are per process, so on a launch.py host they
+cover all its components.
+"""
+
+import gc
+import json
+import os
+import sys
+import threading
+import tracemalloc
+from collections import Counter
+from typing import Dict, Optional
+
+from admission import BoundedQueue
+from plane import Plane
+
+REPLY_TOPIC = "admin/reply"
+
+# where "output" files may be written; unset, results are only published
+DIAGNOSTICS_DIR = os.environ.get("DIAGNOSTICS_DIR")
+
+
+class CommandError(ValueError):
+    """A diagnostics command that can't be run as it was sent"""
+
+
+def integer(message: dict, name: str, default: int) -> int:
+    """a positive integer argument of a command"""
+    value = message.get(name, default)
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise CommandError(f"{name} must be an integer")
+    try:
+        value = int(value)
+    except ValueError:
+        raise CommandError(f"{name} must be an integer") from None
+    if value < 1:
+        raise CommandError(f"{name} must be at least 1")
+    return value
+
+
+def seconds(message: dict, name: str, default: float) -> float:
+    """a positive number of seconds argument of a command"""
+    value = message.get(name, default)
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise CommandError(f"{name} must be a number")
+    try:
+        value = float(value)
+    except ValueError:
+        raise CommandError(f"{name} must be a number") from None
+    if not 0 < value < 3600:  # also refuses nan
+        raise CommandError(f"{name} must be between 0 and 3600 seconds")
+    return value
+
+
+def output_path(output, component_name: str) -> str:
+    """the file an "output" names, which must be inside DIAGNOSTICS_DIR"""
+    if not DIAGNOSTICS_DIR:
+        raise CommandError("output files are disabled, DIAGNOSTICS_DIR is not set")
+    if not isinstance(output, str):
+        raise CommandError("output must be a file name")
+    directory = os.path.realpath(DIAGNOSTICS_DIR)
+    path = os.path.realpath(
+        os.path.join(directory, output.replace("{component}", component_name))
+    )
+    if os.path.dirname(path) != directory:
+        raise CommandError(f"output must be inside {DIAGNOSTICS_DIR}")
+    return path
+
+
+class SamplingProfiler:
+    """Samples the stack of one thread every interval seconds"""
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        """sample until stopped"""
+        while not self.stopping.wait(self.interval):
+            frame = sys._current_frames().get(  # pylint:disable=protected-access
+                self.thread_id
+            )
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+                self.samples += 1
+
+    def stop(self, top: int) -> dict:
+        """stop sampling and report"""
+        self.stopping.set()
+        self.thread.join()
+        return {
+            "samples": self.samples,
+            "interval": self.interval,
+            "stacks": [
+                f"{stack} {count}" for stack, count in self.stacks.most_common(top)
+            ],
+        }
+
+
+_profiler: Optional[SamplingProfiler] = None
+
+
+def profile_start(message: dict) -> dict:
+    """start profiling the calling thread"""
+    global _profiler  # pylint:disable=global-statement
+    if _profiler is not None:
+        return {"error": "the profiler is already running"}
+    _profiler = SamplingProfiler(
+        threading.get_ident(), seconds(message, "interval", 0.01)
+    )
+    _profiler.thread.start()
+    return {"started": True}
+
+
+def profile_stop(message: dict) -> dict:
+    """stop profiling and report the top stacks"""
+    global _profiler  # pylint:disable=global-statement
+    if _profiler is None:
+        return {"error": "the profiler is not running"}
+    top = integer(message, "top", 100)  # checked before the samples are lost
+    profiler, _profiler = _profiler, None
+    return profiler.stop(top)
+
+
+def memory_start(message: dict) -> dict:
+    """start tracing allocations"""
+    if tracemalloc.is_tracing():
+        return {"error": "tracemalloc is already tracing"}
+    tracemalloc.start(integer(message, "frames", 1))
+    return {"started": True}
+
+
+def memory(message: dict) -> dict:
+    """top allocation sites since tracing started"""
+    if not tracemalloc.is_tracing():
+        memory_start(message)
+        return {"started": True, "note": "ask again for a report"}
+    top = integer(message, "top", 20)
+    current, peak = tracemalloc.get_traced_memory()
+    statistics = tracemalloc.take_snapshot().statistics("lineno")
+    return {
+        "traced_kib": round(current / 1024, 1),
+        "peak_kib": round(peak / 1024, 1),
+        "top": [
+            {
+                "location": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                "size_kib": round(stat.size / 1024, 1),
+                "count": stat.count,
+            }
+            for stat in statistics[:top]
+        ],
+    }
+
+
+def memory_stop(message: dict) -> dict:  # pylint:disable=unused-argument
+    """stop tracing allocations"""
+    tracemalloc.stop()
+    return {"stopped": True}
+
+
+def queue_counts(component) -> Dict:
+    """lengths of what the component holds"""
+    counts = {}
+    for name, value in vars(component).items():
+        if isinstance(value, BoundedQueue):
+            counts[name] = len(value)
+            counts[f"{name}.hangar"] = len(value.hangar)
+        elif (
+            isinstance(value, dict)
+            and value
+            and all(isinstance(inner, (list, BoundedQueue)) for inner in value.values())
+        ):
+            counts[name] = {key: len(inner) for key, inner in value.items()}
+        elif isinstance(value, (list, dict)):
+            counts[name] = len(value)
+    counts["planes_in_process"] = sum(
+        1 for obj in gc.get_objects() if isinstance(obj, Plane)
+    )
+    return counts
+
+
+COMMANDS = {
+    "profile_start": profile_start,
+    "profile_stop": profile_stop,
+    "memory_start": memory_start,
+    "memory": memory,
+    "memory_stop": memory_stop,
+}
+
+
+def run_command(component, message: dict) -> bool:
+    """Run a diagnostics command and deliver the result, or an error; False
+    if the command isn't one. Nothing a command does raises out of the
+    component's message callback."""
+    command = message["command"]
+    if command != "queue_counts" and command not in COMMANDS:
+        return False
+    name = component.mqttclientname
+    reply = {"component": name, "command": command}
+    try:
+        path = output_path(message["output"], name) if "output" in message else None
+        if command == "queue_counts":
+            reply["result"] = queue_counts(component)
+        else:
+            reply["result"] = COMMANDS[command](message)
+        if path:
+            with open(path, "w", encoding="utf-8") as output:
+                json.dump(reply, output, indent=2)
+            component.log(f"Wrote {command} result to {path}")
+            return True
+    except Exception as exc:  # pylint:disable=broad-exception-caught
+        reply["error"] = f"{exc.__class__.__name__}: {exc}"
+        component.error(f"{command} failed: {reply['error']}")
+    reply_to = message.get("reply_to", REPLY_TOPIC)
+    component.publish(reply_to if isinstance(reply_to, str) else REPLY_TOPIC, reply)
+    return True
+
+
+class Diagnosable:
+    """Component mixin answering the diagnostics commands"""
+
+    def run_admin_command(self, message: dict) -> bool:
+        """a diagnostics command, or one of another feature"""
+        return run_command(self, message) or super().run_admin_command(message)
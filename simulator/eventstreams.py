@@ -0,0 +1,54 @@
+"""Plane events sent to the dbwriter through Redis streams
+
+With EVENTS_TRANSPORT=redis components hold the plane events of a callback
+and append them at its end to the stream of their flight's partition (see
+sharding.event_stream), in the pipeline that also carries the plane location
+index and the input log. The dbwriter reads the streams with a consumer
+group. Without a Redis client, e.g. on a LocalBroker, the events are
+published on the events topics as with the default mqtt transport.
+"""
+
+import os
+from typing import List
+
+import codec
+from sharding import event_stream
+
+# "mqtt" publishes plane events on the events topics, "redis" appends them to
+# Redis streams that the dbwriter reads with a consumer group
+EVENTS_TRANSPORT = os.environ.get("EVENTS_TRANSPORT", "mqtt")
+EVENTS_STREAM_MAXLEN = int(os.environ.get("EVENTS_STREAM_MAXLEN", "1000000"))
+
+
+class StreamingEvents:
+    """Component mixin sending plane events through Redis streams"""
+
+    def __init__(self, **kwargs):
+        self.events_transport = kwargs.pop("events_transport", EVENTS_TRANSPORT)
+        self.stream_outbox: List[dict] = []
+        super().__init__(**kwargs)
+
+    def publish_event(self, event: dict):
+        """Hold an event for its stream until the end of the callback, with
+        the redis transport"""
+        if self.events_transport != "redis":
+            super().publish_event(event)
+            return
+        self.stream_outbox.append(event)
+        self.writes_held = True
+
+    def queue_writes(self, pipeline):
+        """the held events, in the order they were sent"""
+        super().queue_writes(pipeline)
+        events, self.stream_outbox = self.stream_outbox, []
+        if pipeline is None:
+            for event in events:
+                super().publish_event(event)
+            return
+        for event in events:
+            pipeline.xadd(
+                event_stream(event["flight_id"]),
+                {"event": codec.encode(event, codec.BINARY)},
+                maxlen=EVENTS_STREAM_MAXLEN,
+                approximate=True,
+            )
@@ -0,0 +1,35 @@
+"""The optional features of components, put together
+
+AirportComponent only receives, dispatches and publishes messages and saves
+the state. Each optional feature is a mixin in the module that implements
+it, which takes its keyword arguments before the base constructor runs and
+extends the hooks it needs: heartbeat, save_state, accepted, rejected,
+handle_message, publish, send, publish_event, locate, forget_location,
+queue_writes and run_admin_command. Where two features extend the same hook
+the order below is the order they act in: a traced plane is marked before
+metrics time its handler, metrics time the whole transaction of a snapshot
+with its new input log, and publishing stops while the log is replayed.
+"""
+
+from airportcomponent import AirportComponent
+from checkpoint import Checkpointed
+from diagnostics import Diagnosable
+from eventstreams import StreamingEvents
+from inputlog import InputLogged
+from locations import Located
+from metrics import Measured
+from tracing import Traced
+
+
+class Component(
+    Traced,
+    Measured,
+    InputLogged,
+    Checkpointed,
+    Diagnosable,
+    Located,
+    StreamingEvents,
+    AirportComponent,
+):  # pylint:disable=abstract-method
+    """AirportComponent with every optional feature; what Airport, Gate,
+    Runway and Sky derive from"""
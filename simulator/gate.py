@@ -1,14 +1,15 @@
 """Airport Simulation using MQTT"""
 
-import random
-import json
 import os
 from enum import Enum
+from functools import cached_property
 import argparse
 from redis import Redis
 
 from restorable import construct_or_restore
-from airportcomponent import AirportComponent
+from airportcomponent import handles
+from features import Component
+from observable import ObservableState, state_sync_due
 from plane import Plane, PlaneState
 
 REDIS_BROKER = os.environ.get("REDIS_BROKER", "localhost")
@@ -28,9 +29,14 @@ def gate_redis_key(airport: str, gate_number: str) -> str:
     return f"airport-{airport}-gate-{gate_number}"
 
 
-class Gate(AirportComponent):
+class Gate(Component):
     """Representation of a gate at an airport."""
 
+    GATE_MIN_TICKS = 3  # Minimum ticks a plane stays at the gate
+    GATE_MAX_TICKS = 5
+
+    logged_attributes = ("state_announced_at",)
+
     @staticmethod
     def args_to_dict(arguments: argparse.Namespace) -> dict:
         """Convert command line arguments to a state dictionary."""
@@ -39,48 +45,46 @@ class Gate(AirportComponent):
             "gate_number": arguments.gate_number,
         }
 
-    @property
+    @cached_property
     def airport_topic(self):
         """Return the MQTT topic for the airport"""
         return f"airport/{self.airport}"
 
-    @property
+    @cached_property
     def mqtt_topic(self):
         """Return the MQTT topic for this gate."""
         return f"airport/{self.airport}/gate/{self.gate_number}"
 
-    @property
+    @cached_property
     def mqttclientname(self):
         """Name of the MQTT client we will create"""
         return f"Airport_{self.airport}_Gate_{self.gate_number}"
 
-    @property
+    @cached_property
     def loggername(self) -> str:
         """Name of the logger"""
         return f"{self.airport} Gate {self.gate_number}"
 
-    @property
+    @cached_property
     def redis_key(self) -> str:
         """Key for Redis storage"""
         return gate_redis_key(self.airport, self.gate_number)
 
-    @property
-    def state(self) -> GateState:
-        """gate state"""
-        return self._state
-
-    @state.setter
-    def state(self, newstate: str):
-        """gate state"""
-        self._state = GateState(newstate)
-        self.update_gate_state_to_airport()
+    state = ObservableState(GateState, notify="update_gate_state_to_airport")
 
     def on_child_connect(self):
         """called by airportcomponent.on_connect"""
-        self.client.publish(
+        if self.registered:  # the airport knows us already, e.g. pre-seeded
+            return
+        self.publish(
             self.airport_topic,
-            json.dumps({"msg_type": "register_gate", "gate_number": self.gate_number}),
+            {
+                "msg_type": "register_gate",
+                "gate_number": self.gate_number,
+                "seq": self.state_seq,
+            },
         )
+        self.registered = True
         # self.client.on_disconnect = lambda client, userdata, rc: client.publish(
         #     self.airport_topic,
         #     json.dumps(
@@ -92,11 +96,16 @@ class Gate(AirportComponent):
         #     ),
         # )
 
-    def __init__(self, airport: str, gate_number: str, **kwargs):
+    def __init__(
+        self, airport: str, gate_number: str, registered: bool = False, **kwargs
+    ):
         self.airport = airport
         self.gate_number = gate_number
         self.current_plane = None
         self._state = GateState.FREE
+        self.state_seq = 0  # bumped on every state transition
+        self.state_announced_at = 0
+        self.registered = registered
         self.ticks_till_exit = -1
 
         super().__init__(**kwargs)
@@ -111,97 +120,97 @@ class Gate(AirportComponent):
             ),
             "state": self.state.value,
             "ticks_till_exit": self.ticks_till_exit,
+            "registered": self.registered,
+            "state_seq": self.state_seq,
         }
 
     @staticmethod
     def from_dict(data: dict, **kwargs):
         """Load the Gate state from a dict representation."""
-        restored_gate = Gate(data["airport"], data["gate_number"], **kwargs)
+        restored_gate = Gate(
+            data["airport"],
+            data["gate_number"],
+            registered=data.get("registered", False),
+            **kwargs,
+        )
         if data.get("current_plane"):
             restored_gate.current_plane = Plane.from_dict(data["current_plane"])
         if "state" in data:
             restored_gate.state = GateState(data["state"])
         restored_gate.ticks_till_exit = data.get("ticks_till_exit", 0)
+        # continued, or the airport could take a new state for one it has seen
+        restored_gate.state_seq = data.get("state_seq", 0)
         return restored_gate
 
     def update_gate_state_to_airport(self):
         """Let the Airport know the gate state"""
-        self.client.publish(
+        self.publish(
             self.airport_topic,
-            json.dumps(
-                {
-                    "msg_type": "gate_update",
-                    "gate_number": self.gate_number,
-                    "gate_state": self.state.value,
-                }
-            ),
+            {
+                "msg_type": "gate_update",
+                "gate_number": self.gate_number,
+                "gate_state": self.state.value,
+                "seq": self.state_seq,
+            },
         )
 
+    def sync_gate_state_to_airport(self):
+        """Periodically send the state sequence number, so that the Airport
+        can tell whether it missed an update"""
+        self.publish(
+            self.airport_topic,
+            {
+                "msg_type": "gate_sync",
+                "gate_number": self.gate_number,
+                "gate_state": self.state.value,
+                "seq": self.state_seq,
+            },
+        )
+
+    @handles("arriving_plane", "plane")
     def handle_arriving_plane(self, plane: dict):
         """Handle a plane arriving at the gate from a runway."""
         self.current_plane = Plane.from_dict(plane)
-        self.current_plane.set_state(
-            PlaneState.AT_ARRIVAL_GATE, self.client, self.ticks
-        )
-        self.current_plane.update_flight(self.client, to_gate=self.gate_number)
+        self.current_plane.set_state(PlaneState.AT_ARRIVAL_GATE, self, self.ticks)
+        self.current_plane.update_flight(self, to_gate=self.gate_number)
         self.state = GateState.IN_USE_ARRIVING
-        self.ticks_till_exit = random.randint(
-            3, 5
-        )  # Random time at gate between 3 and 5 ticks
+        self.ticks_till_exit = self.rng.randint(
+            Gate.GATE_MIN_TICKS, Gate.GATE_MAX_TICKS
+        )
         self.log(
             f"Plane {self.current_plane.plane_id} is at gate for arrival; "
             + f"time at gate: {self.ticks_till_exit} ticks",
         )
 
+    @handles("departing_plane", "plane")
     def handle_departing_plane(self, plane: dict):
         """Handle a departing plane coming to the gate on its way to a runway"""
         self.current_plane = Plane.from_dict(plane)
-        self.current_plane.set_state(
-            PlaneState.AT_DEPARTURE_GATE, self.client, self.ticks
-        )
-        self.current_plane.update_flight(self.client, from_gate=self.gate_number)
+        self.current_plane.set_state(PlaneState.AT_DEPARTURE_GATE, self, self.ticks)
+        self.current_plane.update_flight(self, from_gate=self.gate_number)
         self.state = GateState.IN_USE_DEPARTING
-        self.ticks_till_exit = random.randint(
-            3, 5
-        )  # Random time at gate between 3 and 5 ticks
+        self.ticks_till_exit = self.rng.randint(
+            Gate.GATE_MIN_TICKS, Gate.GATE_MAX_TICKS
+        )
         self.log(
             f"Plane {self.current_plane.plane_id} is at gate for departure; "
             + f"time at gate: {self.ticks_till_exit} ticks",
         )
 
+    @handles("departure_runway_assigned", "runway_number", "runway_topic")
     def handle_departure_runway_assigned(self, runway_number: str, runway_topic: str):
         """Transition plane from gate to runway for departure"""
         if self.current_plane:
-            self.client.publish(
+            self.publish(
                 runway_topic,
-                json.dumps(
-                    {
-                        "msg_type": "plane_departing",
-                        "plane": self.current_plane.to_dict(),
-                    }
-                ),
+                {
+                    "msg_type": "plane_departing",
+                    "plane": self.current_plane.to_dict(),
+                },
             )
             self.current_plane = None
         self.state = GateState.FREE
 
-    def handle_message(self, message: dict):
-        """Handle incoming plane messages at the gate."""
-        if self.validate_message(["msg_type"], message):
-
-            if message["msg_type"] == "arriving_plane":
-                if self.validate_message(["plane"], message):
-                    self.handle_arriving_plane(message["plane"])
-
-            elif message["msg_type"] == "departing_plane":
-                if self.validate_message(["plane"], message):
-                    self.handle_departing_plane(message["plane"])
-
-            elif message["msg_type"] == "departure_runway_assigned":
-                if self.validate_message(["runway_number", "runway_topic"], message):
-                    self.handle_departure_runway_assigned(
-                        message["runway_number"], message["runway_topic"]
-                    )
-
     def handle_heartbeat(self):
         """Handle heartbeat messages to update gate state."""
         if self.current_plane:
@@ -216,14 +225,12 @@ class Gate(AirportComponent):
                         f"Plane {self.current_plane.plane_id} "
                         + "is ready to leave the gate.",
                     )
-                    self.client.publish(
+                    self.publish(
                         self.airport_topic,
-                        json.dumps(
-                            {
-                                "msg_type": "requesting_departure_runway",
-                                "gate": self.mqtt_topic,
-                            }
-                        ),
+                        {
+                            "msg_type": "requesting_departure_runway",
+                            "gate": self.mqtt_topic,
+                        },
                     )
 
                 elif self.state == GateState.IN_USE_ARRIVING:
@@ -231,14 +238,15 @@ class Gate(AirportComponent):
                         f"Plane {self.current_plane.plane_id} "
                         + "is going back to its hangar"
                     )
-                    self.current_plane.set_state(
-                        PlaneState.IN_HANGAR, self.client, self.ticks
-                    )
+                    self.current_plane.set_state(PlaneState.IN_HANGAR, self, self.ticks)
                     self.current_plane = None
                     self.state = GateState.FREE
         else:
             self.log("Ready for next plane")
 
+        if state_sync_due(self):
+            self.sync_gate_state_to_airport()
+
 
 # == main
 if __name__ == "__main__":
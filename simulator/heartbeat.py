@@ -3,8 +3,12 @@ import json
 import os
 import argparse
 import paho.mqtt.client as mqtt
+from redis import Redis
+
+from checkpoint import Checkpointer
 
 MQTT_BROKER = os.environ.get("MQTT_BROKER", "localhost")
+REDIS_BROKER = os.environ.get("REDIS_BROKER", "localhost")
 
 parser = argparse.ArgumentParser(description="Heartbeat Publisher")
 parser.add_argument("interval", type=float, help="Heartbeat interval in seconds")
@@ -12,20 +16,39 @@ parser.add_argument(
     "--interactive", action="store_true", help="Press <Enter> to advance time"
 )
 parser.add_argument("--start-tick", help="tick to start at", default=0, type=int)
+parser.add_argument(
+    "--checkpoint-every",
+    type=int,
+    default=0,
+    help="stop the clock every N ticks to checkpoint the world, see checkpoint.py",
+)
+parser.add_argument("--checkpoints", default="checkpoints", help="directory")
+parser.add_argument("--keep", type=int, default=5, help="checkpoints kept, 0 for all")
 args = parser.parse_args()
 
 
 def main():
     client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
     client.connect(MQTT_BROKER)
+    checkpointer = None
+    if args.checkpoint_every:
+        client.loop_start()  # for the components' replies
+        checkpointer = Checkpointer(
+            client,
+            args.checkpoints,
+            keep=args.keep,
+            redis_client=Redis(host=REDIS_BROKER, port=6379),
+        )
     ticks = args.start_tick
     while True:
         ticks += 1
-        client.publish("heartbeat", json.dumps({"ticks": ticks}))
+        client.publish("heartbeat", json.dumps({"ticks": ticks, "time": time.time()}))
         if args.interactive:
             input()
         else:
             time.sleep(args.interval)
+        if checkpointer and ticks % args.checkpoint_every == 0:
+            checkpointer.take(ticks)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,167 @@
+"""Per-component log of what changed a component since its last snapshot
+
+With SNAPSHOT_EVERY=K above 1 components write their full state to Redis
+only every Kth tick, and on the first heartbeat after they start. In between
+they append what they receive, messages on their topic and heartbeats, to
+the Redis list log:<redis_key>, in the pipeline that already carries their
+events and plane locations at the end of a callback. A snapshot replaces
+the log in one transaction. The new log starts with the component's
+logged_attributes, what the snapshot leaves out such as the sequence numbers
+of state updates, and the state of its random generator is written to
+rng:<redis_key> with it when it changed since the last snapshot (see InputLogged). A
+restarted component is rebuilt exactly from its snapshot and log: it
+handles the logged messages again with publishing and Redis writes
+suppressed (see restorable.py). Planes kept in a hangar overflow are not
+saved either way.
+
+Messages are much smaller than the full state of a busy airport or of Sky,
+so steady-state writes drop to the messages plus one snapshot per K ticks
+(and the generator state, 2.5KB, of components that drew random numbers).
+The snapshots airport-monitor shows are then up to K ticks old.
+SNAPSHOT_EVERY=1, the default, writes the state on every tick as before and
+keeps no log.
+"""
+
+import os
+from typing import List, Tuple
+
+import msgpack
+
+import snapshot
+from localbroker import LocalMessage
+from logger import Logger
+
+SNAPSHOT_EVERY = int(os.environ.get("SNAPSHOT_EVERY", "1"))
+
+# the first byte of an entry says what it is
+START = b"s"
+HEARTBEAT = b"h"
+MESSAGE = b"m"
+
+
+def log_key(redis_key: str) -> str:
+    """key of the log of the component stored under redis_key"""
+    return f"log:{redis_key}"
+
+
+def rng_key(redis_key: str) -> str:
+    """key of the random generator state of the component"""
+    return f"rng:{redis_key}"
+
+
+def start_log(pipeline, component):
+    """queue a new log on the transaction that writes a snapshot, and the
+    generator state if it changed since the last snapshot"""
+    key = log_key(component.redis_key)
+    pipeline.delete(key)
+    pipeline.rpush(
+        key,
+        START
+        + msgpack.packb(
+            {name: getattr(component, name) for name in component.logged_attributes}
+        ),
+    )
+    state = component.rng.getstate()
+    if state != component.saved_rng:
+        pipeline.set(rng_key(component.redis_key), msgpack.packb(state))
+        component.saved_rng = state
+
+
+def drop_log(pipeline, redis_key: str):
+    """queue the removal of a log left by an earlier run"""
+    pipeline.delete(log_key(redis_key), rng_key(redis_key))
+
+
+def heartbeat_entry(ticks: int) -> bytes:
+    """a heartbeat in the log; components only read its ticks"""
+    return HEARTBEAT + str(ticks).encode()
+
+
+def replay(component, rng_state: bytes | None, entries: List[bytes]) -> int:
+    """Handle the logged messages and heartbeats again, publishing nothing;
+    returns how many there were"""
+    if not entries or entries[0][:1] != START:
+        return 0
+    if rng_state:
+        version, internal, gauss = msgpack.unpackb(rng_state)
+        component.saved_rng = (version, tuple(internal), gauss)
+        component.rng.setstate(component.saved_rng)
+    for name, value in msgpack.unpackb(entries[0][1:]).items():
+        setattr(component, name, value)
+    if component.logger is None:  # before on_connect; what it logs is dropped
+        component.logger = Logger(component.loggername, component)
+    component.replaying = True
+    try:
+        for entry in entries[1:]:
+            if entry[:1] == HEARTBEAT:
+                payload = b'{"ticks": ' + entry[1:] + b"}"
+                component.on_heartbeat(None, None, LocalMessage("heartbeat", payload))
+            else:
+                component.on_message(
+                    None, None, LocalMessage(component.mqtt_topic, entry[1:])
+                )
+    finally:
+        component.replaying = False
+    return len(entries) - 1
+
+
+class InputLogged:
+    """Component mixin taking snapshots every snapshot_every ticks and
+    logging what it handles in between"""
+
+    # attributes to_dict leaves out that handling messages depends on; saved
+    # at the start of the log
+    logged_attributes: Tuple[str, ...] = ()
+
+    def __init__(self, **kwargs):
+        self.snapshot_every = kwargs.pop("snapshot_every", SNAPSHOT_EVERY)
+        self.snapshot_due = True  # on the first heartbeat, whatever the tick
+        self.replaying = False
+        self.log_outbox: List[bytes] = []
+        self.saved_rng = None  # generator state written with the last snapshot
+        super().__init__(**kwargs)
+
+    def save_state(self, ticks: int):
+        """A snapshot in one transaction with the start of a new log on every
+        Kth tick, and the heartbeat logged; nothing while replaying"""
+        if self.replaying:
+            return
+        if self.snapshot_every <= 1 and not self.snapshot_due:
+            super().save_state(ticks)
+            return
+        if self.snapshot_due or ticks % self.snapshot_every == 0:
+            pipeline = self.redis_client.pipeline()  # a transaction
+            self.queue_snapshot(pipeline)
+            pipeline.execute()
+            self.snapshot_due = False
+        if self.snapshot_every > 1:
+            self.log_outbox.append(heartbeat_entry(ticks))
+            self.writes_held = True
+
+    def queue_snapshot(self, pipeline):
+        """Queue the state and the start of a new log, or the removal of the
+        old one, on a transaction"""
+        pipeline.set(self.redis_key, snapshot.dumps(self.to_dict()))
+        if self.snapshot_every > 1:
+            start_log(pipeline, self)
+        else:
+            drop_log(pipeline, self.redis_key)
+
+    def accepted(self, payload: bytes):
+        """log a message about to be handled"""
+        if self.snapshot_every > 1 and not self.replaying:
+            self.log_outbox.append(MESSAGE + payload)
+            self.writes_held = True
+        super().accepted(payload)
+
+    def publish(self, topic: str, message: dict | str):
+        """nothing is published while logged messages are replayed"""
+        if not self.replaying:
+            super().publish(topic, message)
+
+    def queue_writes(self, pipeline):
+        """the log entries, after the events and plane locations"""
+        super().queue_writes(pipeline)
+        logged, self.log_outbox = self.log_outbox, []
+        if logged and pipeline is not None and not self.replaying:
+            pipeline.rpush(log_key(self.redis_key), *logged)
@@ -0,0 +1,346 @@
+"""Start a whole world described by a scenario file
+
+A scenario is a JSON file:
+
+    {
+        "airports": {
+            "JFK": {"gates": 10, "runways": 3},
+            "LAX": {"gates": 8, "runways": 2}
+        },
+        "defaults": {"gates": 4, "runways": 2},
+        "generator": {"prob": 0.5},
+        "heartbeat": {"interval": 1},
+        "verbose": false
+    }
+
+Airports without counts get the defaults; "airports" may also be a plain
+list of names. "generator" and "heartbeat" are optional and start
+planegenerator.py and heartbeat.py once the world is ready; the generator's
+keys are planegenerator.py options (prob, rate, od, timetable, loop, seed),
+the heartbeat's other than interval heartbeat.py options (checkpoint_every,
+checkpoints, keep); a scenario with other heartbeat keys is refused.
+
+The launcher first writes the state of every new airport, gate and runway
+to Redis in one pipeline, so airports start out knowing their gates and
+runways and nothing has to register. It then starts --hosts host processes
+that each run a share of the airports (with their gates and runways) and of
+the Sky shards over a single MQTT connection, and reports how long it took
+until every host was ready. With METRICS_PORT set, host i serves the metrics
+of all its components on METRICS_PORT + i.
+
+With --checkpoint (a file or a directory of them, see checkpoint.py) the
+world is first restored from a checkpoint and the heartbeat goes on from
+its tick.
+
+    python launch.py scenarios/example.json --hosts 4
+    python launch.py scenarios/example.json --hosts 4 --checkpoint checkpoints/
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List
+
+import paho.mqtt.client as mqtt
+from redis import Redis
+
+import checkpoint
+import metrics
+import snapshot
+from airport import Airport, airport_redis_key
+from gate import Gate, gate_redis_key
+from restorable import construct_or_restore_many
+from runway import Runway, runway_redis_key
+from sharding import SKY_SHARDS, sky_redis_key
+from sharedclient import SharedConnection
+from sky import Sky
+
+MQTT_BROKER = os.environ.get("MQTT_BROKER", "localhost")
+REDIS_BROKER = os.environ.get("REDIS_BROKER", "localhost")
+
+READY_TOPIC = "launch/ready"
+# what a scenario's heartbeat section may set, all heartbeat.py options
+HEARTBEAT_OPTIONS = ("interval", "checkpoint_every", "checkpoints", "keep")
+
+
+def load_scenario(path: str) -> dict:
+    """read a scenario file and fill in the defaults"""
+    with open(path, encoding="utf-8") as scenario_file:
+        scenario = json.load(scenario_file)
+    unknown = set(scenario.get("heartbeat", {})) - set(HEARTBEAT_OPTIONS)
+    if unknown:
+        raise ValueError(f"unknown heartbeat options in {path}: {sorted(unknown)}")
+    defaults = {"gates": 4, "runways": 2, **scenario.get("defaults", {})}
+    airports = scenario.get("airports", {})
+    if isinstance(airports, list):
+        airports = {name: {} for name in airports}
+    scenario["airports"] = {
+        name: {**defaults, **(counts or {})}
+        for name, counts in sorted(airports.items())
+    }
+    scenario.setdefault("verbose", False)
+    return scenario
+
+
+def gate_numbers(counts: dict) -> List[str]:
+    """gate numbers of an airport, from 1 as in add-component.sh"""
+    return [str(number) for number in range(1, counts["gates"] + 1)]
+
+
+def runway_numbers(counts: dict) -> List[str]:
+    """runway numbers of an airport, from 1"""
+    return [str(number) for number in range(1, counts["runways"] + 1)]
+
+
+def seed_redis(scenario: dict, redis_client: Redis) -> int:
+    """Write the initial state of airports that don't exist yet, with all
+    their gates and runways free and registered; returns the keys written"""
+    airports = list(scenario["airports"].items())
+    pipeline = redis_client.pipeline(transaction=False)
+    for name, _ in airports:
+        pipeline.exists(airport_redis_key(name))
+    existing = pipeline.execute()
+
+    for (name, counts), exists in zip(airports, existing):
+        if exists:  # keep a running world; new components register as usual
+            continue
+        gates, runways = gate_numbers(counts), runway_numbers(counts)
+        airport_state = {
+            "airport": name,
+            "gates": {gate: "free" for gate in gates},
+            "runways": {runway: "free" for runway in runways},
+        }
+        pipeline.set(airport_redis_key(name), snapshot.dumps(airport_state), nx=True)
+        for gate in gates:
+            state = {"airport": name, "gate_number": gate, "registered": True}
+            pipeline.set(gate_redis_key(name, gate), snapshot.dumps(state), nx=True)
+        for runway in runways:
+            state = {"airport": name, "runway_number": runway, "registered": True}
+            pipeline.set(runway_redis_key(name, runway), snapshot.dumps(state), nx=True)
+    return sum(1 for written in pipeline.execute() if written)
+
+
+def generator_arguments(generator: dict) -> List[str]:
+    """planegenerator.py options for a scenario's generator section, e.g.
+    {"rate": 0.2, "od": "od.json", "seed": 1} or {"timetable": "t.csv", "loop": true}"""
+    arguments = []
+    for option, value in generator.items():
+        if value is True:
+            arguments.append(f"--{option}")
+        elif value is not False:
+            arguments += [f"--{option}", str(value)]
+    return arguments
+
+
+def heartbeat_arguments(heartbeat: dict, start_tick: int) -> List[str]:
+    """heartbeat.py arguments for a scenario's heartbeat section, e.g.
+    {"interval": 1, "checkpoint_every": 100}, going on from start_tick"""
+    arguments = [str(heartbeat.get("interval", 1)), "--start-tick", str(start_tick)]
+    for option in HEARTBEAT_OPTIONS:
+        if option != "interval" and option in heartbeat:
+            arguments += [f"--{option.replace('_', '-')}", str(heartbeat[option])]
+    return arguments
+
+
+def run_host(scenario: dict, host: int, hosts: int):
+    """run this host's share of the world on one MQTT connection"""
+    start = time.perf_counter()
+    verbose = scenario["verbose"]
+    specs = []
+    for name, counts in list(scenario["airports"].items())[host::hosts]:
+        specs.append(
+            (
+                Airport,
+                airport_redis_key(name),
+                argparse.Namespace(airport=name, verbose=verbose),
+            )
+        )
+        for gate in gate_numbers(counts):
+            specs.append(
+                (
+                    Gate,
+                    gate_redis_key(name, gate),
+                    argparse.Namespace(airport=name, gate_number=gate, verbose=verbose),
+                )
+            )
+        for runway in runway_numbers(counts):
+            specs.append(
+                (
+                    Runway,
+                    runway_redis_key(name, runway),
+                    argparse.Namespace(
+                        airport=name, runway_number=runway, verbose=verbose
+                    ),
+                )
+            )
+    for shard in range(host, SKY_SHARDS, hosts):
+        specs.append(
+            (
+                Sky,
+                sky_redis_key(shard),
+                argparse.Namespace(shard=shard, verbose=verbose),
+            )
+        )
+
+    if metrics.METRICS_PORT:  # one endpoint for all the host's components
+        metrics.serve(metrics.METRICS_PORT + host)
+    connection = SharedConnection(f"launch-host-{host}")
+    redis_client = Redis(host=REDIS_BROKER, port=6379)
+    components = construct_or_restore_many(specs, redis_client, broker=connection)
+    for component in components:
+        if isinstance(component, Sky) and component.shard == 0:
+            component.take_over_retired_shards(redis_client)
+    constructed = time.perf_counter() - start
+
+    def ready():
+        connection.mqtt_client.publish(
+            READY_TOPIC,
+            json.dumps(
+                {
+                    "host": host,
+                    "components": len(components),
+                    "construct_seconds": round(constructed, 3),
+                }
+            ),
+        )
+
+    connection.on_ready = ready
+    connection.mqtt_client.loop_forever()
+
+
+def wait_for_hosts(hosts: int, processes: list, timeout: float) -> Dict[int, dict]:
+    """collect the ready messages of the hosts"""
+    ready: Dict[int, dict] = {}
+    subscribed, all_ready = threading.Event(), threading.Event()
+    start = time.perf_counter()
+
+    def on_ready(client, userdata, msg):  # pylint:disable=unused-argument
+        message = json.loads(msg.payload)
+        message["ready_seconds"] = round(time.perf_counter() - start, 3)
+        ready[message["host"]] = message
+        if len(ready) == hosts:
+            all_ready.set()
+
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, "launcher")
+    client.on_connect = lambda client, *args: client.subscribe(READY_TOPIC)
+    client.on_subscribe = lambda *args: subscribed.set()
+    client.message_callback_add(READY_TOPIC, on_ready)
+    client.connect(MQTT_BROKER)
+    client.loop_start()
+    try:
+        subscribed.wait(timeout)  # before any host can announce itself
+        for host in range(hosts):
+            processes.append(
+                subprocess.Popen(
+                    [
+                        sys.executable,
+                        __file__,
+                        sys.argv[1],
+                        "--host",
+                        str(host),
+                        "--hosts",
+                        str(hosts),
+                    ]
+                )
+            )
+        all_ready.wait(timeout)
+    finally:
+        client.loop_stop()
+        client.disconnect()
+    return ready
+
+
+def main():
+    """main"""
+    parser = argparse.ArgumentParser(description="Start the world of a scenario")
+    parser.add_argument("scenario", help="scenario JSON file")
+    parser.add_argument("--hosts", type=int, default=1, help="host processes")
+    parser.add_argument("--host", type=int, help=argparse.SUPPRESS)
+    parser.add_argument(
+        "--timeout", type=float, default=300, help="seconds to wait for the hosts"
+    )
+    parser.add_argument("--checkpoint", help="restore the world from a checkpoint")
+    args = parser.parse_args()
+    scenario = load_scenario(args.scenario)
+
+    if args.host is not None:
+        run_host(scenario, args.host, args.hosts)
+        return
+
+    components = sum(
+        1 + counts["gates"] + counts["runways"]
+        for counts in scenario["airports"].values()
+    )
+    print(
+        f"{len(scenario['airports'])} airports, {components} components, "
+        + f"{SKY_SHARDS} sky shards on {args.hosts} hosts"
+    )
+
+    start = time.perf_counter()
+    redis_client = Redis(host=REDIS_BROKER, port=6379)
+    start_tick = 0
+    if args.checkpoint:
+        restored = checkpoint.CheckpointFile(checkpoint.latest(args.checkpoint))
+        written = restored.restore(redis_client)
+        start_tick = restored.tick
+        print(
+            f"restored {written} keys of tick {start_tick} from {restored.path} "
+            + f"in {time.perf_counter() - start:.2f}s"
+        )
+        start = time.perf_counter()
+    written = seed_redis(scenario, redis_client)
+    print(f"seeded {written} keys in {time.perf_counter() - start:.2f}s")
+
+    processes: List[subprocess.Popen] = []
+    try:
+        ready = wait_for_hosts(args.hosts, processes, args.timeout)
+        for host, message in sorted(ready.items()):
+            print(
+                f"host {host}: {message['components']} components, constructed in "
+                + f"{message['construct_seconds']}s, ready after "
+                + f"{message['ready_seconds']}s"
+            )
+        if len(ready) < args.hosts:
+            print(
+                f"only {len(ready)} of {args.hosts} hosts ready after {args.timeout}s"
+            )
+            return
+        print(f"world ready in {time.perf_counter() - start:.2f}s")
+
+        here = os.path.dirname(os.path.abspath(__file__))
+        if "heartbeat" in scenario:
+            processes.append(
+                subprocess.Popen(
+                    [
+                        sys.executable,
+                        os.path.join(here, "heartbeat.py"),
+                        *heartbeat_arguments(scenario["heartbeat"], start_tick),
+                    ]
+                )
+            )
+        if "generator" in scenario:
+            processes.append(
+                subprocess.Popen(
+                    [
+                        sys.executable,
+                        os.path.join(here, "planegenerator.py"),
+                        *generator_arguments(scenario["generator"]),
+                        *scenario["airports"],
+                    ]
+                )
+            )
+        for process in processes:
+            process.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == "__main__":
+    main()
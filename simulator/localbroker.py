@@ -0,0 +1,148 @@
+"""In-process stand-in for the MQTT broker
+
+Components take a `broker=LocalBroker()` keyword argument to run without
+mosquitto: benchmarks and headless simulations use it to drive a whole world
+in one process. LocalClient implements the subset of paho's Client that the
+components use, and messages are delivered in publish order when the broker
+is run.
+"""
+
+from collections import deque, defaultdict
+from typing import Callable, Deque, Dict, List, Tuple
+
+import paho.mqtt.client as mqtt
+
+
+class LocalMessage:
+    """What paho hands to message callbacks"""
+
+    __slots__ = ("topic", "payload", "qos", "retain")
+
+    def __init__(self, topic: str, payload: bytes):
+        self.topic = topic
+        self.payload = payload
+        self.qos = 0
+        self.retain = False
+
+
+class LocalClient:
+    """paho.mqtt.client.Client look-alike bound to a LocalBroker"""
+
+    def __init__(self, broker: "LocalBroker", client_id: str):
+        self.broker = broker
+        self.client_id = client_id
+        self.on_connect = None
+        self.on_message = None
+        self.userdata = None
+        self.callbacks: Dict[str, Callable] = {}
+        self.wildcard_callbacks: Dict[str, Callable] = {}
+
+    def user_data_set(self, userdata):
+        """same as paho"""
+        self.userdata = userdata
+
+    def connect(self, *args, **kwargs):  # pylint:disable=unused-argument
+        """connects immediately, calling on_connect"""
+        self.broker.clients[self.client_id] = self
+        if self.on_connect:
+            self.on_connect(self, self.userdata, None, 0, None)
+
+    def disconnect(self):
+        """stop receiving messages"""
+        self.broker.unsubscribe_all(self)
+        self.broker.clients.pop(self.client_id, None)
+
+    def subscribe(self, topic: str, qos: int = 0):  # pylint:disable=unused-argument
+        """same as paho"""
+        self.broker.subscribe(self, topic)
+
+    def message_callback_add(self, sub: str, callback: Callable):
+        """same as paho"""
+        if "+" in sub or "#" in sub:
+            self.wildcard_callbacks[sub] = callback
+        else:
+            self.callbacks[sub] = callback
+
+    def publish(self, topic: str, payload=None, qos=0, retain=False):
+        """queue a message on the broker"""
+        # pylint:disable=unused-argument
+        self.broker.publish(topic, payload, self.client_id)
+
+    def deliver(self, msg: LocalMessage):
+        """invoke every callback whose filter matches, else on_message"""
+        callback = self.callbacks.get(msg.topic)
+        delivered = callback is not None
+        if delivered:
+            callback(self, self.userdata, msg)
+        for sub, callback in self.wildcard_callbacks.items():
+            if mqtt.topic_matches_sub(sub, msg.topic):
+                callback(self, self.userdata, msg)
+                delivered = True
+        if not delivered and self.on_message:
+            self.on_message(self, self.userdata, msg)
+
+    def loop_forever(self):
+        """run the broker until no messages are left"""
+        self.broker.run()
+
+
+class LocalBroker:
+    """Routes messages between LocalClients"""
+
+    def __init__(self):
+        self.clients: Dict[str, LocalClient] = {}
+        self.exact: Dict[str, List[LocalClient]] = defaultdict(list)
+        self.wildcard: List[Tuple[str, LocalClient]] = []
+        self.queue: Deque[LocalMessage] = deque()
+        self.published: Dict[str, int] = defaultdict(int)
+
+    def client(self, client_id: str) -> LocalClient:
+        """create a client"""
+        return LocalClient(self, client_id)
+
+    def subscribe(self, client: LocalClient, topic: str):
+        """add a subscription"""
+        if "+" in topic or "#" in topic:
+            if (topic, client) not in self.wildcard:
+                self.wildcard.append((topic, client))
+        elif client not in self.exact[topic]:
+            self.exact[topic].append(client)
+
+    def unsubscribe_all(self, client: LocalClient):
+        """remove all subscriptions of client"""
+        for clients in self.exact.values():
+            if client in clients:
+                clients.remove(client)
+        self.wildcard = [entry for entry in self.wildcard if entry[1] is not client]
+
+    def publish(self, topic: str, payload, sender: str | None = None):
+        """queue a message; sender is the client id of the publisher"""
+        # pylint:disable=unused-argument
+        if payload is None:
+            payload = b""
+        elif isinstance(payload, str):
+            payload = payload.encode()
+        self.published[topic] += 1
+        self.queue.append(LocalMessage(topic, payload))
+
+    def subscribers(self, topic: str) -> List[LocalClient]:
+        """clients subscribed to topic, each once"""
+        clients = list(self.exact.get(topic, ()))
+        for sub, client in self.wildcard:
+            if client not in clients and mqtt.topic_matches_sub(sub, topic):
+                clients.append(client)
+        return clients
+
+    def deliver(self, msg: LocalMessage):
+        """deliver one message to its subscribers"""
+        for client in self.subscribers(msg.topic):
+            client.deliver(msg)
+
+    def run(self, max_messages: int = -1) -> int:
+        """deliver queued messages, including ones published while delivering,
+        until the queue is empty or max_messages were delivered"""
+        delivered = 0
+        while self.queue and delivered != max_messages:
+            self.deliver(self.queue.popleft())
+            delivered += 1
+        return delivered
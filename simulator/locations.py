@@ -0,0 +1,89 @@
+"""Index of where every plane is now, kept in a Redis hash
+
+Every state change of a plane is recorded in the plane_locations hash under
+both plane:<plane_id> and flight:<flight_id>, as JSON with the state, the
+component holding the plane, its Redis key and the tick. Components hold the
+updates of a callback and write them in the pipeline that also carries their
+events (see Located), so a lookup is a single HGET
+instead of reading every snapshot. Entries are removed when the flight ends
+in its arrival gate's hangar, or when Sky diverts the plane.
+
+The index is off unless PLANE_INDEX=1: it costs every component a Redis
+round trip at the end of each callback that moves a plane, which only the
+redis events transport would make anyway. It is written by the components
+rather than by the dbwriter because only they know where a plane is, and
+so that a checkpoint's copy of it matches the component states.
+airport-monitor-server serves lookups on /locate.
+"""
+
+import json
+import os
+from typing import Dict, Tuple
+
+PLANE_INDEX = os.environ.get("PLANE_INDEX", "0") == "1"
+
+LOCATIONS_KEY = "plane_locations"
+
+
+def fields(plane_id: str, flight_id: str) -> Tuple[str, str]:
+    """the hash fields of a plane"""
+    return f"plane:{plane_id}", f"flight:{flight_id}"
+
+
+def entry(plane, state: str, component) -> str:
+    """where the plane is, as stored in the hash"""
+    return json.dumps(
+        {
+            "plane_id": plane.plane_id,
+            "flight_id": plane.flight_id,
+            "start_airport": plane.start_airport,
+            "end_airport": plane.end_airport,
+            "state": state,
+            "component": component.mqttclientname,
+            "redis_key": component.redis_key,
+            "ticks": component.ticks,
+        }
+    )
+
+
+def write(pipeline, updates: Dict[str, str | None]):
+    """queue updates on a Redis pipeline; None removes the field"""
+    mapping = {field: value for field, value in updates.items() if value is not None}
+    removed = [field for field, value in updates.items() if value is None]
+    if mapping:
+        pipeline.hset(LOCATIONS_KEY, mapping=mapping)
+    if removed:
+        pipeline.hdel(LOCATIONS_KEY, *removed)
+
+
+class Located:
+    """Component mixin keeping the index of the planes it holds"""
+
+    def __init__(self, **kwargs):
+        self.plane_index = kwargs.pop("plane_index", PLANE_INDEX)
+        # index updates of the callback, field -> entry or None to remove
+        self.location_outbox: Dict[str, str | None] = {}
+        super().__init__(**kwargs)
+
+    def locate(self, plane, state: str):
+        """Record in the index that plane is here in state; written with the
+        events at the end of the callback"""
+        if self.plane_index and self.redis_client is not None:
+            value = entry(plane, state, self)
+            for field in fields(plane.plane_id, plane.flight_id):
+                self.location_outbox[field] = value
+            self.writes_held = True
+
+    def forget_location(self, plane):
+        """Remove a plane that left the simulation from the index"""
+        if self.plane_index and self.redis_client is not None:
+            for field in fields(plane.plane_id, plane.flight_id):
+                self.location_outbox[field] = None
+            self.writes_held = True
+
+    def queue_writes(self, pipeline):
+        """the index updates, after the events"""
+        super().queue_writes(pipeline)
+        updates, self.location_outbox = self.location_outbox, {}
+        if pipeline is not None:
+            write(pipeline, updates)
@@ -1,14 +1,13 @@
 """MQTT logger for the airport simulator."""
 
-import paho.mqtt.client as mqtt
-
 
 class Logger:
     """Logger class for the airport simulator."""
 
-    def __init__(self, name: str, mqtt_client: mqtt.Client, verbose: bool = False):
+    def __init__(self, name: str, publisher, verbose: bool = False):
+        """publisher is an mqtt client or anything else with publish(topic, str)"""
         self.name = name
-        self.mqtt_client = mqtt_client
+        self.publisher = publisher
         self.verbose = verbose
 
     def tag(self, message: str, tag: str) -> str:
@@ -20,7 +19,7 @@ class Logger:
         message = self.tag(message, self.name)
         if self.verbose:
             print(message)
-        self.mqtt_client.publish("logs", message)
+        self.publisher.publish("logs", message)
 
     def error(self, message: str):
         """Log an error message to the MQTT broker."""
@@ -0,0 +1,47 @@
+"""Component state that is only announced when it actually changes"""
+
+import os
+from enum import Enum
+from typing import Type
+
+# ticks without a state change after which a component repeats its state and
+# sequence number, so that the Airport can detect updates it missed
+STATE_SYNC_TICKS = int(os.environ.get("STATE_SYNC_TICKS", "20"))
+
+
+class ObservableState:
+    """Enum valued attribute of a component.
+
+    Assigning a different value bumps the owner's state_seq, records the tick
+    in state_announced_at and calls its notify method; assigning the current
+    value again does nothing, so idle components don't publish on every tick."""
+
+    def __init__(self, enum_class: Type[Enum], notify: str):
+        self.enum_class = enum_class
+        self.notify = notify
+        self.attribute = None
+
+    def __set_name__(self, owner, name: str):
+        self.attribute = "_" + name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return getattr(obj, self.attribute)
+
+    def __set__(self, obj, value):
+        new_value = self.enum_class(value)
+        if getattr(obj, self.attribute, None) is new_value:
+            return
+        setattr(obj, self.attribute, new_value)
+        obj.state_seq += 1
+        obj.state_announced_at = obj.ticks
+        getattr(obj, self.notify)()
+
+
+def state_sync_due(component) -> bool:
+    """Whether component has been quiet long enough to repeat its state"""
+    if component.ticks - component.state_announced_at < STATE_SYNC_TICKS:
+        return False
+    component.state_announced_at = component.ticks
+    return True
@@ -2,7 +2,10 @@
 
 from enum import Enum
 from uuid import uuid4
-import json
+import random
+import sys
+
+import tracing
 
 
 class PlaneState(Enum):
@@ -15,17 +18,84 @@ class PlaneState(Enum):
     CIRCLING = "circling"  # do we need this
     ON_ARRIVAL_RUNWAY = "on_arrival_runway"
     AT_ARRIVAL_GATE = "at_arrival_gate"
+    DIVERTED = "diverted"  # turned away by a full arrival queue; the flight ends
+
+
+PLANE_STATES = tuple(PlaneState)
+_STATE_INDEX = {state.value: index for index, state in enumerate(PLANE_STATES)}
+_STATE_BY_VALUE = {state.value: state for state in PLANE_STATES}
+
+
+def plane_record(data: dict) -> list | None:
+    """Positional record of a Plane dict for binary payloads.
+
+    The field order is fixed and the state is sent as its index in
+    PLANE_STATES, so the keys don't travel with every plane. Returns None when
+    the dict has fields the layout doesn't know about; callers then send the
+    plain dict."""
+    if len(data) != 8:
+        return None
+    try:
+        return [
+            data["plane_id"],
+            data["flight_id"],
+            data["start_airport"],
+            data["end_airport"],
+            data["start_gate"],
+            data["end_gate"],
+            _STATE_INDEX[data["state"]],
+            data["ticks_in_sky"],
+        ]
+    except KeyError:
+        return None
+
+
+def plane_from_record(record: list) -> dict:
+    """Inverse of plane_record"""
+    return {
+        "plane_id": record[0],
+        "flight_id": record[1],
+        "start_airport": record[2],
+        "end_airport": record[3],
+        "start_gate": record[4],
+        "end_gate": record[5],
+        "state": PLANE_STATES[record[6]].value,
+        "ticks_in_sky": record[7],
+    }
+
+
+def _intern(value: str | None) -> str | None:
+    """airport and gate names repeat across every plane, keep one copy of each"""
+    return value if value is None else sys.intern(value)
 
 
 class Plane:
     """Plane class for airport simulation."""
 
-    def __init__(self, start_airport: str, end_airport: str):
-        self.plane_id = str(uuid4().hex[:12])
-        self.flight_id = str(uuid4().hex[:12])
-
-        self.start_airport = start_airport
-        self.end_airport = end_airport
+    __slots__ = (
+        "plane_id",
+        "flight_id",
+        "start_airport",
+        "end_airport",
+        "start_gate",
+        "end_gate",
+        "state",
+        "ticks_in_sky",
+        "trace",
+    )
+
+    def __init__(
+        self, start_airport: str, end_airport: str, rng: random.Random | None = None
+    ):
+        if rng is None:
+            ids = uuid4().hex  # one uuid is enough random bits for both ids
+        else:  # reproducible ids for seeded runs
+            ids = f"{rng.getrandbits(96):024x}"
+        self.plane_id = ids[:12]
+        self.flight_id = ids[12:24]
+
+        self.start_airport = sys.intern(start_airport)
+        self.end_airport = sys.intern(end_airport)
 
         # do we need these?
         self.start_gate = None
@@ -35,9 +105,11 @@ class Plane:
 
         self.ticks_in_sky = -1  # filled by Sky when plane is in the sky
 
+        self.trace = None  # trace context of sampled flights, see tracing.py
+
     def to_dict(self):
         """Convert the Plane instance to a dictionary for MQTT messages."""
-        return {
+        data = {
             "plane_id": self.plane_id,
             "flight_id": self.flight_id,
             "start_airport": self.start_airport,
@@ -47,59 +119,66 @@ class Plane:
             "state": self.state.value,
             "ticks_in_sky": self.ticks_in_sky,
         }
+        if self.trace is not None:
+            data["trace"] = dict(self.trace)
+        return data
 
     @staticmethod
     def from_dict(data: dict):
         """Initialize the Plane instance from a dictionary."""
-        plane = Plane(data["start_airport"], data["end_airport"])
+        # skip __init__, the ids it would generate are overwritten anyway
+        plane = Plane.__new__(Plane)
         plane.plane_id = data["plane_id"]
         plane.flight_id = data.get("flight_id")
-        plane.start_gate = data["start_gate"]
-        plane.end_gate = data["end_gate"]
-        plane.state = PlaneState(data["state"])
+        plane.start_airport = sys.intern(data["start_airport"])
+        plane.end_airport = sys.intern(data["end_airport"])
+        plane.start_gate = _intern(data["start_gate"])
+        plane.end_gate = _intern(data["end_gate"])
+        plane.state = _STATE_BY_VALUE[data["state"]]
         plane.ticks_in_sky = data["ticks_in_sky"]
+        plane.trace = data.get("trace")
         return plane
 
-    def set_state(self, new_state: PlaneState, mqtt_client, ticks: int):
-        """on state changes, send state to dbwriter"""
-        mqtt_client.publish(
-            "events",
-            json.dumps(
-                {
-                    "event_type": "plane-event",
-                    "plane_id": self.plane_id,
-                    "flight_id": self.flight_id,
-                    "ticks": ticks,
-                    "from_state": self.state.value,
-                    "to_state": new_state.value,
-                }
-            ),
+    def set_state(self, new_state: PlaneState, publisher, ticks: int):
+        """on state changes, send state to dbwriter and the location index
+
+        publisher is the component handling the plane, see AirportComponent.publish_event
+        """
+        if self.trace is not None:
+            tracing.state_changed(publisher, self, self.state.value)
+        publisher.publish_event(
+            {
+                "event_type": "plane-event",
+                "plane_id": self.plane_id,
+                "flight_id": self.flight_id,
+                "ticks": ticks,
+                "from_state": self.state.value,
+                "to_state": new_state.value,
+            },
         )
+        if new_state in (PlaneState.IN_HANGAR, PlaneState.DIVERTED):  # flight ended
+            publisher.forget_location(self)
+        else:
+            publisher.locate(self, new_state.value)
         self.state = new_state
 
-    def init_flight(self, mqtt_client):
+    def init_flight(self, publisher):
         """update a flight for this plane"""
-        mqtt_client.publish(
-            "events",
-            json.dumps(
-                {
-                    "event_type": "init-flight",
-                    "flight_id": self.flight_id,
-                    "plane_id": self.plane_id,
-                }
-            ),
+        publisher.publish_event(
+            {
+                "event_type": "init-flight",
+                "flight_id": self.flight_id,
+                "plane_id": self.plane_id,
+            },
         )
 
-    def update_flight(self, mqtt_client, **kwargs):
+    def update_flight(self, publisher, **kwargs):
         """update a flight for this plane"""
-        mqtt_client.publish(
-            "events",
-            json.dumps(
-                {
-                    "event_type": "update-flight",
-                    "flight_id": self.flight_id,
-                    "plane_id": self.plane_id,
-                    **kwargs,
-                }
-            ),
+        publisher.publish_event(
+            {
+                "event_type": "update-flight",
+                "flight_id": self.flight_id,
+                "plane_id": self.plane_id,
+                **kwargs,
+            },
         )
@@ -1,27 +1,135 @@
-"""Program which continuously generates flights"""
+"""Program which continuously generates flights
 
-import time
+On every heartbeat the flights of the whole tick are drawn at once, either by
+a FlightSampler (Poisson counts per origin airport, destinations from a
+weighted origin-destination matrix) or from a Timetable file, and each origin
+airport gets one new_planes message listing the destinations of its flights.
+
+Airports publish the depth of their departure queue on queues/<airport>.
+While an airport's queue is at its capacity (or --max-queue) no new flights
+are generated there, and flights an airport deferred are offered again once
+it has room.
+"""
+
+import argparse
+import csv
 import json
-from random import random, randint
 import os
-import argparse
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import numpy as np
 import paho.mqtt.client as mqtt
 
+import codec
+
 MQTT_BROKER = os.environ.get("MQTT_BROKER", "localhost")
 
 
+class FlightSampler:
+    """Flights of a tick: Poisson counts per origin, destinations drawn from
+    the origin's row of an origin-destination weight matrix"""
+
+    def __init__(
+        self,
+        airports: List[str],
+        rates: List[float],
+        weights: Optional[List[List[float]]] = None,
+        seed: Optional[int] = None,
+    ):
+        self.airports = airports
+        self.rates = np.asarray(rates, dtype=float)
+        matrix = np.ones((len(airports), len(airports)))
+        if weights is not None:
+            matrix = np.array(weights, dtype=float)
+        np.fill_diagonal(matrix, 0)  # no flights to the origin itself
+        totals = matrix.sum(axis=1)
+        if np.any((totals == 0) & (self.rates > 0)):
+            raise ValueError("every origin with flights needs a destination weight")
+        # row-wise cumulative distribution ending at exactly 1
+        cumulative = np.cumsum(matrix, axis=1)
+        self.cumulative = cumulative / np.where(totals == 0, 1, totals)[:, None]
+        self.rng = np.random.default_rng(seed)
+
+    def sample(
+        self, tick: int  # pylint:disable=unused-argument
+    ) -> Dict[str, List[str]]:
+        """destinations of the tick's flights by origin airport"""
+        origins = np.repeat(np.arange(len(self.airports)), self.rng.poisson(self.rates))
+        if not origins.size:
+            return {}
+        draws = self.rng.random(origins.size)
+        destinations = (self.cumulative[origins] <= draws[:, None]).sum(axis=1)
+        flights = defaultdict(list)
+        for origin, destination in zip(origins.tolist(), destinations.tolist()):
+            flights[self.airports[origin]].append(self.airports[destination])
+        return dict(flights)
+
+
+class Timetable:
+    """Flights replayed from a CSV file with tick,origin,destination rows,
+    ticks counted from the generator's first heartbeat"""
+
+    def __init__(self, path: str, loop: bool = False):
+        self.flights: Dict[int, Dict[str, List[str]]] = defaultdict(
+            lambda: defaultdict(list)
+        )
+        with open(path, newline="", encoding="utf-8") as timetable_file:
+            for row in csv.DictReader(timetable_file):
+                self.flights[int(row["tick"])][row["origin"]].append(row["destination"])
+        self.period = max(self.flights, default=0) + 1 if loop else None
+        self.airports = sorted(
+            {airport for flights in self.flights.values() for airport in flights}
+        )
+
+    def sample(self, tick: int) -> Dict[str, List[str]]:
+        """the timetable's flights for tick by origin airport"""
+        if self.period:
+            tick %= self.period
+        return {
+            origin: list(destinations)
+            for origin, destinations in self.flights.get(tick, {}).items()
+        }
+
+
+def sampler_from_od_file(
+    path: str, airports: List[str], rate: float, seed: Optional[int]
+) -> FlightSampler:
+    """FlightSampler from a JSON file such as
+
+    {"rates": {"JFK": 2.0}, "weights": {"JFK": {"LAX": 3, "ORD": 1}}}
+
+    Airports without a rate use rate; origins without weights fly
+    everywhere with equal weight."""
+    with open(path, encoding="utf-8") as od_file:
+        od = json.load(od_file)
+    rates = [od.get("rates", {}).get(airport, rate) for airport in airports]
+    weights = []
+    for origin in airports:
+        row = od.get("weights", {}).get(origin)
+        weights.append(
+            [1.0 if row is None else row.get(airport, 0) for airport in airports]
+        )
+    return FlightSampler(airports, rates, weights, seed)
+
+
 class PlaneGenerator:
     """Generator class"""
 
-    def __init__(self, prob: float, airports: list[str]):
+    def __init__(self, sampler, max_queue: Optional[int] = None):
         """constructor"""
-        self.prob = prob
-        self.airports = airports
+        self.sampler = sampler
+        self.max_queue = max_queue
+        self.ticks = 0
+        self.queue_depths: Dict[str, int] = {}
+        self.queue_limits: Dict[str, int] = {}
+        self.deferred: Dict[str, List[str]] = defaultdict(list)
 
         self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, "PlaneGenerator")
         self.client.on_connect = self.on_connect
         self.client.message_callback_add("admin", self.on_admin)
         self.client.message_callback_add("heartbeat", self.on_heartbeat)
+        self.client.message_callback_add("queues/+", self.on_queue_depth)
         self.client.connect(MQTT_BROKER)
 
     def on_connect(
@@ -31,10 +139,34 @@ class PlaneGenerator:
         print("connected to mqtt broker")
         self.client.subscribe("admin")
         self.client.subscribe("heartbeat")
+        self.client.subscribe("queues/+")
 
     def on_heartbeat(self, mqtt_client: mqtt.Client, userdata, msg: mqtt.MQTTMessage):
         """listen for heartbeats"""
-        self.attempt_to_generate_flight()
+        self.generate_flights(self.ticks)
+        self.ticks += 1
+
+    def on_queue_depth(
+        self, mqtt_client: mqtt.Client, userdata, msg: mqtt.MQTTMessage
+    ):  # pylint:disable=unused-argument
+        """an airport reports its departure queue and hands back flights"""
+        try:
+            payload = codec.decode(msg.payload)
+        except ValueError:
+            print(f"received undecodable queue depth: [{msg.payload!r}]")
+            return
+        for message in codec.unbatch(payload):
+            if message.get("msg_type") != "queue_depth":
+                continue
+            airport = message["airport"]
+            self.queue_depths[airport] = message["depth"]
+            self.queue_limits[airport] = self.max_queue or message.get("capacity", 0)
+            self.deferred[airport].extend(message.get("deferred", []))
+
+    def throttled(self, airport: str) -> bool:
+        """whether airport's departure queue is full"""
+        limit = self.queue_limits.get(airport, self.max_queue)
+        return bool(limit) and self.queue_depths.get(airport, 0) >= limit
 
     def on_admin(
         self,
@@ -51,46 +183,77 @@ class PlaneGenerator:
         if message["command"] == "quit":
             self.client.disconnect()
 
-    def attempt_to_generate_flight(self):
-        """generate flight probabalistically"""
-        if random() < self.prob:
-            self.generate_flight()
-
-    def generate_flight(self):
-        """choose two airports at random and queue a flight between them"""
-        from_idx = randint(0, len(self.airports) - 1)
-        to_idx = randint(0, len(self.airports) - 1)
-        while to_idx == from_idx:
-            to_idx = randint(0, len(self.airports) - 1)
-
-        from_airport = self.airports[from_idx]
-        to_airport = self.airports[to_idx]
-
-        topic = f"airport/{from_airport}"
-        message = {"msg_type": "new_plane", "end_airport": to_airport}
-
-        self.client.publish(topic, json.dumps(message))
-        print(f"Created flight from {from_airport} to {to_airport}")
+    def generate_flights(self, tick: int):
+        """queue the tick's flights, one message per origin airport"""
+        flights = self.sampler.sample(tick)
+        deferred, self.deferred = self.deferred, defaultdict(list)
+        count = skipped = airports = 0
+        for from_airport in sorted(set(flights) | set(deferred)):
+            if self.throttled(from_airport):
+                # drop the new flights, keep the deferred ones for later
+                self.deferred[from_airport] = deferred.get(from_airport, [])
+                skipped += len(flights.get(from_airport, ()))
+                continue
+            to_airports = deferred.get(from_airport, []) + flights.get(from_airport, [])
+            if not to_airports:
+                continue
+            message = {"msg_type": "new_planes", "end_airports": to_airports}
+            self.client.publish(f"airport/{from_airport}", json.dumps(message))
+            count += len(to_airports)
+            airports += 1
+        if count:
+            print(f"Created {count} flights from {airports} airports")
+        if skipped:
+            print(f"Skipped {skipped} flights from airports with full queues")
 
 
 def main():
     """main"""
     parser = argparse.ArgumentParser(description="Flight generator")
     parser.add_argument(
-        "--prob", type=float, help="Probability of generating a flight", default=0.5
+        "--prob",
+        type=float,
+        help="Mean number of flights per tick over all airports",
+        default=0.5,
+    )
+    parser.add_argument(
+        "--rate", type=float, help="Mean number of flights per airport per tick"
+    )
+    parser.add_argument("--od", help="JSON file with per-airport rates and weights")
+    parser.add_argument("--timetable", help="CSV file of tick,origin,destination")
+    parser.add_argument(
+        "--loop", action="store_true", help="Repeat the timetable when it ends"
     )
-    parser.add_argument("airports", nargs="+")
+    parser.add_argument("--seed", type=int, help="Seed for the flight sampler")
+    parser.add_argument(
+        "--max-queue",
+        type=int,
+        help="Pause airports with this many planes waiting for a gate "
+        + "(default: the capacity they report)",
+    )
+    parser.add_argument("airports", nargs="*")
     args = parser.parse_args()
 
-    airports = list(set(args.airports))
+    if args.timetable:
+        sampler = Timetable(args.timetable, args.loop)
+        print(f"Replaying {args.timetable} for " + ",".join(sampler.airports))
+        PlaneGenerator(sampler, args.max_queue).client.loop_forever()
+        return
+
+    airports = sorted(set(args.airports))
     if len(airports) < 2:
         print("We need at least two distinct airports")
         return
 
-    print(f"Flight generation probability is {args.prob}")
+    rate = args.rate if args.rate is not None else args.prob / len(airports)
+    if args.od:
+        sampler = sampler_from_od_file(args.od, airports, rate, args.seed)
+    else:
+        sampler = FlightSampler(airports, [rate] * len(airports), seed=args.seed)
+    print(f"Mean flights per tick are {sampler.rates.sum():.2f}")
     print("Airports are " + ",".join(airports))
 
-    plane_generator = PlaneGenerator(args.prob, airports)
+    plane_generator = PlaneGenerator(sampler, args.max_queue)
     plane_generator.client.loop_forever()
 
 
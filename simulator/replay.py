@@ -0,0 +1,586 @@
+"""Replay a recorded run into Redis for the monitor
+
+Reads the plane events of a recorded run, either from the plane_events and
+flights tables (--sql, with CONNECTION_STRING) or from a file of events,
+one JSON object per line, as written by dbwriter.py --record. It rebuilds
+the airport-*, airport-*-gate-*, airport-*-runway-* and sky keys tick by
+tick, in the formats the components write, so airport-monitor can watch the
+run again. Only the keys a tick changed are written, in one pipeline.
+
+The source is read sequentially in large chunks (a server-side cursor for
+SQL) and only the planes currently in the world are held, so memory stays
+bounded however long the recording is. Gate and runway details that aren't
+in the events (ticks left, the runway's topic to notify) are not rebuilt;
+gates and runways appear once a plane used them, and with --sql a plane
+still in its first hangar only appears with its first event.
+
+--speed replays N times faster than the recorded heartbeat interval
+(--tick-seconds), 0 as fast as possible. With --checkpoints the replay state
+is saved every --checkpoint-every ticks, with the position in the source,
+so a later --from-tick starts from the nearest checkpoint instead of the
+beginning:
+
+    python replay.py --events events.jsonl --speed 10 --checkpoints ckpt/
+    python replay.py --events events.jsonl --from-tick 5000 --checkpoints ckpt/
+"""
+
+import argparse
+import glob
+import json
+import os
+import time
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+from urllib.parse import urlsplit, urlunsplit
+
+from redis import Redis
+
+import snapshot
+from airport import airport_redis_key
+from gate import gate_redis_key
+from plane import PlaneState
+from runway import runway_redis_key
+from sharding import SKY_SHARDS, sky_redis_key, sky_shard
+
+REDIS_BROKER = os.environ.get("REDIS_BROKER", "localhost")
+
+CHUNK = 1 << 20  # bytes read from an event file at a time
+ROWS = 10000  # rows fetched from the database at a time
+
+# order of the states in a flight; events of one tick are applied in it, as
+# the database keeps no order within a tick
+LIFECYCLE = {
+    state.value: position
+    for position, state in enumerate(
+        [
+            PlaneState.IN_HANGAR,
+            PlaneState.AT_DEPARTURE_GATE,
+            PlaneState.ON_DEPARTURE_RUNWAY,
+            PlaneState.IN_SKY,
+            PlaneState.CIRCLING,
+            PlaneState.ON_ARRIVAL_RUNWAY,
+            PlaneState.AT_ARRIVAL_GATE,
+        ]
+    )
+}
+# the flight ended, in the hangar after the arrival gate or diverted
+LANDED = len(LIFECYCLE)
+
+GATE_IN_USE = {
+    PlaneState.AT_DEPARTURE_GATE.value: "in-use-departing",
+    PlaneState.AT_ARRIVAL_GATE.value: "in-use-arriving",
+}
+RUNWAY_IN_USE = {
+    PlaneState.ON_DEPARTURE_RUNWAY.value: "in-use-departing",
+    PlaneState.ON_ARRIVAL_RUNWAY.value: "in-use-arriving",
+}
+
+# where a plane is: ("gate", airport, number), ("runway", airport, number),
+# ("hangar", airport), ("circling", airport) or ("flying",)
+Location = Tuple[str, ...]
+
+
+def lifecycle_position(event: dict) -> int:
+    """where an event's new state is in a flight"""
+    if (
+        event["to_state"] == PlaneState.IN_HANGAR.value
+        and event["from_state"] == PlaneState.AT_ARRIVAL_GATE.value
+    ) or event["to_state"] == PlaneState.DIVERTED.value:
+        return LANDED
+    return LIFECYCLE.get(event["to_state"], LANDED)
+
+
+class ReplayState:
+    """The world rebuilt from events: where each plane is, and the
+    components whose Redis keys need writing"""
+
+    def __init__(self, sky_shards: int = SKY_SHARDS):
+        self.sky_shards = sky_shards  # the sky is written as the shards would
+        self.planes: Dict[str, dict] = {}  # plane_id -> Plane.to_dict()
+        self.locations: Dict[str, Location] = {}  # plane_id -> where it is
+        self.flights: Dict[str, dict] = {}  # flight_id -> flights table columns
+        self.occupants: Dict[Location, Dict[str, None]] = {}  # ordered plane ids
+        self.gates: Dict[str, Set[str]] = {}  # airport -> gate numbers seen
+        self.runways: Dict[str, Set[str]] = {}
+        self.dirty: Set[Location] = set()
+        self.pending: List[dict] = []  # plane events of the current tick
+
+    def to_dict(self) -> dict:
+        """what a checkpoint holds"""
+        return {
+            "planes": self.planes,
+            "locations": {pid: list(loc) for pid, loc in self.locations.items()},
+            "flights": self.flights,
+            "gates": {airport: sorted(gates) for airport, gates in self.gates.items()},
+            "runways": {
+                airport: sorted(runways) for airport, runways in self.runways.items()
+            },
+        }
+
+    @staticmethod
+    def from_dict(data: dict) -> "ReplayState":
+        """restore from a checkpoint"""
+        state = ReplayState()
+        state.planes = data["planes"]
+        state.flights = data["flights"]
+        state.gates = {airport: set(gates) for airport, gates in data["gates"].items()}
+        state.runways = {
+            airport: set(runways) for airport, runways in data["runways"].items()
+        }
+        for plane_id, location in data["locations"].items():
+            state.place(plane_id, tuple(location))
+        return state
+
+    def flight_info(self, flight_id: str, plane_id: str, **columns):
+        """record flights table columns; a new flight waits in its hangar"""
+        flight = self.flights.setdefault(flight_id, {"plane_id": plane_id})
+        flight.update(
+            (column, value) for column, value in columns.items() if value is not None
+        )
+        if plane_id not in self.planes and flight.get("from_airport"):
+            self.planes[plane_id] = self.plane_dict(
+                plane_id, flight_id, PlaneState.IN_HANGAR.value
+            )
+            self.place(plane_id, ("hangar", flight["from_airport"]))
+
+    def plane_dict(self, plane_id: str, flight_id: str, state: str) -> dict:
+        """the plane as components serialise it"""
+        flight = self.flights.get(flight_id, {})
+        return {
+            "plane_id": plane_id,
+            "flight_id": flight_id,
+            "start_airport": flight.get("from_airport"),
+            "end_airport": flight.get("to_airport"),
+            "start_gate": flight.get("from_gate"),
+            "end_gate": flight.get("to_gate"),
+            "state": state,
+            "ticks_in_sky": -1,
+        }
+
+    def location_of(self, flight: dict, event: dict) -> Optional[Location]:
+        """where a plane is after an event; None once its flight ended"""
+        state = event["to_state"]
+        origin, destination = flight.get("from_airport"), flight.get("to_airport")
+        if lifecycle_position(event) == LANDED:
+            return None
+        if state == PlaneState.AT_DEPARTURE_GATE.value and flight.get("from_gate"):
+            return ("gate", origin, flight["from_gate"])
+        if state == PlaneState.ON_DEPARTURE_RUNWAY.value and flight.get("from_runway"):
+            return ("runway", origin, flight["from_runway"])
+        if state == PlaneState.IN_SKY.value:
+            return ("flying",)
+        if state == PlaneState.CIRCLING.value:
+            return ("circling", destination)
+        if state == PlaneState.ON_ARRIVAL_RUNWAY.value and flight.get("to_runway"):
+            return ("runway", destination, flight["to_runway"])
+        if state == PlaneState.AT_ARRIVAL_GATE.value and flight.get("to_gate"):
+            return ("gate", destination, flight["to_gate"])
+        return ("hangar", origin)  # a gate or runway we weren't told about
+
+    def place(self, plane_id: str, location: Optional[Location]):
+        """move a plane; None takes it out of the world"""
+        old = self.locations.pop(plane_id, None)
+        if old is not None:
+            self.occupants[old].pop(plane_id, None)
+            self.dirty.add(old)
+        if location is None:
+            return
+        self.locations[plane_id] = location
+        self.occupants.setdefault(location, {})[plane_id] = None
+        self.dirty.add(location)
+        if location[0] == "gate":
+            self.gates.setdefault(location[1], set()).add(location[2])
+        elif location[0] == "runway":
+            self.runways.setdefault(location[1], set()).add(location[2])
+
+    def end_tick(self):
+        """apply the plane events of the tick, in flight order"""
+        self.pending.sort(key=lifecycle_position)
+        for event in self.pending:
+            plane_id, flight_id = event["plane_id"], event["flight_id"]
+            flight = self.flights.get(flight_id, {})
+            location = self.location_of(flight, event)
+            if location is None:
+                self.place(plane_id, None)
+                self.planes.pop(plane_id, None)
+                self.flights.pop(flight_id, None)
+                continue
+            self.planes[plane_id] = self.plane_dict(
+                plane_id, flight_id, event["to_state"]
+            )
+            self.place(plane_id, location)
+        self.pending = []
+
+    def planes_at(self, location: Location) -> List[dict]:
+        """the planes at a location, in arrival order"""
+        return [self.planes[pid] for pid in self.occupants.get(location, ())]
+
+    def component_states(self, everything: bool = False) -> Dict[str, dict]:
+        """Redis key -> state of the components changed since the last call,
+        or of all of them"""
+        if everything:
+            self.dirty = set(self.occupants) | {("flying",)}
+            for airport, gates in self.gates.items():
+                self.dirty.update(("gate", airport, number) for number in gates)
+            for airport, runways in self.runways.items():
+                self.dirty.update(("runway", airport, number) for number in runways)
+            for airport in set(self.gates) | set(self.runways):
+                self.dirty.add(("hangar", airport))
+        dirty, self.dirty = self.dirty, set()
+        airports = {location[1] for location in dirty if len(location) > 1}
+        states = {}
+        for location in dirty:
+            if location[0] == "gate":
+                states[gate_redis_key(location[1], location[2])] = self.gate_state(
+                    *location[1:]
+                )
+            elif location[0] == "runway":
+                states[runway_redis_key(location[1], location[2])] = self.runway_state(
+                    *location[1:]
+                )
+        for airport in airports:
+            states[airport_redis_key(airport)] = self.airport_state(airport)
+        if any(location[0] in ("flying", "circling") for location in dirty):
+            states.update(self.sky_states())
+        return states
+
+    def gate_state(self, airport: str, number: str) -> dict:
+        """as Gate.to_dict"""
+        planes = self.planes_at(("gate", airport, number))
+        plane = planes[0] if planes else None
+        return {
+            "airport": airport,
+            "gate_number": number,
+            "current_plane": plane,
+            "state": GATE_IN_USE.get(plane["state"], "free") if plane else "free",
+            "ticks_till_exit": -1,
+            "registered": True,
+        }
+
+    def runway_state(self, airport: str, number: str) -> dict:
+        """as Runway.to_dict"""
+        planes = self.planes_at(("runway", airport, number))
+        plane = planes[0] if planes else None
+        return {
+            "airport": airport,
+            "runway_number": number,
+            "current_plane": plane,
+            "state": RUNWAY_IN_USE.get(plane["state"], "free") if plane else "free",
+            "ticks_till_exit": -1,
+            "registered": True,
+            "topic_to_notify_on_exit": None,
+        }
+
+    def airport_state(self, airport: str) -> dict:
+        """as Airport.to_dict"""
+        return {
+            "airport": airport,
+            "runways": {
+                number: self.runway_state(airport, number)["state"]
+                for number in sorted(self.runways.get(airport, ()), key=_number)
+            },
+            "gates": {
+                number: self.gate_state(airport, number)["state"]
+                for number in sorted(self.gates.get(airport, ()), key=_number)
+            },
+            "waiting_for_departure_gate": self.planes_at(("hangar", airport)),
+            "waiting_for_arrival_gate": [],
+            "waiting_for_departure_runway": [],
+            "waiting_for_arrival_runway": [],
+            "arrivals_waiting": len(self.occupants.get(("circling", airport), ())),
+        }
+
+    def sky_states(self) -> Dict[str, dict]:
+        """Redis key -> state of every Sky shard, as Sky.to_dict; planes are
+        with the shard owning their destination"""
+        shards = [
+            {"shard": shard, "plane_queues": {}, "planes_flying": []}
+            for shard in range(self.sky_shards)
+        ]
+        for location in sorted(self.occupants):
+            if location[0] == "circling":
+                shard = sky_shard(location[1], self.sky_shards)
+                shards[shard]["plane_queues"][location[1]] = self.planes_at(location)
+        for plane in self.planes_at(("flying",)):
+            shard = sky_shard(plane["end_airport"] or "", self.sky_shards)
+            shards[shard]["planes_flying"].append(plane)
+        return {
+            sky_redis_key(state["shard"], self.sky_shards): state for state in shards
+        }
+
+
+def _number(text: str):
+    """sort gate and runway numbers numerically where they are numbers"""
+    return (0, int(text), "") if text.isdigit() else (1, 0, text)
+
+
+class EventFile:
+    """Events recorded by dbwriter.py --record, one JSON object per line;
+    positions are byte offsets"""
+
+    name = "file"
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def events(self, position: int = 0) -> Iterator[Tuple[int, dict]]:
+        """(offset of the line, event) from position on"""
+        with open(self.path, "rb", buffering=CHUNK) as source:
+            source.seek(position)
+            while True:
+                offset = source.tell()
+                line = source.readline()
+                if not line:
+                    return
+                if line.strip():
+                    yield offset, json.loads(line)
+
+
+class EventTables:
+    """plane_events joined with flights, in tick order; positions are ticks"""
+
+    name = "sql"
+
+    QUERY = """
+        SELECT e.plane_id, e.flight_id, e.ticks, e.from_state, e.to_state,
+               f.from_airport, f.to_airport, f.from_gate, f.to_gate,
+               f.from_runway, f.to_runway
+        FROM plane_events e
+        LEFT JOIN flights f ON f.flight_id = e.flight_id AND f.plane_id = e.plane_id
+        WHERE e.ticks >= :start
+        ORDER BY e.ticks
+    """
+
+    def __init__(self, connection_string: str):
+        # sqlalchemy is only needed for this source
+        from sqlalchemy import (  # pylint:disable=import-outside-toplevel
+            create_engine,
+            text,
+        )
+
+        self.engine = create_engine(connection_string)
+        self.query = text(self.QUERY)
+
+    def events(self, position: int = 0) -> Iterator[Tuple[int, dict]]:
+        """(tick, event carrying its flight's columns) from tick position on"""
+        with self.engine.connect() as connection:
+            rows = connection.execution_options(
+                stream_results=True, yield_per=ROWS
+            ).execute(self.query, {"start": position})
+            for row in rows:
+                event = dict(row._mapping)  # pylint:disable=protected-access
+                event["event_type"] = "plane-event"
+                yield event["ticks"], event
+
+
+class Checkpoints:
+    """Replay states every few ticks, as replay-<tick>.ckpt files"""
+
+    def __init__(self, directory: str, every: int, source: str):
+        self.directory = directory
+        self.every = every
+        self.source = source
+        self.last = -1  # tick of the last checkpoint saved or loaded
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, tick: int) -> str:
+        """file of the checkpoint at tick"""
+        return os.path.join(self.directory, f"replay-{tick:010d}.ckpt")
+
+    def due(self, tick: int) -> bool:
+        """whether to save after tick, the first tick past a multiple of every"""
+        return self.every > 0 and tick // self.every > self.last // self.every
+
+    def save(self, tick: int, position, state: ReplayState):
+        """write the state after tick and where the source continues"""
+        data = {
+            "tick": tick,
+            "position": position,
+            "source": self.source,
+            **state.to_dict(),
+        }
+        with open(self.path(tick) + ".tmp", "wb") as output:
+            output.write(snapshot.dumps(data, "binary"))
+        os.replace(self.path(tick) + ".tmp", self.path(tick))
+        self.last = tick
+
+    def latest(self, tick: int) -> Optional[dict]:
+        """the last checkpoint of this source at or before tick"""
+        ticks = sorted(
+            int(os.path.basename(path)[7:-5])
+            for path in glob.glob(os.path.join(self.directory, "replay-*.ckpt"))
+        )
+        for candidate in reversed(ticks):
+            if candidate > tick:
+                continue
+            with open(self.path(candidate), "rb") as checkpoint:
+                data = snapshot.loads(checkpoint.read())
+            if data["source"] == self.source:
+                self.last = data["tick"]
+                return data
+        return None
+
+
+class Replayer:
+    """Feeds a source's events into a ReplayState and writes the changed
+    components to Redis at every tick"""
+
+    def __init__(self, source, redis: Redis, options: argparse.Namespace, checkpoints):
+        self.source = source
+        self.redis = redis
+        self.options = options
+        self.checkpoints = checkpoints
+        self.state = ReplayState()
+        self.ticks = 0
+        self.events = 0
+
+    def emit(self, everything: bool = False):
+        """write the components changed since the last write, or all of them"""
+        pipeline = self.redis.pipeline(transaction=False)
+        for key, value in self.state.component_states(everything).items():
+            pipeline.set(key, snapshot.dumps(value))
+        pipeline.execute()
+        self.ticks += 1
+
+    def run(self):
+        """replay until the source or --until-tick ends"""
+        position, tick = 0, None
+        if self.checkpoints and self.options.from_tick:
+            data = self.checkpoints.latest(self.options.from_tick)
+            if data:
+                self.state = ReplayState.from_dict(data)
+                position, tick = data["position"], data["tick"]
+                print(f"starting from the checkpoint at tick {tick}")
+        # ticks before --from-tick are applied without writes or waits
+        seeking = self.options.from_tick > (tick or 0)
+        if not seeking and tick is not None:
+            self.emit(everything=True)
+        speed = self.options.speed
+        interval = self.options.tick_seconds / speed if speed else 0
+        deadline = time.monotonic()
+
+        for offset, event in self.source.events(position):
+            event_tick = event.get("ticks")
+            if event_tick is not None and (tick is None or event_tick > tick):
+                if tick is not None:
+                    self.finish_tick(tick, offset, seeking)
+                if seeking and event_tick > self.options.from_tick:
+                    seeking = False
+                    self.emit(everything=True)
+                elif interval and tick is not None and not seeking:
+                    deadline += interval * (event_tick - tick)
+                    time.sleep(max(0.0, deadline - time.monotonic()))
+                if event_tick > self.options.until_tick:
+                    break
+                tick = event_tick
+            self.apply(event)
+        else:
+            if tick is not None:
+                self.finish_tick(tick, None, seeking)
+        if seeking:
+            self.emit(everything=True)
+
+    def apply(self, event: dict):
+        """take in one event"""
+        self.events += 1
+        event_type = event["event_type"]
+        if event_type == "plane-event":
+            if "from_airport" in event:  # a database row carries its flight
+                self.state.flight_info(
+                    event["flight_id"],
+                    event["plane_id"],
+                    **{
+                        column: event[column]
+                        for column in (
+                            "from_airport",
+                            "to_airport",
+                            "from_gate",
+                            "to_gate",
+                            "from_runway",
+                            "to_runway",
+                        )
+                    },
+                )
+            self.state.pending.append(event)
+        elif event_type in ("init-flight", "update-flight"):
+            columns = {
+                key: value
+                for key, value in event.items()
+                if key not in ("event_type", "flight_id", "plane_id")
+            }
+            self.state.flight_info(event["flight_id"], event["plane_id"], **columns)
+
+    def finish_tick(self, tick: int, position, seeking: bool):
+        """apply and write a tick, and checkpoint it if due"""
+        self.state.end_tick()
+        if seeking:
+            self.state.component_states()  # only clears what changed
+        else:
+            self.emit()
+        if self.checkpoints and position is not None and self.checkpoints.due(tick):
+            self.checkpoints.save(tick, position, self.state)
+
+
+def without_password(connection_string: str) -> str:
+    """the connection string with its password left out, to name the source
+    in checkpoints"""
+    parts = urlsplit(connection_string)
+    if parts.password is None:
+        return connection_string
+    host = parts.netloc.rpartition("@")[2]
+    return urlunsplit(parts._replace(netloc=f"{parts.username}@{host}"))
+
+
+def main():
+    """main"""
+    parser = argparse.ArgumentParser(description="Replay a recorded run into Redis")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--events", help="file written by dbwriter.py --record")
+    source.add_argument(
+        "--sql",
+        action="store_true",
+        help="read plane_events and flights from CONNECTION_STRING",
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1,
+        help="times faster than recorded; 0 replays as fast as possible",
+    )
+    parser.add_argument(
+        "--tick-seconds",
+        type=float,
+        default=1.0,
+        help="heartbeat interval of the recorded run",
+    )
+    parser.add_argument("--from-tick", type=int, default=0)
+    parser.add_argument("--until-tick", type=int, default=2**62)
+    parser.add_argument("--checkpoints", help="directory of replay checkpoints")
+    parser.add_argument("--checkpoint-every", type=int, default=500, help="ticks")
+    args = parser.parse_args()
+
+    if args.sql:
+        connection_string = os.environ.get("CONNECTION_STRING")
+        if not connection_string:
+            print("CONNECTION_STRING environment variable must be set")
+            return
+        events = EventTables(connection_string)
+        name = f"sql:{without_password(connection_string)}"
+    else:
+        events = EventFile(args.events)
+        name = f"file:{os.path.abspath(args.events)}"
+    checkpoints = (
+        Checkpoints(args.checkpoints, args.checkpoint_every, name)
+        if args.checkpoints
+        else None
+    )
+    replayer = Replayer(events, Redis(host=REDIS_BROKER, port=6379), args, checkpoints)
+    start = time.monotonic()
+    replayer.run()
+    print(
+        f"replayed {replayer.events} events over {replayer.ticks} ticks "
+        + f"in {time.monotonic() - start:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,61 @@
 """Functions for restorable objects"""
 
 import argparse
-import json
+from typing import List, Tuple
 from redis import Redis
 
+import inputlog
+import snapshot
+
 
 def construct_or_restore(
-    cls, redis_client: Redis, redis_key: str, arguments: argparse.Namespace
+    cls, redis_client: Redis, redis_key: str, arguments: argparse.Namespace, **kwargs
 ):
     """Construct a Runway instance or restore from a saved state."""
     saved_state = redis_client.get(redis_key)
     if saved_state:
         print("Restoring saved state from Redis...")
-        obj = cls.from_dict(json.loads(saved_state.decode()), verbose=arguments.verbose)
+        obj = cls.from_dict(
+            snapshot.loads(saved_state), verbose=arguments.verbose, **kwargs
+        )
+        logged = inputlog.replay(
+            obj,
+            redis_client.get(inputlog.rng_key(redis_key)),
+            redis_client.lrange(inputlog.log_key(redis_key), 0, -1),
+        )
+        if logged:
+            print(f"Replayed {logged} logged messages")
     else:
         obj = cls.from_dict(
             cls.args_to_dict(arguments),
             verbose=arguments.verbose,
+            **kwargs,
         )
     obj.redis_client = redis_client
     return obj
+
+
+def construct_or_restore_many(
+    specs: List[Tuple[type, str, argparse.Namespace]], redis_client: Redis, **kwargs
+) -> list:
+    """construct_or_restore for (cls, redis_key, arguments) triples, fetching
+    all saved states in one round trip and their logs in another"""
+    saved_states = redis_client.mget([redis_key for _, redis_key, _ in specs])
+    pipeline = redis_client.pipeline(transaction=False)
+    for (_, redis_key, _), saved_state in zip(specs, saved_states):
+        if saved_state:
+            pipeline.get(inputlog.rng_key(redis_key))
+            pipeline.lrange(inputlog.log_key(redis_key), 0, -1)
+    logs = iter(pipeline.execute())
+    objs = []
+    for (cls, _, arguments), saved_state in zip(specs, saved_states):
+        if saved_state:
+            data = snapshot.loads(saved_state)
+        else:
+            data = cls.args_to_dict(arguments)
+        obj = cls.from_dict(data, verbose=arguments.verbose, **kwargs)
+        if saved_state:
+            inputlog.replay(obj, next(logs), next(logs))
+        obj.redis_client = redis_client
+        objs.append(obj)
+    return objs
@@ -1,16 +1,18 @@
 """Runway module for handling plane arrivals and sending them to gates."""
 
-import json
-import random
 import os
 from enum import Enum
+from functools import cached_property
 
 import argparse
 from redis import Redis
 
 from restorable import construct_or_restore
-from airportcomponent import AirportComponent
+from airportcomponent import handles
+from features import Component
+from observable import ObservableState, state_sync_due
 from plane import Plane, PlaneState
+from sharding import sky_topic_for
 
 REDIS_BROKER = os.environ.get("REDIS_BROKER", "localhost")
 
@@ -28,12 +30,14 @@ def runway_redis_key(airport: str, runway_number: str):
     return f"airport-{airport}-runway-{runway_number}"
 
 
-class Runway(AirportComponent):
+class Runway(Component):
     """Representation of a runway at an airport."""
 
     RUNWAY_MIN_TICKS = 3  # Minimum ticks a plane stays on the runway
     RUNWAY_MAX_TICKS = 10
 
+    logged_attributes = ("state_announced_at",)
+
     @staticmethod
     def args_to_dict(arguments: argparse.Namespace) -> dict:
         """Convert command line arguments to a state dictionary."""
@@ -42,57 +46,58 @@ class Runway(AirportComponent):
             "runway_number": arguments.runway_number,
         }
 
-    @property
+    @cached_property
     def airport_topic(self):
         """Return the MQTT topic for the airport"""
         return f"airport/{self.airport}"
 
-    @property
+    @cached_property
     def mqtt_topic(self):
         """Return the MQTT topic for this runway."""
         return f"airport/{self.airport}/runway/{self.runway_number}"
 
-    @property
+    @cached_property
     def mqttclientname(self):
         """Name of the MQTT client we will create"""
         return f"Airport_{self.airport}_Runway_{self.runway_number}"
 
-    @property
+    @cached_property
     def redis_key(self) -> str:
         """Name of key for redis storage"""
         return runway_redis_key(self.airport, self.runway_number)
 
-    @property
+    @cached_property
     def loggername(self) -> str:
         """Name of the logger"""
         return f"{self.airport} Runway {self.runway_number}"
 
-    @property
-    def state(self) -> RunwayState:
-        """runway state"""
-        return self._state
-
-    @state.setter
-    def state(self, newstate: str):
-        """runway state"""
-        self._state = RunwayState(newstate)
-        self.update_runway_state_to_airport()
+    state = ObservableState(RunwayState, notify="update_runway_state_to_airport")
 
     def on_child_connect(self):
         """called by airportcomponent.on_connect"""
-        self.client.publish(
+        if self.registered:  # the airport knows us already, e.g. pre-seeded
+            return
+        self.publish(
             self.airport_topic,
-            json.dumps(
-                {"msg_type": "register_runway", "runway_number": self.runway_number}
-            ),
+            {
+                "msg_type": "register_runway",
+                "runway_number": self.runway_number,
+                "seq": self.state_seq,
+            },
         )
+        self.registered = True
 
-    def __init__(self, airport: str, runway_number: str, **kwargs):
+    def __init__(
+        self, airport: str, runway_number: str, registered: bool = False, **kwargs
+    ):
         """Runway listens for planes arriving and sends them to gates after 3 ticks."""
         self.airport = airport
         self.runway_number = runway_number
         self.current_plane = None
         self._state = RunwayState.FREE
+        self.state_seq = 0  # bumped on every state transition
+        self.state_announced_at = 0
+        self.registered = registered
         self.ticks_till_exit = -1
         self.topic_to_notify_on_exit = None
 
@@ -108,34 +113,56 @@ class Runway(AirportComponent):
             ),
             "state": self.state.value,
             "ticks_till_exit": self.ticks_till_exit,
+            "registered": self.registered,
             "topic_to_notify_on_exit": self.topic_to_notify_on_exit,
+            "state_seq": self.state_seq,
         }
 
     @staticmethod
     def from_dict(data, **kwargs):
         """Load the Runway state from a JSON representation."""
-        restored_runway = Runway(data["airport"], data["runway_number"], **kwargs)
+        restored_runway = Runway(
+            data["airport"],
+            data["runway_number"],
+            registered=data.get("registered", False),
+            **kwargs,
+        )
         if data.get("current_plane"):
             restored_runway.current_plane = Plane.from_dict(data["current_plane"])
         restored_runway.ticks_till_exit = data.get("ticks_till_exit", -1)
         restored_runway.topic_to_notify_on_exit = data.get("topic_to_notify_on_exit")
         if "state" in data:
             restored_runway.state = RunwayState(data["state"])
+        # continued, or the airport could take a new state for one it has seen
+        restored_runway.state_seq = data.get("state_seq", 0)
         return restored_runway
 
     def update_runway_state_to_airport(self):
         """Let the Airport know the runway state"""
-        self.client.publish(
+        self.publish(
             self.airport_topic,
-            json.dumps(
-                {
-                    "msg_type": "runway_update",
-                    "runway_number": self.runway_number,
-                    "runway_state": self.state.value,
-                }
-            ),
+            {
+                "msg_type": "runway_update",
+                "runway_number": self.runway_number,
+                "runway_state": self.state.value,
+                "seq": self.state_seq,
+            },
+        )
+
+    def sync_runway_state_to_airport(self):
+        """Periodically send the state sequence number, so that the Airport
+        can tell whether it missed an update"""
+        self.publish(
+            self.airport_topic,
+            {
+                "msg_type": "runway_sync",
+                "runway_number": self.runway_number,
+                "runway_state": self.state.value,
+                "seq": self.state_seq,
+            },
         )
 
+    @handles("plane_arrival", "plane")
     def handle_plane_arriving(self, plane: dict):
         """Handle the landing of a plane"""
         if self.current_plane:
@@ -143,33 +170,32 @@ class Runway(AirportComponent):
                 f"Plane {plane['plane_id']} arrived but runway "
                 + f"is occupied by {self.current_plane.plane_id}",
             )
+            self.update_runway_state_to_airport()  # the Airport thought we were free
             return
         if self.state != RunwayState.FREE:
             self.error("Runway in use")
+            self.update_runway_state_to_airport()
             return
 
         self.current_plane = Plane.from_dict(plane)
-        self.ticks_till_exit = random.randint(
+        self.ticks_till_exit = self.rng.randint(
             Runway.RUNWAY_MIN_TICKS, Runway.RUNWAY_MAX_TICKS
         )
-        self.current_plane.set_state(
-            PlaneState.ON_ARRIVAL_RUNWAY, self.client, self.ticks
-        )
-        self.current_plane.update_flight(self.client, to_runway=self.runway_number)
+        self.current_plane.set_state(PlaneState.ON_ARRIVAL_RUNWAY, self, self.ticks)
+        self.current_plane.update_flight(self, to_runway=self.runway_number)
         self.state = RunwayState.IN_USE_ARRIVING
         self.topic_to_notify_on_exit = None  # don't have a gate yet
 
-        self.client.publish(
+        self.publish(
             self.airport_topic,
-            json.dumps(
-                {
-                    "msg_type": "requesting_arrival_gate",
-                    "runway_topic": self.mqtt_topic,
-                }
-            ),
+            {
+                "msg_type": "requesting_arrival_gate",
+                "runway_topic": self.mqtt_topic,
+            },
         )
         self.log(f"Plane {plane['plane_id']} arrived on runway, waiting for gate")
 
+    @handles("arrival_gate_assigned", "gate_topic", "gate_number")
     def handle_arrival_gate_assigned(self, gate_topic: str, gate_number: str):
         """Handle the assignment of an arrival gate"""
         self.topic_to_notify_on_exit = gate_topic
@@ -183,37 +209,21 @@ class Runway(AirportComponent):
         else:
             self.log("No plane on runway to advance")
 
+    @handles("plane_departing", "plane")
     def handle_plane_departing(self, plane: dict):
         """Handle a plane departing from this runway"""
         if self.state != RunwayState.FREE:
             self.error("Runway in use")
+            self.update_runway_state_to_airport()
             return
         self.state = RunwayState.IN_USE_DEPARTING
         self.current_plane = Plane.from_dict(plane)
-        self.current_plane.set_state(
-            PlaneState.ON_DEPARTURE_RUNWAY, self.client, self.ticks
-        )
-        self.current_plane.update_flight(self.client, from_runway=self.runway_number)
-        self.ticks_till_exit = random.randint(
+        self.current_plane.set_state(PlaneState.ON_DEPARTURE_RUNWAY, self, self.ticks)
+        self.current_plane.update_flight(self, from_runway=self.runway_number)
+        self.ticks_till_exit = self.rng.randint(
             Runway.RUNWAY_MIN_TICKS, Runway.RUNWAY_MAX_TICKS
         )
-        self.topic_to_notify_on_exit = "sky"
-
-    def handle_message(self, message: dict):
-        """Handle plane arrivals on the runway."""
-        if message["msg_type"] == "plane_arrival":
-            if self.validate_message(["plane"], message):
-                self.handle_plane_arriving(message["plane"])
-
-        elif message["msg_type"] == "arrival_gate_assigned":
-            if self.validate_message(["gate_topic", "gate_number"], message):
-                self.handle_arrival_gate_assigned(
-                    message["gate_topic"], message["gate_number"]
-                )
-
-        elif message["msg_type"] == "plane_departing":
-            if self.validate_message(["plane"], message):
-                self.handle_plane_departing(message["plane"])
+        self.topic_to_notify_on_exit = sky_topic_for(self.current_plane.end_airport)
 
     def advance_plane(self):
         """Advance the plane on the runway, check if it can be sent to a gate."""
@@ -240,27 +250,23 @@ class Runway(AirportComponent):
             return
 
         if self.state == RunwayState.IN_USE_DEPARTING:
-            self.client.publish(
+            self.publish(
                 self.topic_to_notify_on_exit,
-                json.dumps(
-                    {
-                        "msg_type": "plane_departure",
-                        "plane": self.current_plane.to_dict(),
-                    }
-                ),
+                {
+                    "msg_type": "plane_departure",
+                    "plane": self.current_plane.to_dict(),
+                },
             )
             self.topic_to_notify_on_exit = None
             self.current_plane = None
 
         if self.state == RunwayState.IN_USE_ARRIVING and self.topic_to_notify_on_exit:
-            self.client.publish(
+            self.publish(
                 self.topic_to_notify_on_exit,
-                json.dumps(
-                    {
-                        "msg_type": "arriving_plane",
-                        "plane": self.current_plane.to_dict(),
-                    }
-                ),
+                {
+                    "msg_type": "arriving_plane",
+                    "plane": self.current_plane.to_dict(),
+                },
             )
             self.log(
                 f"Sent plane {self.current_plane.plane_id} to {self.topic_to_notify_on_exit}"
@@ -279,6 +285,9 @@ class Runway(AirportComponent):
             self.log("Ready for next plane")
             self.state = RunwayState.FREE
 
+        if state_sync_due(self):
+            self.sync_runway_state_to_airport()
+
 
 if __name__ == "__main__":
     redis_client = Redis(host=REDIS_BROKER, port=6379)
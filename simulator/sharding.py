@@ -0,0 +1,133 @@
+"""Partitioning of work over several processes
+
+Sky: with SKY_SHARDS=N (default 1) the sky runs as N processes. Each one owns the
+airports that a consistent hash ring maps to it and listens on its own topic,
+sky/<shard>, with its own Redis key. Departing runways and landing airports
+route by destination airport with sky_topic_for(), which every process
+computes the same way. When N changes only about 1/N of the airports move;
+a restarted shard hands the planes it no longer owns to their new owner, and
+shard 0 takes over the planes of shards that were removed.
+
+With a single shard the original names ("sky" topic and Redis key, "Sky"
+client) are kept.
+
+Events: with EVENT_PARTITIONS=N (default 1) plane events are published to
+events/<partition>, chosen by a hash of the flight id, so every event of a
+flight goes to the same DBWriter consumer, in order. With one partition they
+stay on "events". The Redis stream transport uses the same partitions, as
+streams named events or events-<partition>.
+"""
+
+import bisect
+import hashlib
+import os
+import zlib
+from functools import lru_cache
+from typing import List
+
+SKY_SHARDS = int(os.environ.get("SKY_SHARDS", "1"))
+EVENT_PARTITIONS = int(os.environ.get("EVENT_PARTITIONS", "1"))
+
+VIRTUAL_NODES = 64  # points per shard on the ring; evens out the partitions
+
+
+def _hash(key: str) -> int:
+    """Stable 64 bit hash (str hashes are salted per process)"""
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent hash ring mapping keys to shard numbers"""
+
+    def __init__(self, shards: int, virtual_nodes: int = VIRTUAL_NODES):
+        points = sorted(
+            (_hash(f"sky-{shard}-{node}"), shard)
+            for shard in range(shards)
+            for node in range(virtual_nodes)
+        )
+        self.hashes: List[int] = [point for point, _ in points]
+        self.shards: List[int] = [shard for _, shard in points]
+
+    def shard_for(self, key: str) -> int:
+        """The shard owning key"""
+        index = bisect.bisect(self.hashes, _hash(key)) % len(self.hashes)
+        return self.shards[index]
+
+
+@lru_cache(maxsize=None)
+def _ring(shards: int) -> HashRing:
+    """ring for a shard count, built once"""
+    return HashRing(shards)
+
+
+@lru_cache(maxsize=65536)
+def sky_shard(airport: str, shards: int = SKY_SHARDS) -> int:
+    """The Sky shard that owns planes flying to airport"""
+    if shards <= 1:
+        return 0
+    return _ring(shards).shard_for(airport)
+
+
+def _legacy(shard: int, shards: int) -> bool:
+    """a single shard keeps the names from before sharding"""
+    return shard == 0 and shards <= 1
+
+
+def sky_topic(shard: int, shards: int = SKY_SHARDS) -> str:
+    """MQTT topic of a Sky shard"""
+    return "sky" if _legacy(shard, shards) else f"sky/{shard}"
+
+
+def sky_client_name(shard: int, shards: int = SKY_SHARDS) -> str:
+    """MQTT client name of a Sky shard"""
+    return "Sky" if _legacy(shard, shards) else f"Sky_{shard}"
+
+
+def sky_redis_key(shard: int, shards: int = SKY_SHARDS) -> str:
+    """Redis key of a Sky shard"""
+    return "sky" if _legacy(shard, shards) else f"sky-{shard}"
+
+
+def sky_topic_for(airport: str) -> str:
+    """MQTT topic of the Sky shard handling planes flying to airport"""
+    return sky_topic(sky_shard(airport))
+
+
+def event_partition(flight_id: str, partitions: int = EVENT_PARTITIONS) -> int:
+    """Partition of the events of a flight"""
+    return zlib.crc32(flight_id.encode()) % partitions
+
+
+def event_topic(flight_id: str, partitions: int = EVENT_PARTITIONS) -> str:
+    """MQTT topic for the events of a flight"""
+    if partitions <= 1:
+        return "events"
+    return f"events/{event_partition(flight_id, partitions)}"
+
+
+def event_topics_for_consumer(
+    consumer: int, consumers: int, partitions: int = EVENT_PARTITIONS
+) -> List[str]:
+    """Event topics read by one of several consumers sharing the partitions"""
+    if partitions <= 1:
+        return ["events"] if consumer == 0 else []
+    return [
+        f"events/{partition}"
+        for partition in range(partitions)
+        if partition % consumers == consumer
+    ]
+
+
+def event_stream(flight_id: str, partitions: int = EVENT_PARTITIONS) -> str:
+    """Redis stream for the events of a flight"""
+    return event_topic(flight_id, partitions).replace("/", "-")
+
+
+def event_streams_for_consumer(
+    consumer: int, consumers: int, partitions: int = EVENT_PARTITIONS
+) -> List[str]:
+    """Redis streams read by one of several consumers sharing the partitions"""
+    return [
+        topic.replace("/", "-")
+        for topic in event_topics_for_consumer(consumer, consumers, partitions)
+    ]
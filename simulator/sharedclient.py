@@ -0,0 +1,165 @@
+"""Many components on one MQTT connection
+
+Components take a `broker=SharedConnection(...)` keyword argument, like they
+take a LocalBroker, and then publish and subscribe through one paho client
+instead of opening a connection each. launch.py uses it to run thousands of
+gates and runways in a few host processes. A subscription that several
+components share, such as heartbeat, is made once and fanned out. A
+component that disconnects, e.g. on the admin quit command, only drops its
+own callbacks and the subscriptions no other component shares; the
+connection closes with its last component.
+"""
+
+import os
+from typing import Callable, Dict, List, Optional, Set
+
+import paho.mqtt.client as mqtt
+
+MQTT_BROKER = os.environ.get("MQTT_BROKER", "localhost")
+
+SUBSCRIBE_CHUNK = 500  # topics per SUBSCRIBE packet
+
+
+class SharedClient:
+    """paho.mqtt.client.Client look-alike bound to a SharedConnection"""
+
+    def __init__(self, connection: "SharedConnection", client_id: str):
+        self.connection = connection
+        self.client_id = client_id
+        self.on_connect = None
+        self.on_message = None
+        self.userdata = None
+        self.topics: Set[str] = set()
+        self.subs: Set[str] = set()  # with a callback
+
+    def user_data_set(self, userdata):
+        """same as paho"""
+        self.userdata = userdata
+
+    def connect(self, *args, **kwargs):  # pylint:disable=unused-argument
+        """calls on_connect once the shared connection is up"""
+        self.connection.attach(self)
+
+    def disconnect(self):
+        """stop receiving messages; the last component closes the connection"""
+        self.connection.detach(self)
+
+    def subscribe(self, topic: str, qos: int = 0):  # pylint:disable=unused-argument
+        """same as paho"""
+        self.topics.add(topic)
+        self.connection.subscribe(topic, self)
+
+    def message_callback_add(self, sub: str, callback: Callable):
+        """same as paho"""
+        self.subs.add(sub)
+        self.connection.add_callback(sub, self, callback)
+
+    def publish(self, topic: str, payload=None, qos=0, retain=False):
+        """same as paho"""
+        return self.connection.mqtt_client.publish(topic, payload, qos, retain)
+
+    def loop_forever(self):
+        """run the shared connection's network loop"""
+        self.connection.mqtt_client.loop_forever()
+
+
+class SharedConnection:
+    """One paho client shared by the components of a process"""
+
+    def __init__(self, client_id: str, broker_host: str = MQTT_BROKER):
+        self.mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id)
+        self.mqtt_client.on_connect = self.on_connect
+        self.connected = False
+        self.holding_subscriptions = False  # see on_connect
+        self.waiting: List[SharedClient] = []
+        self.attached: Set[SharedClient] = set()
+        # topic -> the components subscribed to it
+        self.topics: Dict[str, Set[SharedClient]] = {}
+        # called once everything is subscribed, e.g. to announce readiness
+        self.on_ready: Optional[Callable] = None
+        self.callbacks: Dict[str, Dict[SharedClient, Callable]] = {}
+        self.mqtt_client.connect(broker_host)
+
+    def client(self, client_id: str) -> SharedClient:
+        """what a component uses as its client, as with LocalBroker"""
+        return SharedClient(self, client_id)
+
+    def attach(self, shared_client: SharedClient):
+        """connect a component, now or once the connection is up"""
+        self.attached.add(shared_client)
+        if self.connected:
+            shared_client.on_connect(
+                shared_client, shared_client.userdata, None, 0, None
+            )
+        else:
+            self.waiting.append(shared_client)
+
+    def subscribe(self, topic: str, shared_client: SharedClient):
+        """subscribe once per topic"""
+        subscribed = topic in self.topics
+        self.topics.setdefault(topic, set()).add(shared_client)
+        if not subscribed and self.connected and not self.holding_subscriptions:
+            self.mqtt_client.subscribe(topic)
+
+    def add_callback(self, sub: str, shared_client: SharedClient, callback: Callable):
+        """register a component's callback, fanning out shared subscriptions"""
+        if sub not in self.callbacks:
+            self.mqtt_client.message_callback_add(sub, self.fan_out(sub))
+        self.callbacks.setdefault(sub, {})[shared_client] = callback
+
+    def detach(self, shared_client: SharedClient):
+        """Disconnect a component: remove its callbacks and the subscriptions
+        no other component has, and close the connection if it was the last"""
+        self.attached.discard(shared_client)
+        if shared_client in self.waiting:
+            self.waiting.remove(shared_client)
+        for sub in shared_client.subs:
+            callbacks = self.callbacks[sub]
+            callbacks.pop(shared_client, None)
+            if not callbacks:
+                del self.callbacks[sub]
+                self.mqtt_client.message_callback_remove(sub)
+        for topic in shared_client.topics:
+            subscribers = self.topics[topic]
+            subscribers.discard(shared_client)
+            if not subscribers:
+                del self.topics[topic]
+                if self.connected:
+                    self.mqtt_client.unsubscribe(topic)
+        shared_client.subs, shared_client.topics = set(), set()
+        if not self.attached:
+            self.mqtt_client.disconnect()
+
+    def fan_out(self, sub: str) -> Callable:
+        """paho callback delivering a message to every component on sub"""
+
+        def deliver(client, userdata, msg):  # pylint:disable=unused-argument
+            # a copy: components may disconnect while handling the message
+            for shared_client, callback in tuple(self.callbacks.get(sub, {}).items()):
+                callback(shared_client, shared_client.userdata, msg)
+
+        return deliver
+
+    def on_connect(
+        self, client, userdata, connect_flags, reason_code, properties
+    ):  # pylint:disable=unused-argument
+        """connect the waiting components; resubscribe after a reconnect.
+
+        What the components subscribe to while connecting is sent in a few
+        SUBSCRIBE packets rather than one per topic."""
+        if reason_code != 0:
+            raise RuntimeError("failed to connect to mqtt broker")
+        self.connected = True
+        self.holding_subscriptions = True
+        waiting, self.waiting = self.waiting, []
+        for shared_client in waiting:
+            shared_client.on_connect(
+                shared_client, shared_client.userdata, None, 0, None
+            )
+        self.holding_subscriptions = False
+        topics = sorted(self.topics)
+        for start in range(0, len(topics), SUBSCRIBE_CHUNK):
+            chunk = topics[start : start + SUBSCRIBE_CHUNK]
+            self.mqtt_client.subscribe([(topic, 0) for topic in chunk])
+        if self.on_ready:
+            self.on_ready()
@@ -1,61 +1,108 @@
 """Airport Simulation using MQTT"""
 
 import os
-import json
 from typing import List, Dict
-import random
+from functools import cached_property
 import argparse
 from redis import Redis
 
+from admission import DEFER, BoundedQueue, queue_limits
 from restorable import construct_or_restore
-from airportcomponent import AirportComponent
+from airportcomponent import handles
+from features import Component
+from inputlog import drop_log
+from localbroker import LocalBroker
+from metrics import Registry
 from plane import Plane, PlaneState
+from sharding import (
+    SKY_SHARDS,
+    sky_client_name,
+    sky_redis_key,
+    sky_shard,
+    sky_topic,
+    sky_topic_for,
+)
 
 REDIS_BROKER = os.environ.get("REDIS_BROKER", "localhost")
+ARRIVAL_QUEUE_CAPACITY, ARRIVAL_QUEUE_POLICY = queue_limits("ARRIVAL_QUEUE")
 
 
-class Sky(AirportComponent):
+def retired_shard_keys(redis_client: Redis, shards: int = SKY_SHARDS) -> List[str]:
+    """Redis keys of Sky shards that SKY_SHARDS no longer runs, left by a
+    run with more shards (or with one, whose key is "sky")"""
+    current = {sky_redis_key(shard, shards) for shard in range(shards)}
+    keys = [key.decode() for key in redis_client.scan_iter(match="sky-*")]
+    keys = [key for key in keys if key[len("sky-") :].isdigit()]
+    if redis_client.exists("sky"):
+        keys.append("sky")
+    return sorted(key for key in keys if key not in current)
+
+
+class Sky(Component):
     """Representation of the sky where planes fly."""
 
+    FLIGHT_MIN_TICKS = 5  # Minimum ticks a plane flies before circling
+    FLIGHT_MAX_TICKS = 10
+
+    logged_attributes = ("announced_waiting",)
+
     @staticmethod
     def args_to_dict(arguments: argparse.Namespace) -> dict:
         """Convert command line arguments to a state dictionary."""
-        return {}
+        return {"shard": arguments.shard}
 
-    @property
+    @cached_property
     def mqtt_topic(self):
         """Return the MQTT topic for the Sky."""
-        return "sky"
+        return sky_topic(self.shard)
 
-    @property
+    @cached_property
     def mqttclientname(self):
         """Name of the MQTT client we will create"""
-        return "Sky"
+        return sky_client_name(self.shard)
 
-    @property
+    @cached_property
     def loggername(self) -> str:
         """Name of the logger"""
-        return "Sky"
+        return sky_client_name(self.shard).replace("_", " ")
 
-    @property
+    @cached_property
     def redis_key(self) -> str:
         """Key for Redis storage"""
-        return "sky"
+        return sky_redis_key(self.shard)
 
     def on_child_connect(self):
         """called by airportcomponent.on_connect"""
+        self.hand_off_foreign_planes()
 
-    def __init__(self, **kwargs):
-        self.plane_queues: Dict[str, List[Plane]] = {}
+    def __init__(self, shard: int = 0, **kwargs):
+        self.shard = shard
+        self.plane_queues: Dict[str, BoundedQueue[Plane]] = {}
         self.planes_flying: List[Plane] = []
+        # queue lengths last published to each airport
+        self.announced_waiting: Dict[str, int] = {}
 
         super().__init__(**kwargs)
 
+    def register_gauges(self):
+        """queue depths"""
+        self.metrics.gauge(
+            "sky_planes_circling",
+            "Planes circling over the shard's airports",
+            lambda: sum(len(queue) for queue in self.plane_queues.values()),
+        )
+        self.metrics.gauge(
+            "sky_planes_flying",
+            "Planes on their way",
+            lambda: len(self.planes_flying),
+        )
+
     def to_dict(self):
         """Convert the Sky instance to a JSON representation."""
         return {
+            "shard": self.shard,
             "plane_queues": {
-                airport: [plane.to_dict() for plane in planes]
+                airport: [plane.to_dict() for plane in planes.items]
                 for airport, planes in self.plane_queues.items()
             },
             "planes_flying": [plane.to_dict() for plane in self.planes_flying],
@@ -64,86 +111,237 @@ class Sky(AirportComponent):
     @staticmethod
     def from_dict(data, **kwargs):
         """Load the Sky state from a JSON representation."""
-        restored_sky = Sky(**kwargs)
+        restored_sky = Sky(data.get("shard", 0), **kwargs)
         for airport, plane_queue in data.get("plane_queues", {}).items():
-            restored_sky.plane_queues[airport] = [
+            restored_sky.plane_queues[airport] = Sky.new_queue(
                 Plane.from_dict(plane) for plane in plane_queue
-            ]
+            )
         restored_sky.planes_flying = [
             Plane.from_dict(plane) for plane in data.get("planes_flying", [])
         ]
         return restored_sky
 
-    def handle_message(self, message: dict):
+    @staticmethod
+    def new_queue(planes=()) -> BoundedQueue[Plane]:
+        """Queue of the planes circling over an airport"""
+        return BoundedQueue(ARRIVAL_QUEUE_CAPACITY, ARRIVAL_QUEUE_POLICY, planes)
+
+    def start_circling(self, plane: Plane) -> bool:
+        """Queue a plane to land at its destination; False if it keeps
+        flying because the queue is full and the policy is to defer"""
+        queue = self.plane_queues.setdefault(plane.end_airport, Sky.new_queue())
+        if not queue.admits():
+            queue.refuse()
+            if queue.policy == DEFER:
+                self.log(f"Plane {plane.plane_id} holds, {plane.end_airport} is full")
+                return False
+            self.log(f"Plane {plane.plane_id} diverted, {plane.end_airport} is full")
+            plane.set_state(PlaneState.DIVERTED, self, self.ticks)
+            return True
+        if plane.state != PlaneState.CIRCLING:
+            plane.set_state(PlaneState.CIRCLING, self, self.ticks)
+        queue.offer(plane)
+        self.log(
+            f"Plane {plane.plane_id} has started circling to land at {plane.end_airport}."
+        )
+        return True
+
+    def owns(self, airport: str) -> bool:
+        """Whether planes flying to airport are handled by this shard"""
+        return sky_shard(airport) == self.shard
+
+    def hand_off(self, plane: Plane):
+        """Send a plane to the shard that owns its destination"""
+        self.publish(
+            sky_topic_for(plane.end_airport),
+            {"msg_type": "plane_handoff", "plane": plane.to_dict()},
+        )
+        self.log(f"Handed plane {plane.plane_id} off to {plane.end_airport}'s shard")
+
+    def hand_off_foreign_planes(self):
+        """After SKY_SHARDS changed, pass on the planes another shard now owns"""
+        for plane in [p for p in self.planes_flying if not self.owns(p.end_airport)]:
+            self.planes_flying.remove(plane)
+            self.hand_off(plane)
+        for airport in [a for a in self.plane_queues if not self.owns(a)]:
+            for plane in self.plane_queues.pop(airport):
+                self.hand_off(plane)
+            self.announced_waiting.pop(airport, None)
+
+    def take_over(self, redis_client: Redis, old_key: str) -> int:
+        """Move the planes saved under a retired shard's key into this shard,
+        in the transaction that writes this shard's snapshot and drops the
+        key; the ones it doesn't own are handed off once connected. Returns
+        how many planes there were"""
+        retired = construct_or_restore(
+            Sky,
+            redis_client,
+            old_key,
+            argparse.Namespace(shard=0, verbose=False),
+            broker=LocalBroker(),  # replays its log without connecting
+            metrics_registry=Registry(),
+        )
+        self.planes_flying.extend(retired.planes_flying)
+        for airport, planes in retired.plane_queues.items():
+            # circling planes are kept even beyond the queue's capacity
+            queue = self.plane_queues.setdefault(airport, Sky.new_queue())
+            queue.items.extend(planes)
+        pipeline = redis_client.pipeline()  # a transaction
+        self.queue_snapshot(pipeline)
+        pipeline.delete(old_key)
+        drop_log(pipeline, old_key)
+        pipeline.execute()
+        return len(retired.planes_flying) + sum(
+            len(planes) for planes in retired.plane_queues.values()
+        )
+
+    def take_over_retired_shards(self, redis_client: Redis):
+        """After SKY_SHARDS went down, take the planes of the shards that are
+        gone; run by shard 0 before it connects"""
+        for old_key in retired_shard_keys(redis_client):
+            planes = self.take_over(redis_client, old_key)
+            print(f"Took over {planes} planes from {old_key}")
+
+    @handles("plane_handoff", "plane")
+    def handle_plane_handoff(self, plane_data: dict):
+        """another shard passed us a plane flying to one of our airports"""
+        plane = Plane.from_dict(plane_data)
+        if not self.owns(plane.end_airport):
+            self.hand_off(plane)
+            return
+        if plane.state != PlaneState.CIRCLING:
+            self.planes_flying.append(plane)
+        elif self.start_circling(plane):
+            self.announce_arrivals_waiting(plane.end_airport, force=True)
+        else:
+            self.planes_flying.append(plane)
+        self.log(f"Took over plane {plane.plane_id} flying to {plane.end_airport}")
+
+    def announce_arrivals_waiting(self, airport: str, force: bool = False):
+        """Tell an airport how many planes are circling, if that changed"""
+        count = len(self.plane_queues.get(airport, ()))
+        if not force and self.announced_waiting.get(airport) == count:
+            return
+        self.announced_waiting[airport] = count
+        self.publish(
+            f"airport/{airport}", {"msg_type": "arrivals_waiting", "count": count}
+        )
+
+    def forward(self, airport: str, msg_type: str, **message):
+        """Pass a request about airport on to the shard that owns it"""
+        self.publish(
+            sky_topic_for(airport),
+            dict(message, msg_type=msg_type, airport=airport),
+        )
+
+    def land_plane(self, airport: str, runway_number: str) -> bool:
+        """Send the next plane circling over airport to a runway"""
+        if not self.plane_queues.get(airport):
+            self.log(f"No planes available to land at {airport}")
+            return False
+        plane: Plane = self.plane_queues[airport].pop(0)
+        runway_topic = f"airport/{airport}/runway/{runway_number}"
+        self.publish(
+            runway_topic,
+            {
+                "msg_type": "plane_arrival",
+                "plane": plane.to_dict(),
+            },
+        )
+        self.log(f"Sent plane {plane.plane_id} to {runway_topic}")
+        return True
+
+    @handles("land_next_plane", "airport", "runway_number")
+    def handle_land_next_plane(self, airport: str, runway_number: str):
         """runway requests next plane"""
-        if self.validate_message(["msg_type"], message):
-
-            if message["msg_type"] == "land_next_plane":
-
-                if self.validate_message(["airport", "runway_number"], message):
-                    airport = message["airport"]
-                    self.log(f"Request to send next plane received from {airport}.")
-
-                    if self.plane_queues.get(airport):
-
-                        runway_number = message["runway_number"]
-                        plane: Plane = self.plane_queues[airport].pop(0)
-                        runway_topic = f"airport/{airport}/runway/{runway_number}"
-                        self.client.publish(
-                            runway_topic,
-                            json.dumps(
-                                {
-                                    "msg_type": "plane_arrival",
-                                    "plane": plane.to_dict(),
-                                }
-                            ),
-                        )
-                        self.log(f"Sent plane {plane.plane_id} to {runway_topic}")
-                    else:
-                        self.log(f"No planes available to land at {airport}")
-
-            elif message["msg_type"] == "plane_departure":
-
-                if self.validate_message(["plane"], message):
-                    plane_data = message["plane"]
-                    if plane_data:
-
-                        plane = Plane.from_dict(plane_data)
-                        plane.ticks_in_sky = random.randint(5, 10)
-                        plane.set_state(PlaneState.IN_SKY, self.client, self.ticks)
-                        self.planes_flying.append(plane)
-
-                        self.log(
-                            f"Plane {plane.plane_id} is departing to {plane.end_airport} "
-                            + f"and will be in the sky for {plane.ticks_in_sky} ticks."
-                        )
-
-                        if plane.end_airport not in self.plane_queues:
-                            self.plane_queues[plane.end_airport] = []
-                    else:
-                        self.log("No plane data provided in departure message")
+        if not self.owns(airport):
+            self.forward(airport, "land_next_plane", runway_number=runway_number)
+            return
+        self.log(f"Request to send next plane received from {airport}.")
+        self.land_plane(airport, runway_number)
+        self.announce_arrivals_waiting(airport)
+
+    @handles("land_planes", "airport", "runway_numbers")
+    def handle_land_planes(self, airport: str, runway_numbers: List[str]):
+        """an airport has free runways for the planes we said are circling"""
+        if not self.owns(airport):
+            self.forward(airport, "land_planes", runway_numbers=runway_numbers)
+            return
+        self.log(f"Request to land on runways {runway_numbers} from {airport}.")
+        for runway_number in runway_numbers:
+            if not self.land_plane(airport, runway_number):
+                break
+        self.announce_arrivals_waiting(airport)
+
+    @handles("arrivals_waiting_query", "airport")
+    def handle_arrivals_waiting_query(self, airport: str):
+        """an airport (re)connected and wants to know its arrival queue"""
+        if not self.owns(airport):
+            self.forward(airport, "arrivals_waiting_query")
+            return
+        self.announce_arrivals_waiting(airport, force=True)
+
+    @handles("plane_departure", "plane")
+    def handle_plane_departure(self, plane_data: dict):
+        """a runway has sent a plane into the sky"""
+        if plane_data:
+
+            plane = Plane.from_dict(plane_data)
+            if not self.owns(plane.end_airport):
+                self.hand_off(plane)
+                return
+            plane.ticks_in_sky = self.rng.randint(
+                Sky.FLIGHT_MIN_TICKS, Sky.FLIGHT_MAX_TICKS
+            )
+            plane.set_state(PlaneState.IN_SKY, self, self.ticks)
+            self.planes_flying.append(plane)
+
+            self.log(
+                f"Plane {plane.plane_id} is departing to {plane.end_airport} "
+                + f"and will be in the sky for {plane.ticks_in_sky} ticks."
+            )
+
+            if plane.end_airport not in self.plane_queues:
+                self.plane_queues[plane.end_airport] = Sky.new_queue()
+        else:
+            self.log("No plane data provided in departure message")
 
     def handle_heartbeat(self):
         """Handle heartbeat messages to add new planes."""
         for plane in list(self.planes_flying):
             if plane.ticks_in_sky <= 0:
-                plane.set_state(PlaneState.CIRCLING, self.client, self.ticks)
-                self.plane_queues[plane.end_airport].append(plane)
-                self.planes_flying.remove(plane)
-                self.log(
-                    f"Plane {plane.plane_id} has started circling to land at {plane.end_airport}."
-                )
+                if self.start_circling(plane):
+                    self.planes_flying.remove(plane)
+                # else it is held back and tries again next tick
             else:
                 plane.ticks_in_sky -= 1
                 self.log(
                     f"Plane {plane.plane_id} is still in the sky, "
                     + f"{plane.ticks_in_sky} ticks remaining."
                 )
+        for airport in self.plane_queues:
+            self.announce_arrivals_waiting(airport)
 
 
 if __name__ == "__main__":
     redis_client = Redis(host=REDIS_BROKER, port=6379)
     parser = argparse.ArgumentParser(description="Gate Simulation")
+    parser.add_argument(
+        "--shard",
+        type=int,
+        default=0,
+        help=f"Which of the SKY_SHARDS={SKY_SHARDS} shards to run",
+    )
     parser.add_argument("--verbose", action="store_true", help="Enable verbose logging")
-    sky = construct_or_restore(Sky, redis_client, "sky", parser.parse_args())
+    args = parser.parse_args()
+
+    key = sky_redis_key(args.shard)
+    if args.shard == 0 and not redis_client.exists(key):
+        # going between one and several shards renames shard 0's key
+        for old_key in ("sky", "sky-0"):
+            if old_key != key and redis_client.exists(old_key):
+                redis_client.rename(old_key, key)
+    sky = construct_or_restore(Sky, redis_client, key, args)
+    if args.shard == 0:
+        sky.take_over_retired_shards(redis_client)
     sky.client.loop_forever()
@@ -0,0 +1,127 @@
+"""Versioned encoding of component state snapshots stored in Redis
+
+A snapshot is MAGIC, a version byte, a body format byte and a compression
+byte, followed by the body. Anything that doesn't start with MAGIC is read as
+the plain JSON written by older versions, so existing keys keep loading.
+
+JSON stays the default: restoring a binary snapshot is no faster, since most
+of the time goes into building the plane dicts either way. SNAPSHOT_FORMAT=binary
+makes the per-tick writes and Redis memory smaller. Bodies are compressed
+with zlib unless SNAPSHOT_COMPRESSION picks zstd or lz4, which need the
+packages of the "snapshot" extra.
+
+This module is also used by airport-monitor-server, so it must only depend on
+msgpack and the standard library; zstandard and lz4 are used when installed.
+"""
+
+import json
+import os
+import zlib
+
+import msgpack
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+MAGIC = b"\x00ASN"
+VERSION = 1
+
+BODY_MSGPACK = ord("m")
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_ZSTD = 2
+COMPRESSION_LZ4 = 3
+
+COMPRESSIONS = {
+    "none": COMPRESSION_NONE,
+    "zlib": COMPRESSION_ZLIB,
+    "zstd": COMPRESSION_ZSTD,
+    "lz4": COMPRESSION_LZ4,
+}
+
+# bodies smaller than this aren't worth compressing (idle gates and runways)
+COMPRESSION_THRESHOLD = 512
+
+SNAPSHOT_FORMAT = os.environ.get("SNAPSHOT_FORMAT", "json")
+SNAPSHOT_COMPRESSION = os.environ.get("SNAPSHOT_COMPRESSION", "zlib")
+
+
+def _compress(body: bytes, compression: int) -> bytes:
+    """compress body with the given algorithm"""
+    if compression == COMPRESSION_ZLIB:
+        return zlib.compress(body, 1)
+    if compression == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("zstd compression requires the zstandard package")
+        return zstandard.ZstdCompressor(level=1).compress(body)
+    if compression == COMPRESSION_LZ4:
+        if lz4 is None:
+            raise RuntimeError("lz4 compression requires the lz4 package")
+        return lz4.frame.compress(body)
+    return body
+
+
+def _decompress(body: bytes, compression: int) -> bytes:
+    """inverse of _compress"""
+    if compression == COMPRESSION_ZLIB:
+        return zlib.decompress(body)
+    if compression == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise ValueError("snapshot is zstd compressed but zstandard is missing")
+        return zstandard.ZstdDecompressor().decompress(body)
+    if compression == COMPRESSION_LZ4:
+        if lz4 is None:
+            raise ValueError("snapshot is lz4 compressed but lz4 is missing")
+        return lz4.frame.decompress(body)
+    if compression == COMPRESSION_NONE:
+        return body
+    raise ValueError(f"unknown snapshot compression {compression}")
+
+
+def dumps(
+    state: dict,
+    snapshot_format: str = SNAPSHOT_FORMAT,
+    compression: str = SNAPSHOT_COMPRESSION,
+) -> bytes | str:
+    """Encode a component state; 'json' produces the legacy plain JSON"""
+    if snapshot_format == "json":
+        return json.dumps(state)
+    body = msgpack.packb(state)
+    compression_id = COMPRESSIONS[compression]
+    if len(body) < COMPRESSION_THRESHOLD:
+        compression_id = COMPRESSION_NONE
+    return (
+        MAGIC
+        + bytes((VERSION, BODY_MSGPACK, compression_id))
+        + _compress(body, compression_id)
+    )
+
+
+def loads(raw: bytes | str) -> dict:
+    """Decode a snapshot in any supported format; raises ValueError if it can't"""
+    if isinstance(raw, str):
+        return json.loads(raw)
+    if raw[: len(MAGIC)] != MAGIC:
+        return json.loads(raw)
+    header_end = len(MAGIC) + 3
+    version, body_format, compression = raw[len(MAGIC) : header_end]
+    if version > VERSION:
+        raise ValueError(f"snapshot version {version} is newer than {VERSION}")
+    try:
+        body = _decompress(raw[header_end:], compression)
+    except zlib.error as exc:
+        raise ValueError(f"corrupt snapshot: {exc}") from exc
+    if body_format != BODY_MSGPACK:
+        raise ValueError(f"unknown snapshot body format {body_format}")
+    try:
+        return msgpack.unpackb(body)
+    except msgpack.UnpackException as exc:
+        raise ValueError(f"corrupt snapshot: {exc}") from exc
@@ -0,0 +1,244 @@
+"""Parameter sweeps over headless worlds for capacity planning
+
+A grid is a JSON object whose values are lists (or single values). Every
+combination is one run of world.py's headless world:
+
+    {
+        "airports": [4, 8],
+        "gates": [2, 4, 8],
+        "runways": [1, 2],
+        "prob": [0.3, 0.8],
+        "runway_ticks": [[3, 10]],
+        "gate_ticks": [[3, 5], [5, 10]],
+        "flight_ticks": [[5, 10]],
+        "seed": [1, 2, 3],
+        "ticks": 200
+    }
+
+prob is the chance that an airport gets a new plane on a tick (what
+planegenerator.py's --prob is for the whole world), and the *_ticks ranges
+replace Runway.RUNWAY_MIN/MAX_TICKS, Gate.GATE_MIN/MAX_TICKS and
+Sky.FLIGHT_MIN/MAX_TICKS. Runs are spread over a process pool and one row
+of summary metrics per run is written to the results file, Parquet (with
+the "sweep" extra, which installs pyarrow) or CSV. A run is identified by a
+hash of its parameters, and runs already in the results file are skipped, so
+an interrupted sweep can simply be started again.
+
+Every finished run is appended at once: to a CSV file directly, and for
+Parquet, which can't be appended to, to a JSON lines journal next to it
+(results.parquet.partial) that is turned into the Parquet file at the end
+and read back when an interrupted sweep is started again.
+
+    python sweep.py grid.json --output results.parquet --processes 8
+"""
+
+import argparse
+import csv
+import hashlib
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from gate import Gate
+from runway import Runway
+from sky import Sky
+from world import run_world
+
+DEFAULTS = {
+    "airports": 4,
+    "gates": 4,
+    "runways": 2,
+    "prob": 0.3,
+    "runway_ticks": [Runway.RUNWAY_MIN_TICKS, Runway.RUNWAY_MAX_TICKS],
+    "gate_ticks": [Gate.GATE_MIN_TICKS, Gate.GATE_MAX_TICKS],
+    "flight_ticks": [Sky.FLIGHT_MIN_TICKS, Sky.FLIGHT_MAX_TICKS],
+    "seed": 1,
+    "ticks": 200,
+}
+
+# tick ranges are class attributes, so they are set for the whole worker
+# process; each run sets all of them before building its world
+TICK_RANGES = {
+    "runway_ticks": (Runway, "RUNWAY_MIN_TICKS", "RUNWAY_MAX_TICKS"),
+    "gate_ticks": (Gate, "GATE_MIN_TICKS", "GATE_MAX_TICKS"),
+    "flight_ticks": (Sky, "FLIGHT_MIN_TICKS", "FLIGHT_MAX_TICKS"),
+}
+
+
+def expand_grid(grid: dict) -> List[dict]:
+    """every combination of the grid's values, with defaults filled in"""
+    unknown = set(grid) - set(DEFAULTS)
+    if unknown:
+        raise ValueError(f"unknown grid parameters: {', '.join(sorted(unknown))}")
+    axes = {}
+    for name, default in DEFAULTS.items():
+        values = grid.get(name, default)
+        # a tick range is a list itself, so a single range is [min, max]
+        single = not isinstance(values, list) or (
+            name in TICK_RANGES and values and not isinstance(values[0], list)
+        )
+        axes[name] = [values] if single else values
+    return [
+        dict(zip(axes, combination))
+        for combination in itertools.product(*axes.values())
+    ]
+
+
+def run_id(params: dict) -> str:
+    """stable identifier of a run's parameters"""
+    return hashlib.blake2b(
+        json.dumps(params, sort_keys=True).encode(), digest_size=8
+    ).hexdigest()
+
+
+def run(params: dict) -> dict:
+    """run one world and summarise it"""
+    for name, (cls, minimum, maximum) in TICK_RANGES.items():
+        setattr(cls, minimum, params[name][0])
+        setattr(cls, maximum, params[name][1])
+
+    options = {
+        "airports": [f"A{index:04d}" for index in range(params["airports"])],
+        "gates": params["gates"],
+        "runways": params["runways"],
+        "seed": params["seed"],
+        "new_plane_prob": params["prob"],
+        "batch_publish": False,
+    }
+    results, elapsed = run_world(options, params["ticks"], 0)
+
+    states = [json.loads(state) for state in results["states"].values()]
+    airports = [state for state in states if "waiting_for_departure_gate" in state]
+    skies = [state for state in states if "plane_queues" in state]
+    tallies = results["tallies"]
+    row = {
+        "run_id": run_id(params),
+        "airports": params["airports"],
+        "gates": params["gates"],
+        "runways": params["runways"],
+        "prob": params["prob"],
+        "seed": params["seed"],
+        "ticks": params["ticks"],
+    }
+    for name in TICK_RANGES:
+        row[name.replace("_ticks", "_min_ticks")] = params[name][0]
+        row[name.replace("_ticks", "_max_ticks")] = params[name][1]
+    row.update(
+        {
+            "flights_created": tallies.get("init-flight", 0),
+            "departures": tallies.get("on_departure_runway", 0),
+            "arrivals": tallies.get("on_arrival_runway", 0),
+            "completed": tallies.get("in_hangar", 0),
+            "waiting_for_gate_at_end": sum(
+                len(a["waiting_for_departure_gate"]) for a in airports
+            ),
+            "circling_at_end": sum(
+                len(queue) for sky in skies for queue in sky["plane_queues"].values()
+            ),
+            "flying_at_end": sum(len(sky["planes_flying"]) for sky in skies),
+            "messages": sum(results["published"].values()),
+            "events": results["events"],
+            "seconds": round(elapsed, 3),
+        }
+    )
+    return row
+
+
+def journal_path(path: str) -> str:
+    """where the runs of a Parquet results file are kept until the end"""
+    return path + ".partial"
+
+
+def read_results(path: str) -> List[Dict]:
+    """rows already in the results file, and in its journal"""
+    rows = []
+    if os.path.exists(path):
+        if path.endswith(".parquet"):
+            rows = pyarrow.parquet.read_table(path).to_pylist()
+        else:
+            with open(path, newline="", encoding="utf-8") as results_file:
+                rows = list(csv.DictReader(results_file))
+    if os.path.exists(journal_path(path)):
+        with open(journal_path(path), encoding="utf-8") as journal:
+            for line in journal:
+                try:
+                    rows.append(json.loads(line))
+                except ValueError:  # the last line of an interrupted write
+                    break
+    return rows
+
+
+def append_result(path: str, row: Dict):
+    """record a finished run, without rewriting what is there"""
+    if path.endswith(".parquet"):
+        with open(journal_path(path), "a", encoding="utf-8") as journal:
+            journal.write(json.dumps(row) + "\n")
+        return
+    new = not os.path.exists(path)
+    with open(path, "a", newline="", encoding="utf-8") as results_file:
+        writer = csv.DictWriter(results_file, fieldnames=list(row))
+        if new:
+            writer.writeheader()
+        writer.writerow(row)
+
+
+def finish_results(path: str, rows: List[Dict]):
+    """write a Parquet results file from all rows and drop its journal"""
+    if not path.endswith(".parquet") or not os.path.exists(journal_path(path)):
+        return
+    pyarrow.parquet.write_table(pyarrow.Table.from_pylist(rows), path + ".tmp")
+    os.replace(path + ".tmp", path)
+    os.remove(journal_path(path))
+
+
+def main():
+    """main"""
+    parser = argparse.ArgumentParser(description="Parameter sweep of headless worlds")
+    parser.add_argument("grid", help="JSON file with the parameter grid")
+    parser.add_argument(
+        "--output",
+        default="sweep_results.parquet",
+        help="results file, .parquet (needs the sweep extra) or .csv",
+    )
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    if args.output.endswith(".parquet") and pyarrow is None:
+        print(
+            'writing Parquet requires pyarrow: pip install -e ".[sweep]", '
+            + "or use a .csv output"
+        )
+        return
+
+    with open(args.grid, encoding="utf-8") as grid_file:
+        runs = expand_grid(json.load(grid_file))
+    rows = read_results(args.output)
+    done = {row["run_id"] for row in rows}
+    todo = [params for params in runs if run_id(params) not in done]
+    print(f"{len(runs)} runs, {len(runs) - len(todo)} already done")
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.processes) as pool:
+        futures = [pool.submit(run, params) for params in todo]
+        for completed, future in enumerate(as_completed(futures), 1):
+            rows.append(future.result())
+            append_result(args.output, rows[-1])  # kept if the sweep is interrupted
+            print(
+                f"[{completed}/{len(todo)}] run {rows[-1]['run_id']} "
+                + f"took {rows[-1]['seconds']}s"
+            )
+    finish_results(args.output, rows)
+    print(f"sweep took {time.perf_counter() - start:.1f}s, results in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,7 +9,8 @@ CREATE TABLE IF NOT EXISTS public.plane_events
     ticks bigint NOT NULL,
     event_time timestamptz not null,
     from_state character varying(25) COLLATE pg_catalog."default" NOT NULL,
-    to_state character varying(25) COLLATE pg_catalog."default" NOT NULL
+    to_state character varying(25) COLLATE pg_catalog."default" NOT NULL,
+    CONSTRAINT plane_events_pkey PRIMARY KEY (flight_id, plane_id, ticks, from_state, to_state)
 )
 
 TABLESPACE pg_default;
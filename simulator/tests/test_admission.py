@@ -0,0 +1,90 @@
+"""Bounded queues and what happens to what doesn't fit"""
+
+import json
+import random
+
+import pytest
+
+import sky
+from admission import DEFER, HANGAR, REJECT, BoundedQueue, queue_limits
+from localbroker import LocalBroker
+from plane import Plane, PlaneState
+
+
+def filled(policy: str, capacity: int = 2) -> BoundedQueue:
+    """a queue holding 1 and 2"""
+    queue = BoundedQueue(capacity, policy)
+    assert queue.offer(1) and queue.offer(2)
+    return queue
+
+
+def test_unbounded_queue_takes_everything():
+    queue = BoundedQueue()
+    assert all(queue.offer(item) for item in range(1000))
+    assert not queue.full() and queue.admits()
+
+
+@pytest.mark.parametrize("policy", [REJECT, DEFER])
+def test_full_queue_refuses_and_counts(policy):
+    queue = filled(policy)
+    assert queue.full() and not queue.admits()
+    assert not queue.offer(3)
+    queue.refuse()
+    assert list(queue) == [1, 2]
+    assert queue.shed == 2
+
+
+def test_hangar_keeps_the_overflow_out_of_the_queue():
+    queue = filled(HANGAR)
+    assert queue.admits()
+    assert queue.offer(3) and queue.offer(4)
+    assert queue.items == [1, 2]
+    assert len(queue) == 4 and list(queue) == [1, 2, 3, 4]
+    assert queue.shed == 0
+
+
+def test_pop_moves_the_hangar_in_order():
+    queue = filled(HANGAR)
+    queue.offer(3)
+    queue.offer(4)
+    assert queue.pop() == 1
+    assert queue.items == [2, 3] and queue.hangar == [4]
+
+
+def test_limits_come_from_the_environment(monkeypatch):
+    monkeypatch.setenv("TEST_QUEUE_CAPACITY", "5")
+    monkeypatch.setenv("TEST_QUEUE_POLICY", HANGAR)
+    assert queue_limits("TEST_QUEUE") == (5, HANGAR)
+    monkeypatch.setenv("TEST_QUEUE_POLICY", "drop")
+    with pytest.raises(ValueError):
+        queue_limits("TEST_QUEUE")
+
+
+@pytest.mark.parametrize(
+    "policy, admitted, state", [(REJECT, True, "diverted"), (DEFER, False, "in_sky")]
+)
+def test_sky_turns_away_planes_for_a_full_airport(monkeypatch, policy, admitted, state):
+    monkeypatch.setattr(sky, "ARRIVAL_QUEUE_CAPACITY", 1)
+    monkeypatch.setattr(sky, "ARRIVAL_QUEUE_POLICY", policy)
+    broker = LocalBroker()
+    the_sky = sky.Sky(broker=broker)
+    events = []
+    listener = broker.client("listener")
+    listener.subscribe("events")
+    listener.message_callback_add(
+        "events", lambda client, userdata, msg: events.append(json.loads(msg.payload))
+    )
+    broker.run()
+    rng = random.Random(3)
+    planes = [Plane("JFK", "LAX", rng) for _ in range(2)]
+    for plane in planes:
+        plane.state = PlaneState.IN_SKY
+    assert the_sky.start_circling(planes[0])
+    assert the_sky.start_circling(planes[1]) is admitted
+    broker.run()
+    assert planes[1].state.value == state
+    assert [plane.plane_id for plane in the_sky.plane_queues["LAX"]] == [
+        planes[0].plane_id
+    ]
+    diverted = [event for event in events if event.get("to_state") == "diverted"]
+    assert len(diverted) == (1 if policy == REJECT else 0)
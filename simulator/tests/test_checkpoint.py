@@ -0,0 +1,124 @@
+"""Checkpoint files, restoring them, and taking one from components"""
+
+import json
+
+import fakeredis
+import msgpack
+import pytest
+
+import checkpoint
+import snapshot
+from gate import Gate
+from inputlog import log_key
+from localbroker import LocalBroker
+from locations import LOCATIONS_KEY
+from runway import Runway
+
+STATES = {
+    "airport-JFK": json.dumps({"airport": "JFK", "gates": ["1", "2"]}).encode(),
+    "sky": snapshot.dumps({"planes_flying": [], "plane_queues": {}}, "binary"),
+}
+INDEX = {"plane:p1": json.dumps({"state": "circling", "redis_key": "sky"})}
+
+
+@pytest.fixture(name="checkpoint_file")
+def fixture_checkpoint_file(tmp_path):
+    """a checkpoint of STATES and INDEX at tick 100"""
+    path = checkpoint.checkpoint_path(str(tmp_path), 100)
+    checkpoint.write_checkpoint(path, 100, STATES, INDEX)
+    return path
+
+
+def test_write_and_read_back(checkpoint_file):
+    saved = checkpoint.CheckpointFile(checkpoint_file)
+    assert saved.tick == 100
+    assert saved.states() == {key: snapshot.loads(raw) for key, raw in STATES.items()}
+    kinds = {key: kind for key, kind, _, _ in saved.entries}
+    assert kinds == {"airport-JFK": "string", "sky": "string", LOCATIONS_KEY: "hash"}
+
+
+def test_not_a_checkpoint(tmp_path):
+    path = tmp_path / "checkpoint-0000000001.ckpt"
+    path.write_bytes(b"\x00" * 64)
+    with pytest.raises(ValueError):
+        checkpoint.CheckpointFile(str(path))
+
+
+def test_restore_replaces_keys_index_and_logs(checkpoint_file):
+    redis_client = fakeredis.FakeRedis()
+    redis_client.set("sky", b"newer")
+    redis_client.rpush(log_key("sky"), b"entry")
+    redis_client.hset(LOCATIONS_KEY, mapping={"plane:gone": "{}"})
+    written = checkpoint.CheckpointFile(checkpoint_file).restore(redis_client)
+    assert written == 3
+    for key, raw in STATES.items():
+        assert redis_client.get(key) == (
+            raw if isinstance(raw, bytes) else raw.encode()
+        )
+    assert not redis_client.exists(log_key("sky"))
+    assert redis_client.hgetall(LOCATIONS_KEY) == {
+        key.encode(): value.encode() for key, value in INDEX.items()
+    }
+
+
+def test_latest_and_prune(tmp_path):
+    directory = str(tmp_path)
+    for tick in (10, 20, 30):
+        checkpoint.write_checkpoint(
+            checkpoint.checkpoint_path(directory, tick), tick, STATES, {}
+        )
+    assert checkpoint.latest(directory).endswith("checkpoint-0000000030.ckpt")
+    checkpointer = checkpoint.Checkpointer(
+        LocalBroker().client("heartbeat"), directory, keep=2
+    )
+    checkpointer.prune()
+    assert len(checkpoint.checkpoint_files(directory)) == 2
+
+
+def test_take_a_checkpoint_of_components(tmp_path):
+    broker = LocalBroker()
+    components = [Gate("JFK", "1", broker=broker), Runway("JFK", "1", broker=broker)]
+    client = broker.client("heartbeat")
+    redis_client = fakeredis.FakeRedis()
+    redis_client.hset(LOCATIONS_KEY, mapping=INDEX)
+    checkpointer = checkpoint.Checkpointer(
+        client,
+        str(tmp_path),
+        redis_client=redis_client,
+        wait=lambda seconds: broker.run(),
+    )
+    broker.run()
+    for ticks in range(3):
+        broker.publish("heartbeat", json.dumps({"ticks": ticks}))
+        broker.run()
+    handled = {component.mqttclientname: component.handled for component in components}
+
+    assert checkpointer.counts() == {
+        name: [count, 2] for name, count in handled.items()
+    }
+    path = checkpointer.take(2)
+    saved = checkpoint.CheckpointFile(path)
+    assert saved.tick == 2
+    assert saved.states() == {
+        component.redis_key: component.to_dict() for component in components
+    }
+    assert checkpointer.take(3) is None  # the components are at tick 2
+
+
+def test_dump_reply_is_a_binary_snapshot():
+    broker = LocalBroker()
+    gate = Gate("JFK", "1", broker=broker)
+    replies = []
+    client = broker.client("probe")
+    client.subscribe("probe/reply")
+    client.message_callback_add(
+        "probe/reply", lambda client, userdata, msg: replies.append(msg.payload)
+    )
+    broker.run()
+    broker.publish(
+        "admin", json.dumps({"command": "checkpoint_dump", "reply_to": "probe/reply"})
+    )
+    broker.run()
+    (reply,) = [msgpack.unpackb(payload) for payload in replies]
+    assert reply["redis_key"] == gate.redis_key
+    assert snapshot.loads(reply["state"]) == gate.to_dict()
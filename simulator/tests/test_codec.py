@@ -0,0 +1,63 @@
+"""Wire codec round trips and the batch envelope"""
+
+import json
+import random
+
+import pytest
+
+import codec
+from plane import Plane
+
+
+def plane_dict() -> dict:
+    """a plane as components send it"""
+    plane = Plane("JFK", "LAX", random.Random(1))
+    plane.start_gate = "3"
+    return plane.to_dict()
+
+
+@pytest.mark.parametrize("encoding", [codec.JSON, codec.BINARY])
+def test_round_trip(encoding):
+    message = {"msg_type": "plane_departing", "plane": plane_dict(), "runway": "1"}
+    assert codec.decode(codec.encode(message, encoding)) == message
+
+
+def test_json_is_plain_text():
+    message = {"msg_type": "gate_update", "gate_number": "3", "gate_state": "free"}
+    assert json.loads(codec.encode(message)) == message
+
+
+def test_binary_starts_with_header_and_is_smaller():
+    message = {"msg_type": "plane_departing", "plane": plane_dict()}
+    payload = codec.encode(message, codec.BINARY)
+    assert payload[:2] == codec.BINARY_HEADER
+    assert len(payload) < len(codec.encode(message))
+
+
+@pytest.mark.parametrize("encoding", [codec.JSON, codec.BINARY])
+def test_batch_round_trip(encoding):
+    messages = [
+        {"msg_type": "plane_departing", "plane": plane_dict()},
+        {"msg_type": "gate_update", "gate_number": "3", "gate_state": "free"},
+    ]
+    decoded = codec.decode(codec.encode(codec.batch(messages), encoding))
+    assert decoded["msg_type"] == codec.BATCH
+    assert codec.unbatch(decoded) == messages
+
+
+def test_unbatch_single_message():
+    message = {"msg_type": "gate_update"}
+    assert codec.unbatch(message) == [message]
+
+
+def test_unbatch_needs_the_messages():
+    message = {"msg_type": codec.BATCH}
+    assert codec.unbatch(message) == [message]
+
+
+@pytest.mark.parametrize(
+    "payload", [codec.BINARY_HEADER + b"\xc1", b"{not json", b"\xff\xfe"]
+)
+def test_undecodable_payload_raises_value_error(payload):
+    with pytest.raises(ValueError):
+        codec.decode(payload)
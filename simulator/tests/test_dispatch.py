@@ -0,0 +1,132 @@
+"""The @handles registry and dispatch through it"""
+
+import json
+
+from airportcomponent import AirportComponent, handles
+from localbroker import LocalBroker, LocalMessage
+
+
+class Tower(AirportComponent):
+    """the smallest component with a few handlers"""
+
+    def __init__(self, **kwargs):
+        self.calls = []
+        super().__init__(**kwargs)
+
+    @staticmethod
+    def args_to_dict(arguments):
+        return {}
+
+    def to_dict(self):
+        return {}
+
+    @staticmethod
+    def from_dict(data, **kwargs):
+        return Tower(**kwargs)
+
+    @property
+    def mqttclientname(self):
+        return "Tower"
+
+    @property
+    def mqtt_topic(self):
+        return "tower"
+
+    @property
+    def loggername(self):
+        return "Tower"
+
+    @property
+    def redis_key(self):
+        return "tower"
+
+    def handle_heartbeat(self):
+        pass
+
+    def on_child_connect(self):
+        pass
+
+    @handles("clearance", "runway", "plane_id", optional=("priority",))
+    def handle_clearance(self, runway, plane_id, priority=0):
+        """record a clearance"""
+        self.calls.append(("clearance", runway, plane_id, priority))
+
+    @handles("wind", "speed")
+    def handle_wind(self, speed):
+        """record the wind"""
+        self.calls.append(("wind", speed))
+
+
+class NightTower(Tower):
+    """overrides one handler and adds another"""
+
+    @handles("wind", "speed", "direction")
+    def handle_wind_from(self, speed, direction):
+        """record the wind and where it comes from"""
+        self.calls.append(("wind_from", speed, direction))
+
+    @handles("lights", "on")
+    def handle_lights(self, on):
+        """record the lights"""
+        self.calls.append(("lights", on))
+
+
+def tower(cls=Tower):
+    """a connected tower on a broker of its own"""
+    component = cls(broker=LocalBroker())
+    component.client.broker.run()
+    return component
+
+
+def test_registry_holds_decorated_methods():
+    handler, required, optional = Tower.message_handlers["clearance"]
+    assert handler is Tower.handle_clearance
+    assert required == ("runway", "plane_id")
+    assert optional == ("priority",)
+    assert set(Tower.message_handlers) == {"clearance", "wind"}
+
+
+def test_subclass_registry_extends_without_changing_the_base():
+    assert NightTower.message_handlers["wind"][0] is NightTower.handle_wind_from
+    assert NightTower.message_handlers["clearance"][0] is Tower.handle_clearance
+    assert Tower.message_handlers["wind"][0] is Tower.handle_wind
+    assert "lights" not in Tower.message_handlers
+
+
+def test_required_keys_are_passed_in_order():
+    component = tower()
+    component.handle_message(
+        {"msg_type": "clearance", "plane_id": "p1", "runway": "09L"}
+    )
+    assert component.calls == [("clearance", "09L", "p1", 0)]
+
+
+def test_optional_keys_are_passed_when_present():
+    component = tower()
+    component.handle_message(
+        {"msg_type": "clearance", "runway": "09L", "plane_id": "p1", "priority": 2}
+    )
+    assert component.calls == [("clearance", "09L", "p1", 2)]
+
+
+def test_missing_keys_and_unknown_types_are_not_handled():
+    component = tower()
+    component.handle_message({"msg_type": "clearance", "runway": "09L"})
+    component.handle_message({"msg_type": "no_such_message"})
+    component.handle_message({"runway": "09L"})
+    assert component.calls == []
+
+
+def test_batches_are_dispatched_in_order():
+    component = tower(NightTower)
+    payload = {
+        "msg_type": "batch",
+        "batch": [
+            {"msg_type": "lights", "on": True},
+            {"msg_type": "wind", "speed": 12, "direction": 270},
+        ],
+    }
+    component.on_message(
+        None, None, LocalMessage("tower", json.dumps(payload).encode())
+    )
+    assert component.calls == [("lights", True), ("wind_from", 12, 270)]
@@ -0,0 +1,104 @@
+"""Components rebuilt from a snapshot and their input log match the originals"""
+
+import json
+import random
+
+import fakeredis
+import pytest
+
+import inputlog
+import snapshot
+from airport import Airport
+from gate import Gate
+from localbroker import LocalBroker
+from runway import Runway
+from sky import Sky
+
+SEED = 7
+
+
+def world(broker: LocalBroker, redis_client, **kwargs) -> list:
+    """two airports with gates and runways, and Sky"""
+    components = []
+    for airport in ("JFK", "LAX"):
+        components.append(Airport(airport, [], [], broker=broker, **kwargs))
+        components += [Gate(airport, str(n), broker=broker, **kwargs) for n in range(3)]
+        components += [
+            Runway(airport, str(n), broker=broker, **kwargs) for n in range(2)
+        ]
+    components.append(Sky(broker=broker, **kwargs))
+    for component in components:
+        component.redis_client = redis_client
+    broker.run()
+    return components
+
+
+def run(broker: LocalBroker, ticks: int):
+    """new planes both ways and a heartbeat every tick"""
+    rng = random.Random(1)
+    for tick in range(ticks):
+        for origin, destination in (("JFK", "LAX"), ("LAX", "JFK")):
+            if rng.random() < 0.5:
+                broker.publish(
+                    f"airport/{origin}",
+                    json.dumps({"msg_type": "new_plane", "end_airport": destination}),
+                )
+        broker.publish("heartbeat", json.dumps({"ticks": tick}))
+        broker.run()
+
+
+def restore(component, redis_client, **kwargs):
+    """the component rebuilt from Redis; returns it, what the replay handled
+    and what it published"""
+    broker = LocalBroker()
+    restored = type(component).from_dict(
+        snapshot.loads(redis_client.get(component.redis_key)), broker=broker, **kwargs
+    )
+    broker.run()
+    published = sum(broker.published.values())
+    replayed = inputlog.replay(
+        restored,
+        redis_client.get(inputlog.rng_key(component.redis_key)),
+        redis_client.lrange(inputlog.log_key(component.redis_key), 0, -1),
+    )
+    return restored, replayed, sum(broker.published.values()) - published
+
+
+@pytest.mark.parametrize("ticks", [23, 40])
+def test_replay_rebuilds_the_exact_state(ticks):
+    redis_client = fakeredis.FakeRedis()
+    kwargs = {"seed": SEED, "snapshot_every": 5}
+    broker = LocalBroker()
+    components = world(broker, redis_client, **kwargs)
+    run(broker, ticks)
+    replayed = 0
+    for component in components:
+        restored, entries, published = restore(component, redis_client, **kwargs)
+        replayed += entries
+        assert restored.to_dict() == component.to_dict(), component.mqttclientname
+        assert restored.rng.getstate() == component.rng.getstate()
+        for name in component.logged_attributes:
+            assert getattr(restored, name) == getattr(component, name)
+        assert published == 0
+    assert replayed > 0
+
+
+def test_snapshot_every_tick_keeps_no_log():
+    redis_client = fakeredis.FakeRedis()
+    broker = LocalBroker()
+    components = world(broker, redis_client, seed=SEED, snapshot_every=1)
+    run(broker, 10)
+    for component in components:
+        assert not redis_client.exists(inputlog.log_key(component.redis_key))
+        assert snapshot.loads(redis_client.get(component.redis_key))
+
+
+def test_log_starts_with_the_snapshot():
+    redis_client = fakeredis.FakeRedis()
+    broker = LocalBroker()
+    components = world(broker, redis_client, seed=SEED, snapshot_every=5)
+    run(broker, 12)  # snapshots at ticks 0, 5 and 10
+    entries = redis_client.lrange(inputlog.log_key(components[0].redis_key), 0, -1)
+    assert entries[0][:1] == inputlog.START
+    heartbeats = [entry for entry in entries if entry[:1] == inputlog.HEARTBEAT]
+    assert heartbeats == [inputlog.heartbeat_entry(tick) for tick in (10, 11)]
@@ -0,0 +1,25 @@
+"""Scenario files and the processes they start"""
+
+import json
+
+import pytest
+
+from launch import heartbeat_arguments, load_scenario
+
+
+def test_heartbeat_gets_only_its_own_options():
+    assert heartbeat_arguments({"interval": 0.5, "checkpoint_every": 100}, 40) == [
+        "0.5",
+        "--start-tick",
+        "40",
+        "--checkpoint-every",
+        "100",
+    ]
+    assert heartbeat_arguments({}, 0) == ["1", "--start-tick", "0"]
+
+
+def test_unknown_heartbeat_options_are_refused(tmp_path):
+    path = tmp_path / "scenario.json"
+    path.write_text(json.dumps({"airports": ["JFK"], "heartbeat": {"prob": 0.5}}))
+    with pytest.raises(ValueError):
+        load_scenario(str(path))
@@ -0,0 +1,17 @@
+"""The metrics registry in the Prometheus text format"""
+
+from metrics import Registry
+
+
+def test_render_counters_and_gauges():
+    registry = Registry()
+    registry.counter("messages_total", "Messages", (("component", "Sky"),)).inc(3)
+    registry.gauge("depth", "Depth", (("component", "Sky"),), lambda: 7)
+    assert registry.render().splitlines() == [
+        "# HELP depth Depth",
+        "# TYPE depth gauge",
+        'depth{component="Sky"} 7',
+        "# HELP messages_total Messages",
+        "# TYPE messages_total counter",
+        'messages_total{component="Sky"} 3',
+    ]
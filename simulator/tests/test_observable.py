@@ -0,0 +1,100 @@
+"""ObservableState only announces real changes"""
+
+import json
+from enum import Enum
+
+import observable
+import pytest
+
+from gate import Gate, GateState
+from localbroker import LocalBroker
+from observable import ObservableState, state_sync_due
+from runway import Runway, RunwayState
+
+
+class Light(Enum):
+    """what the owner holds"""
+
+    RED = "red"
+    GREEN = "green"
+
+
+class Signal:
+    """owner of an observable attribute"""
+
+    light = ObservableState(Light, notify="announce")
+
+    def __init__(self):
+        self.ticks = 0
+        self.state_seq = 0
+        self.state_announced_at = 0
+        self.announced = []
+        self.light = Light.RED
+
+    def announce(self):
+        """what a component publishes on a change"""
+        self.announced.append((self.light, self.state_seq))
+
+
+def test_first_assignment_announces():
+    assert Signal().announced == [(Light.RED, 1)]
+
+
+def test_same_value_is_suppressed():
+    signal = Signal()
+    signal.light = Light.RED
+    signal.light = "red"  # converted to the enum
+    assert signal.announced == [(Light.RED, 1)]
+    assert signal.state_seq == 1
+
+
+def test_changes_bump_the_sequence_and_record_the_tick():
+    signal = Signal()
+    signal.ticks = 5
+    signal.light = "green"
+    signal.ticks = 9
+    signal.light = Light.RED
+    assert signal.announced == [(Light.RED, 1), (Light.GREEN, 2), (Light.RED, 3)]
+    assert signal.state_announced_at == 9
+
+
+def test_state_is_repeated_after_a_quiet_period():
+    signal = Signal()
+    signal.ticks = observable.STATE_SYNC_TICKS - 1
+    assert not state_sync_due(signal)
+    signal.ticks = observable.STATE_SYNC_TICKS
+    assert state_sync_due(signal)
+    assert signal.state_announced_at == observable.STATE_SYNC_TICKS
+    assert not state_sync_due(signal)  # not again until the next period
+
+
+def test_idle_gate_only_repeats_its_state_after_a_quiet_period():
+    broker = LocalBroker()
+    gate = Gate("JFK", "1", broker=broker)
+    broker.run()
+    published = dict(broker.published)
+    for ticks in range(observable.STATE_SYNC_TICKS - 1):
+        broker.publish("heartbeat", json.dumps({"ticks": ticks}))
+        broker.run()
+    assert broker.published[gate.airport_topic] == published[gate.airport_topic]
+    broker.publish("heartbeat", json.dumps({"ticks": observable.STATE_SYNC_TICKS}))
+    broker.run()
+    assert broker.published[gate.airport_topic] == published[gate.airport_topic] + 1
+
+
+@pytest.mark.parametrize(
+    "component, busy",
+    [
+        (lambda broker: Gate("JFK", "1", broker=broker), GateState.IN_USE_ARRIVING),
+        (
+            lambda broker: Runway("JFK", "1", broker=broker),
+            RunwayState.IN_USE_ARRIVING,
+        ),
+    ],
+)
+def test_sequence_continues_after_a_restart(component, busy):
+    original = component(LocalBroker())
+    original.state = busy
+    original.state = busy.FREE
+    restored = type(original).from_dict(original.to_dict(), broker=LocalBroker())
+    assert restored.state_seq == original.state_seq == 2
@@ -0,0 +1,57 @@
+"""Replaying recorded events into the components' Redis keys"""
+
+import pytest
+
+from plane import PlaneState
+from replay import ReplayState, without_password
+from sharding import sky_shard
+
+
+def fly(state: ReplayState, plane_id: str, destination: str, to_state: str):
+    """a plane on its way from ORG to destination"""
+    state.flight_info(f"f-{plane_id}", plane_id, from_airport="ORG")
+    state.flight_info(f"f-{plane_id}", plane_id, to_airport=destination)
+    state.pending.append(
+        {"plane_id": plane_id, "flight_id": f"f-{plane_id}", "to_state": to_state}
+    )
+    state.end_tick()
+
+
+def test_sky_is_split_by_shard():
+    first, second = "JFK", "LAX"
+    assert sky_shard(first, 2) != sky_shard(second, 2)
+    state = ReplayState(sky_shards=2)
+    fly(state, "p1", first, PlaneState.IN_SKY.value)
+    fly(state, "p2", second, PlaneState.CIRCLING.value)
+    skies = {
+        key: value
+        for key, value in state.component_states(everything=True).items()
+        if key.startswith("sky")
+    }
+    assert set(skies) == {"sky-0", "sky-1"}
+    flying = skies[f"sky-{sky_shard(first, 2)}"]
+    circling = skies[f"sky-{sky_shard(second, 2)}"]
+    assert [plane["plane_id"] for plane in flying["planes_flying"]] == ["p1"]
+    assert flying["plane_queues"] == {}
+    assert circling["planes_flying"] == []
+    assert [plane["plane_id"] for plane in circling["plane_queues"][second]] == ["p2"]
+
+
+def test_single_sky_keeps_its_key():
+    state = ReplayState(sky_shards=1)
+    fly(state, "p1", "JFK", PlaneState.IN_SKY.value)
+    assert state.component_states()["sky"]["planes_flying"][0]["plane_id"] == "p1"
+
+
+@pytest.mark.parametrize(
+    "connection_string, name",
+    [
+        (
+            "postgresql://airport:secret@db:5432/airport",
+            "postgresql://airport@db:5432/airport",
+        ),
+        ("postgresql://db/airport", "postgresql://db/airport"),
+    ],
+)
+def test_checkpoints_are_named_without_the_password(connection_string, name):
+    assert without_password(connection_string) == name
@@ -0,0 +1,41 @@
+"""Consistent hashing of airports to Sky shards"""
+
+import pytest
+
+from sharding import HashRing, sky_redis_key, sky_shard, sky_topic
+
+AIRPORTS = [f"A{number:04d}" for number in range(4000)]
+
+
+def owners(shards: int) -> dict:
+    """airport -> shard"""
+    ring = HashRing(shards)
+    return {airport: ring.shard_for(airport) for airport in AIRPORTS}
+
+
+def test_the_same_ring_is_built_everywhere():
+    assert owners(4) == owners(4)
+
+
+@pytest.mark.parametrize("shards", [2, 4, 8])
+def test_adding_a_shard_only_moves_airports_to_it(shards):
+    before, after = owners(shards), owners(shards + 1)
+    moved = [airport for airport in AIRPORTS if before[airport] != after[airport]]
+    assert all(after[airport] == shards for airport in moved)
+    # about 1/(N+1) of the airports move
+    assert len(moved) / len(AIRPORTS) == pytest.approx(1 / (shards + 1), abs=0.08)
+
+
+def test_shards_share_the_airports():
+    counts = [0] * 4
+    for shard in owners(4).values():
+        counts[shard] += 1
+    assert min(counts) > len(AIRPORTS) / 4 * 0.6
+
+
+def test_single_shard_keeps_the_original_names():
+    assert sky_shard("JFK", 1) == 0
+    assert sky_topic(0, 1) == "sky"
+    assert sky_redis_key(0, 1) == "sky"
+    assert sky_topic(2, 4) == "sky/2"
+    assert sky_redis_key(2, 4) == "sky-2"
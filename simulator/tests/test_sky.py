@@ -0,0 +1,109 @@
+"""Sky shards passing on the planes they don't own after a restart"""
+
+import fakeredis
+import pytest
+
+import sharding
+import sky
+import snapshot
+from inputlog import log_key
+from localbroker import LocalBroker, LocalClient
+from plane import Plane, PlaneState
+from sky import Sky, retired_shard_keys
+
+SHARDS = 2
+
+
+class DeferredClient(LocalClient):
+    """connects like paho and SharedConnection: on_connect runs later, from
+    the network loop"""
+
+    def connect(self, *args, **kwargs):
+        self.broker.clients[self.client_id] = self
+
+
+class DeferredBroker(LocalBroker):
+    """LocalBroker whose clients wait for connect_all()"""
+
+    def client(self, client_id: str) -> LocalClient:
+        return DeferredClient(self, client_id)
+
+    def connect_all(self):
+        """the connections come up"""
+        for client in list(self.clients.values()):
+            client.on_connect(client, client.userdata, None, 0, None)
+
+
+@pytest.fixture(autouse=True)
+def two_shards(monkeypatch):
+    """route as if SKY_SHARDS=2"""
+    monkeypatch.setattr(sky, "sky_shard", lambda a: sharding.sky_shard(a, SHARDS))
+    monkeypatch.setattr(
+        sky,
+        "sky_topic_for",
+        lambda a: sharding.sky_topic(sharding.sky_shard(a, SHARDS), SHARDS),
+    )
+
+
+def airport_of(shard: int) -> str:
+    """an airport owned by shard"""
+    return next(
+        name
+        for name in (f"A{number:03d}" for number in range(100))
+        if sharding.sky_shard(name, SHARDS) == shard
+    )
+
+
+def plane_to(airport: str, state: PlaneState) -> dict:
+    """a plane flying to airport"""
+    plane = Plane("ORG", airport)
+    plane.state = state
+    return plane.to_dict()
+
+
+def state_with(ours: str, theirs: str) -> dict:
+    """a shard 0 snapshot holding planes of both shards"""
+    return {
+        "shard": 0,
+        "planes_flying": [
+            plane_to(ours, PlaneState.IN_SKY),
+            plane_to(theirs, PlaneState.IN_SKY),
+        ],
+        "plane_queues": {theirs: [plane_to(theirs, PlaneState.CIRCLING)]},
+    }
+
+
+def test_restored_shard_hands_off_once_connected():
+    ours, theirs = airport_of(0), airport_of(1)
+    broker = DeferredBroker()
+    restored = Sky.from_dict(state_with(ours, theirs), broker=broker)
+    assert not broker.published  # not connected, nothing to log with yet
+    broker.connect_all()
+    assert broker.published[sharding.sky_topic(1, SHARDS)] == 2
+    assert [plane.end_airport for plane in restored.planes_flying] == [ours]
+    assert theirs not in restored.plane_queues
+
+
+def test_retired_shard_keys():
+    redis_client = fakeredis.FakeRedis()
+    for key in ("sky", "sky-0", "sky-1", "sky-2", "sky-3", "sky-x"):
+        redis_client.set(key, b"{}")
+    assert retired_shard_keys(redis_client, SHARDS) == ["sky", "sky-2", "sky-3"]
+    assert retired_shard_keys(redis_client, 1) == ["sky-0", "sky-1", "sky-2", "sky-3"]
+
+
+def test_take_over_a_retired_shard():
+    ours, theirs = airport_of(0), airport_of(1)
+    redis_client = fakeredis.FakeRedis()
+    redis_client.set("sky-2", snapshot.dumps(dict(state_with(ours, theirs), shard=2)))
+    redis_client.rpush(log_key("sky-2"), b"entry")
+    broker = DeferredBroker()
+    shard = Sky(0, broker=broker)
+    assert shard.take_over(redis_client, "sky-2") == 3
+    assert not redis_client.exists("sky-2", log_key("sky-2"))
+    saved = snapshot.loads(redis_client.get(shard.redis_key))
+    assert len(saved["planes_flying"]) == 2
+    assert len(saved["plane_queues"][theirs]) == 1
+    broker.connect_all()
+    assert broker.published[sharding.sky_topic(1, SHARDS)] == 2
+    assert len(shard.planes_flying) == 1
@@ -0,0 +1,78 @@
+"""Snapshot encodings round trip, old JSON keys keep loading"""
+
+import json
+import random
+
+import pytest
+
+import snapshot
+from airport import Airport
+from localbroker import LocalBroker
+from plane import Plane
+
+
+def sky_state(planes: int = 50) -> dict:
+    """a state large enough to be compressed"""
+    rng = random.Random(2)
+    return {
+        "ticks": 42,
+        "planes": [Plane("JFK", "LAX", rng).to_dict() for _ in range(planes)],
+    }
+
+
+def test_json_is_the_default():
+    state = sky_state()
+    assert snapshot.dumps(state) == json.dumps(state)
+    assert snapshot.loads(snapshot.dumps(state)) == state
+
+
+@pytest.mark.parametrize("compression", ["none", "zlib", "zstd", "lz4"])
+def test_binary_round_trip(compression):
+    if compression == "zstd" and snapshot.zstandard is None:
+        pytest.skip("zstandard is not installed")
+    if compression == "lz4" and snapshot.lz4 is None:
+        pytest.skip("lz4 is not installed")
+    state = sky_state()
+    raw = snapshot.dumps(state, "binary", compression)
+    assert raw[: len(snapshot.MAGIC)] == snapshot.MAGIC
+    assert raw[len(snapshot.MAGIC) + 2] == snapshot.COMPRESSIONS[compression]
+    assert snapshot.loads(raw) == state
+
+
+def test_small_bodies_are_not_compressed():
+    raw = snapshot.dumps({"gate_state": "free"}, "binary", "zlib")
+    assert raw[len(snapshot.MAGIC) + 2] == snapshot.COMPRESSION_NONE
+    assert snapshot.loads(raw) == {"gate_state": "free"}
+
+
+@pytest.mark.parametrize(
+    "legacy", [json.dumps(sky_state()), json.dumps(sky_state()).encode()]
+)
+def test_legacy_json_loads(legacy):
+    assert snapshot.loads(legacy) == sky_state()
+
+
+def test_newer_version_is_refused():
+    raw = bytearray(snapshot.dumps(sky_state(), "binary"))
+    raw[len(snapshot.MAGIC)] = snapshot.VERSION + 1
+    with pytest.raises(ValueError):
+        snapshot.loads(bytes(raw))
+
+
+def test_corrupt_body_raises_value_error():
+    raw = snapshot.dumps(sky_state(), "binary", "zlib")
+    with pytest.raises(ValueError):
+        snapshot.loads(raw[:-20])
+
+
+@pytest.mark.parametrize("snapshot_format", ["json", "binary"])
+def test_component_restores_from_snapshot(snapshot_format):
+    airport = Airport(
+        "JFK", ["1", "2"], [str(gate) for gate in range(30)], broker=LocalBroker()
+    )
+    airport.ticks = 7
+    restored = Airport.from_dict(
+        snapshot.loads(snapshot.dumps(airport.to_dict(), snapshot_format)),
+        broker=LocalBroker(),
+    )
+    assert restored.to_dict() == airport.to_dict()
@@ -0,0 +1,220 @@
+"""Latency tracing of sampled flights
+
+A sampled plane carries a trace context in its payload (Plane.trace): the
+number of hops it made between components, when and on which tick the last
+mark was made, and whether it is in flight between two components. Each
+component it passes through publishes spans on the traces topic:
+
+- broker/<msg_type>: from publishing the plane until the next component
+  started handling it, i.e. time spent in the broker and its inbox
+- <Component>/<state>: time the plane spent in a component in that state,
+  e.g. Airport/in_hangar is the wait for a departure gate and Sky/circling
+  the wait for a runway
+
+TRACE_SAMPLE_RATE (0 to 1, default 0) is the share of new flights traced;
+the choice is made from the flight id so it costs no random draws. Wall
+clock spans between processes assume their clocks are synchronised.
+
+The collector aggregates the spans into per-hop latency percentiles, in
+seconds and in ticks, plus the end-to-end latency of completed flights:
+
+    python tracing.py --interval 30 --output traces.json
+"""
+
+import argparse
+import json
+import os
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+import paho.mqtt.client as mqtt
+
+MQTT_BROKER = os.environ.get("MQTT_BROKER", "localhost")
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0"))
+
+TRACES_TOPIC = "traces"
+FINAL_SEGMENT = "Gate/at_arrival_gate"  # the last span of a flight
+
+
+def sampled(flight_id: str) -> bool:
+    """whether a new flight is traced"""
+    return (
+        TRACE_SAMPLE_RATE > 0
+        and int(flight_id[:8], 16) < TRACE_SAMPLE_RATE * 0x100000000
+    )
+
+
+def start(ticks: int) -> dict:
+    """trace context of a new plane"""
+    return {"hop": 0, "mark": time.time(), "mark_tick": ticks, "in_flight": False}
+
+
+def _span(component, trace: dict, flight_id: str, segment: str):
+    """publish the span since the last mark and move the mark to now"""
+    now = time.time()
+    component.publish(
+        TRACES_TOPIC,
+        {
+            "flight_id": flight_id,
+            "hop": trace["hop"],
+            "segment": segment,
+            "component": component.mqttclientname,
+            "seconds": now - trace["mark"],
+            "ticks": component.ticks - trace["mark_tick"],
+        },
+    )
+    trace["mark"] = now
+    trace["mark_tick"] = component.ticks
+
+
+def state_changed(component, plane, old_state: str):
+    """a traced plane changed state in component"""
+    trace = plane.trace
+    if not trace["in_flight"]:
+        _span(
+            component, trace, plane.flight_id, f"{type(component).__name__}/{old_state}"
+        )
+
+
+def received(component, msg_type: str, plane_data: dict):
+    """component is about to handle a message carrying a traced plane"""
+    trace = plane_data["trace"]
+    if trace["in_flight"]:
+        _span(component, trace, plane_data["flight_id"], f"broker/{msg_type}")
+        trace["in_flight"] = False
+
+
+def sending(component, plane_data: dict):
+    """component publishes a message handing a traced plane on"""
+    trace = plane_data["trace"]
+    if trace["in_flight"]:  # already stamped, e.g. when a batch is flushed
+        return
+    _span(
+        component,
+        trace,
+        plane_data["flight_id"],
+        f"{type(component).__name__}/{plane_data['state']}",
+    )
+    trace["hop"] += 1
+    trace["in_flight"] = True
+
+
+class Traced:
+    """Component mixin marking traced planes as they arrive and leave"""
+
+    def handle_message(self, message: dict):
+        """a span for the time a traced plane spent in the broker"""
+        plane = message.get("plane")
+        if plane.__class__ is dict and "trace" in plane and "msg_type" in message:
+            received(self, message["msg_type"], plane)
+        super().handle_message(message)
+
+    def publish(self, topic: str, message: dict | str):
+        """a span for the time a traced plane spent here"""
+        if message.__class__ is dict and "plane" in message:
+            plane = message["plane"]
+            if plane.__class__ is dict and "trace" in plane:
+                sending(self, plane)
+        super().publish(topic, message)
+
+
+def percentile(values: List[float], q: float) -> float:
+    """nearest-rank percentile of sorted values"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, round(q * len(values)) - 1))]
+
+
+class TraceCollector:
+    """Aggregates spans into latency percentiles per segment"""
+
+    def __init__(self):
+        self.seconds: Dict[str, List[float]] = defaultdict(list)
+        self.ticks: Dict[str, List[int]] = defaultdict(list)
+        self.flights: Dict[str, List[float]] = defaultdict(lambda: [0.0, 0])
+        self.spans = 0
+
+    def add(self, span: dict):
+        """record one span"""
+        segment = span["segment"]
+        self.seconds[segment].append(span["seconds"])
+        self.ticks[segment].append(span["ticks"])
+        totals = self.flights[span["flight_id"]]
+        totals[0] += span["seconds"]
+        totals[1] += span["ticks"]
+        if segment == FINAL_SEGMENT:
+            seconds, ticks = self.flights.pop(span["flight_id"])
+            self.seconds["end_to_end"].append(seconds)
+            self.ticks["end_to_end"].append(ticks)
+        self.spans += 1
+
+    def summary(self) -> Dict[str, dict]:
+        """count and p50/p90/p99 per segment"""
+        result = {}
+        for segment in sorted(self.seconds):
+            seconds = sorted(self.seconds[segment])
+            ticks = sorted(self.ticks[segment])
+            result[segment] = {
+                "count": len(seconds),
+                **{
+                    f"p{q}_seconds": round(percentile(seconds, q / 100), 6)
+                    for q in (50, 90, 99)
+                },
+                **{f"p{q}_ticks": percentile(ticks, q / 100) for q in (50, 90, 99)},
+            }
+        return result
+
+    def report(self) -> str:
+        """the summary as a table"""
+        lines = [
+            f"{'segment':40} {'count':>7} {'p50 s':>10} {'p90 s':>10} {'p99 s':>10}"
+            + f" {'p50 t':>6} {'p90 t':>6} {'p99 t':>6}"
+        ]
+        for segment, row in self.summary().items():
+            lines.append(
+                f"{segment:40} {row['count']:>7} {row['p50_seconds']:>10.4f} "
+                + f"{row['p90_seconds']:>10.4f} {row['p99_seconds']:>10.4f} "
+                + f"{row['p50_ticks']:>6} {row['p90_ticks']:>6} {row['p99_ticks']:>6}"
+            )
+        return "\n".join(lines)
+
+
+def main():
+    """main"""
+    parser = argparse.ArgumentParser(description="Collect plane latency traces")
+    parser.add_argument(
+        "--interval", type=float, default=30, help="seconds between reports"
+    )
+    parser.add_argument("--output", help="JSON file for the summary at exit")
+    args = parser.parse_args()
+
+    import codec  # pylint:disable=import-outside-toplevel  # codec imports plane
+
+    collector = TraceCollector()
+
+    def on_traces(client, userdata, msg):  # pylint:disable=unused-argument
+        for span in codec.unbatch(codec.decode(msg.payload)):
+            collector.add(span)
+
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, "TraceCollector")
+    client.on_connect = lambda client, *args: client.subscribe(TRACES_TOPIC)
+    client.message_callback_add(TRACES_TOPIC, on_traces)
+    client.connect(MQTT_BROKER)
+    client.loop_start()
+    try:
+        while True:
+            time.sleep(args.interval)
+            print(f"{collector.spans} spans\n{collector.report()}\n", flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.loop_stop()
+        print(collector.report())
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as output:
+                json.dump(collector.summary(), output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
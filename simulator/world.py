@@ -0,0 +1,538 @@
+"""Headless simulation of a whole world, optionally spread over processes
+
+A world is a set of airports, each with its gates and runways, plus Sky. The
+airports are split into partitions that each run on their own LocalBroker,
+all in this process or one worker process per partition. Airports only
+interact through Sky, so the partitions run a tick independently and what
+they send to Sky, and what Sky sends back, is exchanged in bulk at tick
+boundaries:
+
+    tick t:  every partition gets Sky's messages from tick t-1, its new
+             planes and heartbeat t, and runs until it is idle;
+             Sky gets the partitions' messages sorted by airport, then
+             heartbeat t, and runs until it is idle
+
+Every component draws from its own generator, seeded from --seed and its
+name, so a run gives the same result however the airports are partitioned.
+--check runs the world serially and in parallel and compares the results.
+
+With the "probes" option every partition also records handler latencies
+and counts the bytes the components would write to Redis, for
+benchmarks/throughput.py.
+
+    python world.py --airports 64 --ticks 200 --workers 8 --check
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import random
+import resource
+import sys
+import time
+from collections import Counter, defaultdict
+from typing import Callable, Dict, List, Tuple
+
+import codec
+from airport import Airport
+from gate import Gate
+from localbroker import LocalBroker
+from metrics import Registry
+from runway import Runway
+from sharding import SKY_SHARDS
+from sky import Sky
+
+# (airport the message is from or for, topic, payload)
+Exchange = Tuple[str, str, bytes]
+
+
+def _hash(text: str) -> int:
+    """stable 64 bit hash"""
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "big")
+
+
+class PartitionBroker(LocalBroker):
+    """LocalBroker that holds back the messages meant for another partition"""
+
+    def __init__(self, route: Callable[[str, str | None], str | None]):
+        """route(topic, sender) returns the airport to file a message under
+        when it leaves the partition, or None to deliver it here"""
+        super().__init__()
+        self.route = route
+        self.outgoing: List[Exchange] = []
+
+    def publish(self, topic: str, payload, sender: str | None = None):
+        """queue a message, or hold it back for the exchange"""
+        airport = self.route(topic, sender)
+        if airport is None:
+            super().publish(topic, payload, sender)
+            return
+        if payload is None:
+            payload = b""
+        elif isinstance(payload, str):
+            payload = payload.encode()
+        self.published[topic] += 1
+        self.outgoing.append((airport, topic, payload))
+
+    def take_outgoing(self) -> List[Exchange]:
+        """the held back messages, in publish order"""
+        outgoing, self.outgoing = self.outgoing, []
+        return outgoing
+
+
+class RedisWriteCounter:
+    """Stands in for a component's Redis client and counts its snapshot,
+    plane location index and input log writes"""
+
+    def __init__(self, kind: str, writes: Counter, sizes: Counter):
+        self.kind = kind
+        self.writes = writes
+        self.sizes = sizes
+
+    def set(self, key: str, value: bytes):  # pylint:disable=unused-argument
+        """count a write under the component's class"""
+        self.writes[self.kind] += 1
+        self.sizes[self.kind] += len(value)
+
+    def pipeline(self, transaction: bool = True):  # pylint:disable=unused-argument
+        """the counter itself; the plane location index writes through it"""
+        return self
+
+    def hset(self, name: str, mapping: dict):  # pylint:disable=unused-argument
+        """count an index write"""
+        self.writes[self.kind] += 1
+        self.sizes[self.kind] += sum(len(value) for value in mapping.values())
+
+    def hdel(self, name: str, *fields):  # pylint:disable=unused-argument
+        """count an index removal"""
+        self.writes[self.kind] += 1
+
+    def delete(self, *names):  # pylint:disable=unused-argument
+        """count the truncation of an input log"""
+        self.writes[self.kind] += 1
+
+    def rpush(self, name: str, *values):  # pylint:disable=unused-argument
+        """count appends to an input log"""
+        self.writes[self.kind] += 1
+        self.sizes[self.kind] += sum(len(value) for value in values)
+
+    def execute(self):
+        """nothing to send"""
+
+
+def merge_histogram(histograms: Dict[str, dict], name: str, counts: list, total):
+    """add bucket counts and a sum to the histogram called name"""
+    merged = histograms.setdefault(name, {"counts": [0] * len(counts), "sum": 0.0})
+    merged["counts"] = [mine + theirs for mine, theirs in zip(merged["counts"], counts)]
+    merged["sum"] += total
+
+
+class Probes:
+    """Latency histograms and Redis writes of a partition's components"""
+
+    def __init__(self):
+        self.registry = Registry()
+        self.writes: Counter = Counter()
+        self.sizes: Counter = Counter()
+
+    def attach(self, component):
+        """have a component write its snapshots to a counter"""
+        component.redis_client = RedisWriteCounter(
+            type(component).__name__, self.writes, self.sizes
+        )
+
+    def results(self, components: list) -> dict:
+        """histograms by "<Class>.<msg_type>" and Redis writes by class"""
+        histograms: Dict[str, dict] = {}
+        for component in components:
+            kind = type(component).__name__
+            metrics = component.metrics
+            named = dict(metrics.handlers)
+            named["heartbeat"] = metrics.heartbeat
+            named["snapshot"] = metrics.snapshot
+            for name, histogram in named.items():
+                merge_histogram(
+                    histograms, f"{kind}.{name}", histogram.counts, histogram.sum
+                )
+        return {
+            "histograms": histograms,
+            "redis_writes": dict(self.writes),
+            "redis_bytes": dict(self.sizes),
+        }
+
+
+class EventDigest:
+    """Order independent digest of the plane events published on a broker"""
+
+    def __init__(self, broker: LocalBroker):
+        self.count = 0
+        self.digest = 0
+        # plane-events by the state entered, other events by their type
+        self.tallies: Counter = Counter()
+        client = broker.client("world-events")
+        client.on_message = self.on_event
+        client.connect()
+        client.subscribe("events")
+        client.subscribe("events/+")
+
+    def on_event(self, client, userdata, msg):  # pylint:disable=unused-argument
+        """add the events of a message"""
+        for event in codec.unbatch(codec.decode(msg.payload)):
+            self.count += 1
+            if event["event_type"] == "plane-event":
+                self.tallies[event["to_state"]] += 1
+            else:
+                self.tallies[event["event_type"]] += 1
+            self.digest = (self.digest + _hash(json.dumps(event, sort_keys=True))) % (
+                1 << 64
+            )
+
+
+def component_results(
+    components: list, broker: LocalBroker, events: EventDigest, probes: Probes | None
+):
+    """what a partition reports at the end of a run"""
+    results = {
+        "states": {
+            component.redis_key: json.dumps(component.to_dict(), sort_keys=True)
+            for component in components
+        },
+        "published": dict(broker.published),
+        "events": events.count,
+        "event_digest": events.digest,
+        "tallies": dict(events.tallies),
+        # KiB on Linux; the whole process, which is the partition in a worker
+        "peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    if probes:
+        results.update(probes.results(components))
+    return results
+
+
+class Partition:
+    """A group of airports with their gates and runways on one LocalBroker"""
+
+    def __init__(self, airports: List[str], options: dict):
+        self.airports = airports
+        self.options = options
+        self.sender_airport: Dict[str, str] = {}
+        self.broker = PartitionBroker(self.route)
+        self.events = EventDigest(self.broker)
+        self.components = []
+
+        # new planes for each airport are drawn from a generator of its own
+        index = {
+            airport: position for position, airport in enumerate(options["airports"])
+        }
+        self.generators = {
+            airport: (
+                random.Random(f"{options['seed']}:generator:{airport}"),
+                index[airport],
+            )
+            for airport in airports
+        }
+
+        kwargs = {
+            "broker": self.broker,
+            "seed": options["seed"],
+            "batch_publish": options["batch_publish"],
+            "events_transport": "mqtt",
+        }
+        self.probes = Probes() if options.get("probes") else None
+        if self.probes:
+            kwargs["metrics_registry"] = self.probes.registry
+        for airport in airports:
+            self.add(airport, Airport(airport, [], [], **kwargs))
+            for gate_number in range(options["gates"]):
+                self.add(airport, Gate(airport, str(gate_number), **kwargs))
+            for runway_number in range(options["runways"]):
+                self.add(airport, Runway(airport, str(runway_number), **kwargs))
+        self.broker.run()
+
+    def add(self, airport: str, component):
+        """keep track of a component and the airport it belongs to"""
+        self.sender_airport[component.mqttclientname] = airport
+        self.components.append(component)
+        if self.probes:
+            self.probes.attach(component)
+
+    def route(self, topic: str, sender: str | None) -> str | None:
+        """messages to Sky leave the partition, filed under their airport"""
+        if topic == "sky" or topic.startswith("sky/"):
+            return self.sender_airport.get(sender, "")
+        return None
+
+    def step(self, ticks: int, inbound: Dict[str, list]) -> List[Exchange]:
+        """run one tick; returns the messages for Sky"""
+        for airport in self.airports:
+            for topic, payload in inbound.get(airport, ()):
+                self.broker.publish(topic, payload)
+
+        everywhere = self.options["airports"]
+        for airport, (generator, index) in self.generators.items():
+            if generator.random() < self.options["new_plane_prob"]:
+                destination = generator.randrange(len(everywhere) - 1)
+                if destination >= index:
+                    destination += 1
+                self.broker.publish(
+                    f"airport/{airport}",
+                    json.dumps(
+                        {
+                            "msg_type": "new_plane",
+                            "end_airport": everywhere[destination],
+                        }
+                    ),
+                )
+
+        self.broker.publish("heartbeat", json.dumps({"ticks": ticks}))
+        self.broker.run()
+        return self.broker.take_outgoing()
+
+    def results(self) -> dict:
+        """states, message counts and event digest"""
+        return component_results(self.components, self.broker, self.events, self.probes)
+
+
+class SkyPartition:
+    """The Sky shards on their own LocalBroker"""
+
+    def __init__(self, options: dict):
+        self.broker = PartitionBroker(self.route)
+        self.events = EventDigest(self.broker)
+        self.probes = Probes() if options.get("probes") else None
+        self.components = [
+            Sky(
+                shard,
+                broker=self.broker,
+                seed=options["seed"],
+                batch_publish=options["batch_publish"],
+                events_transport="mqtt",
+                metrics_registry=self.probes.registry if self.probes else None,
+            )
+            for shard in range(SKY_SHARDS)
+        ]
+        if self.probes:
+            for sky in self.components:
+                self.probes.attach(sky)
+        self.broker.run()
+
+    @staticmethod
+    def route(topic: str, sender: str | None) -> str | None:
+        """messages to airports, runways and gates leave for their partition"""
+        # pylint:disable=unused-argument
+        if topic.startswith("airport/"):
+            return topic.split("/", 2)[1]
+        return None
+
+    def step(self, ticks: int, messages: List[Exchange]) -> Dict[str, list]:
+        """run one tick on the partitions' messages; returns what Sky sent to
+        each airport"""
+        # sorting by airport keeps each airport's messages in order and makes
+        # the order independent of how airports are partitioned
+        for _, topic, payload in sorted(messages, key=lambda message: message[0]):
+            self.broker.publish(topic, payload)
+        self.broker.publish("heartbeat", json.dumps({"ticks": ticks}))
+        self.broker.run()
+
+        inbound = defaultdict(list)
+        for airport, topic, payload in self.broker.take_outgoing():
+            inbound[airport].append((topic, payload))
+        return inbound
+
+    def results(self) -> dict:
+        """states, message counts and event digest"""
+        return component_results(self.components, self.broker, self.events, self.probes)
+
+
+def _worker(connection, airports: List[str], options: dict):
+    """run a partition in a worker process, driven over a pipe"""
+    partition = Partition(airports, options)
+    while True:
+        command, *arguments = connection.recv()
+        if command == "step":
+            connection.send(partition.step(*arguments))
+        elif command == "results":
+            connection.send(partition.results())
+            return
+
+
+class World:
+    """Airports partitioned over workers (or run in this process) plus Sky"""
+
+    def __init__(self, options: dict, workers: int = 0):
+        airports = options["airports"]
+        partitions = max(1, min(workers, len(airports)))
+        groups = [airports[index::partitions] for index in range(partitions)]
+        self.partition_of = {
+            airport: index for index, group in enumerate(groups) for airport in group
+        }
+        self.sky = SkyPartition(options)
+        self.partitions: List[Partition] = []
+        self.connections = []
+        self.processes = []
+        if workers:
+            for group in groups:
+                parent, child = multiprocessing.Pipe()
+                process = multiprocessing.Process(
+                    target=_worker, args=(child, group, options), daemon=True
+                )
+                process.start()
+                self.connections.append(parent)
+                self.processes.append(process)
+        else:
+            self.partitions = [Partition(group, options) for group in groups]
+        self.partition_count = partitions
+        self.ticks = 0
+        self.inbound: Dict[str, list] = {}  # from Sky, for the next tick
+
+    def run(self, ticks: int):
+        """advance the world by ticks"""
+        for _ in range(ticks):
+            self.ticks += 1
+            per_partition = [{} for _ in range(self.partition_count)]
+            for airport, messages in self.inbound.items():
+                per_partition[self.partition_of[airport]][airport] = messages
+
+            if self.connections:
+                for connection, partition_inbound in zip(
+                    self.connections, per_partition
+                ):
+                    connection.send(("step", self.ticks, partition_inbound))
+                outgoing = [
+                    message
+                    for connection in self.connections
+                    for message in connection.recv()
+                ]
+            else:
+                outgoing = [
+                    message
+                    for partition, partition_inbound in zip(
+                        self.partitions, per_partition
+                    )
+                    for message in partition.step(self.ticks, partition_inbound)
+                ]
+            self.inbound = self.sky.step(self.ticks, outgoing)
+
+    def results(self) -> dict:
+        """merged results of Sky and all partitions; stops the workers"""
+        if self.connections:
+            for connection in self.connections:
+                connection.send(("results",))
+            parts = [connection.recv() for connection in self.connections]
+            for process in self.processes:
+                process.join()
+        else:
+            parts = [partition.results() for partition in self.partitions]
+        parts.append(self.sky.results())
+
+        results = {
+            "states": {},
+            "published": defaultdict(int),
+            "events": 0,
+            "tallies": Counter(),
+            # the workers, then this process, which runs Sky
+            "peak_rss_kib": [
+                part["peak_rss_kib"] for part in parts[: len(self.connections)]
+            ]
+            + [parts[-1]["peak_rss_kib"]],
+        }
+        event_digest = 0
+        for part in parts:
+            results["states"].update(part["states"])
+            for topic, count in part["published"].items():
+                results["published"][topic] += count
+            results["events"] += part["events"]
+            results["tallies"].update(part["tallies"])
+            event_digest = (event_digest + part["event_digest"]) % (1 << 64)
+        results["published"] = dict(results["published"])
+        results["tallies"] = dict(results["tallies"])
+        if "histograms" in parts[0]:
+            results["histograms"] = {}
+            results["redis_writes"] = Counter()
+            results["redis_bytes"] = Counter()
+            for part in parts:
+                for name, histogram in part["histograms"].items():
+                    merge_histogram(
+                        results["histograms"],
+                        name,
+                        histogram["counts"],
+                        histogram["sum"],
+                    )
+                results["redis_writes"].update(part["redis_writes"])
+                results["redis_bytes"].update(part["redis_bytes"])
+            results["redis_writes"] = dict(results["redis_writes"])
+            results["redis_bytes"] = dict(results["redis_bytes"])
+        results["digest"] = hashlib.blake2b(
+            json.dumps([results["states"], event_digest], sort_keys=True).encode(),
+            digest_size=8,
+        ).hexdigest()
+        return results
+
+
+def run_world(options: dict, ticks: int, workers: int) -> Tuple[dict, float]:
+    """run a world; returns its results and the seconds the ticks took"""
+    world = World(options, workers)
+    start = time.perf_counter()
+    world.run(ticks)
+    elapsed = time.perf_counter() - start
+    return world.results(), elapsed
+
+
+def main():
+    """main"""
+    parser = argparse.ArgumentParser(description="Headless world simulation")
+    parser.add_argument("--airports", type=int, default=16)
+    parser.add_argument("--gates", type=int, default=4, help="gates per airport")
+    parser.add_argument("--runways", type=int, default=2, help="runways per airport")
+    parser.add_argument("--ticks", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--prob",
+        type=float,
+        default=0.3,
+        help="probability that an airport gets a new plane on a tick",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="worker processes; 0 runs everything in this process",
+    )
+    parser.add_argument("--batch-publish", action="store_true")
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="also run serially and check that the results are identical",
+    )
+    args = parser.parse_args()
+
+    options = {
+        "airports": [f"A{index:04d}" for index in range(args.airports)],
+        "gates": args.gates,
+        "runways": args.runways,
+        "seed": args.seed,
+        "new_plane_prob": args.prob,
+        "batch_publish": args.batch_publish,
+    }
+    results, elapsed = run_world(options, args.ticks, args.workers)
+    print(
+        f"{args.airports} airports, {args.ticks} ticks, {args.workers} workers: "
+        + f"{args.ticks / elapsed:.1f} ticks/s ({elapsed:.2f}s)"
+    )
+    print(
+        f"{sum(results['published'].values())} messages, "
+        + f"{results['events']} events, digest {results['digest']}"
+    )
+
+    if args.check:
+        serial, serial_elapsed = run_world(options, args.ticks, 0)
+        print(f"serial: {args.ticks / serial_elapsed:.1f} ticks/s")
+        if serial["digest"] != results["digest"]:
+            print(f"MISMATCH: serial digest {serial['digest']}")
+            sys.exit(1)
+        print("serial and parallel results are identical")
+
+
+if __name__ == "__main__":
+    main()